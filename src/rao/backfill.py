@@ -0,0 +1,92 @@
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import timedelta
+
+from loguru import logger
+
+from . import doc_parsing as dp
+from . import remarkable
+from .file_processing_config import ProcessingConfig
+from .metrics import Metrics
+from .models import RemarkableFile
+from .pipeline import DocumentResult
+
+
+@dataclass(frozen=True)
+class BackfillEstimate:
+    documents: int
+    pages: int
+    api_calls: int
+
+    @property
+    def duration(self) -> timedelta:
+        """Lower bound, as conversions are capped by the API quota."""
+        return timedelta(seconds=round(60 * self.api_calls / dp.API_CALLS_PER_MINUTE))
+
+    def __str__(self) -> str:
+        return (
+            f"{self.documents} documents with up to {self.pages} pages, "
+            f"needing up to {self.api_calls} model requests, "
+            f"taking at least {self.duration}"
+        )
+
+
+def estimate(
+    client: remarkable.Source,
+    files: list[RemarkableFile],
+    file_configs: dict[RemarkableFile, ProcessingConfig],
+) -> BackfillEstimate:
+    """Size up a backfill from the documents' page counts, without rendering them.
+
+    Pages already synced are skipped during the backfill, so these are upper bounds.
+    """
+    page_counts = remarkable.count_pages(client, files)
+    return BackfillEstimate(
+        documents=len(files),
+        pages=sum(page_counts[file.uuid] for file in files),
+        api_calls=sum(
+            page_counts[file.uuid]
+            for file in files
+            if not file_configs[file].pdf_only and file_configs[file].prompt
+        ),
+    )
+
+
+class BackfillProgress:
+    """Logs progress, throughput, and time left as documents are checkpointed."""
+
+    def __init__(
+        self, estimate: BackfillEstimate, clock: Callable[[], float] = time.monotonic
+    ):
+        self._estimate = estimate
+        self._clock = clock
+        self._started = clock()
+        self._lock = threading.Lock()
+        self.documents = 0
+        self.pages = 0
+        self.converted = 0
+
+    def document_done(self, doc: DocumentResult):
+        with self._lock:
+            self.documents += 1
+            self.pages += len(doc.pages)
+            self.converted += len(doc.rendered)
+            documents, converted = self.documents, self.converted
+        elapsed_minutes = max(self._clock() - self._started, 1e-9) / 60
+        throughput = converted / elapsed_minutes
+        remaining = max(self._estimate.api_calls - converted, 0)
+        eta = (
+            timedelta(seconds=round(60 * remaining / throughput))
+            if throughput
+            else "unknown"
+        )
+        logger.info(
+            f"Backfill {documents}/{self._estimate.documents} documents "
+            f"({doc.file.name}): {converted} pages converted, "
+            f"{throughput:.1f} pages/min, about {eta} left"
+        )
+        Metrics.set("backfill_documents", documents)
+        Metrics.set("backfill_pages_converted", converted)
+        Metrics.set("backfill_pages_per_minute", round(throughput, 1))
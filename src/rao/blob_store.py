@@ -0,0 +1,51 @@
+import atexit
+import itertools
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# Payloads up to this size aren't worth a file of their own and stay in memory
+INLINE_LIMIT = 4096
+
+# Either the payload itself, or where it was spilled to
+Blob = bytes | Path
+
+
+class BlobStore:
+    """Keeps large binary payloads, e.g. rendered PDF pages, on disk instead of in memory.
+
+    Blobs are written once and read back on demand. Each one is deleted again once
+    nothing refers to it, see `RemarkablePage`.
+    """
+
+    def __init__(self, root: Path | None = None, inline_limit: int = INLINE_LIMIT):
+        self._root = root
+        self._inline_limit = inline_limit
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def root(self) -> Path:
+        with self._lock:
+            if self._root is None:
+                self._root = Path(tempfile.mkdtemp(prefix="rao-blobs-"))
+                atexit.register(shutil.rmtree, self._root, ignore_errors=True)
+        return self._root
+
+    def put(self, data: bytes) -> Blob:
+        if len(data) <= self._inline_limit:
+            return data
+        path = self.root / f"{next(self._ids)}.blob"
+        path.write_bytes(data)
+        return path
+
+    def get(self, blob: Blob) -> bytes:
+        return blob if isinstance(blob, bytes) else blob.read_bytes()
+
+    def discard(self, blob: Blob):
+        if isinstance(blob, Path):
+            blob.unlink(missing_ok=True)
+
+
+store = BlobStore()
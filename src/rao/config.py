@@ -1,4 +1,6 @@
-from dataclasses import asdict, dataclass
+import re
+import threading
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
 from typing import TypeAlias
 
@@ -11,45 +13,124 @@ _DEFAULT_PROMPT = """Render this document as rmarkdown and ensure that tables ar
 DB_CACHE_PATH = Path("/tmp/rao_db/db.sqlite")
 CONFIG_PATH = Path("/data/config.toml")
 
+# Tablets are synced from threads of their own, which all reload the config
+_reload_lock = threading.Lock()
+
 
 class ConfigLoadError(Exception):
     pass
 
 
+@dataclass(frozen=True)
+class Tablet:
+    """Connection details of one tablet, from a `[[remarkable-auto-ocr-app.tablets]]` section.
+
+    Outputs and DB state of each tablet are kept apart by its `name`, except for the
+    unnamed tablet configured by the top-level keys, which uses the original layout.
+    """
+
+    name: str
+    remarkable_ip_address: str
+    ssh_key_path: str
+    snapshot_path: str | None = None
+
+
 @dataclass()
 class _Config:
     google_api_key: str = ""
     remarkable_ip_address: str = ""
     ssh_key_path: str = ""
     check_interval: Seconds = 120
+    min_check_interval: Seconds = 30
+    max_check_interval: Seconds = 1800
+    max_staleness: Seconds = 3600
+    max_cycle_seconds: Seconds | None = 900
+    max_pages_per_cycle: int | None = None
+    max_api_calls_per_cycle: int | None = None
     whitelist_path: str | None = None
     blacklist_path: str | None = None
     md_repo_path: str | None = None
+    md_repo_push_interval: Seconds = 600
+    md_repo_push_files: int = 100
     pdf_copy_path: str | None = None
+    pdf_copy_workers: int = 2
+    pdf_copy_timeout: Seconds = 120
     db_data_dir: str | None = None
+    db_echo: bool = False
+    db_backup_interval: Seconds = 600
+    gc_interval: Seconds = 3600
+    metrics_path: str | None = None
+    watch_inputs: bool = True
+    watch_poll_interval: Seconds = 5
+    control_socket_path: str | None = "/tmp/rao.sock"
     default_prompt: str = _DEFAULT_PROMPT
     model: str = "gemini-1.5-pro"
     backup_model: str = "gemini-1.5-flash"
     prompts_dir: str = "/data/prompts"
     render_path: str = "/data/renders"
+    snapshot_path: str | None = None
+    render_workers: int = 2
+    ocr_workers: int = 4
+    save_workers: int = 1
+    pipeline_queue_size: int = 16
+    job_queue_dir: str | None = None
+    job_lease_seconds: Seconds = 300
+    tablets: list[dict] = field(default_factory=list)
 
     @classmethod
     def _load(cls):
         logger.info(f"Loading config from {CONFIG_PATH}")
         data = tomllib.load(CONFIG_PATH.open("rb"))
-        return cls(**data["remarkable-auto-ocr-app"])
+        config = cls(**data["remarkable-auto-ocr-app"])
+        config.devices()  # Fail early on invalid tablet sections
+        return config
+
+    def devices(self) -> list[Tablet]:
+        """All tablets to sync, falling back to the single one from the top-level keys."""
+        if not self.tablets:
+            return [
+                Tablet(
+                    name="",
+                    remarkable_ip_address=self.remarkable_ip_address,
+                    ssh_key_path=self.ssh_key_path,
+                    snapshot_path=self.snapshot_path,
+                )
+            ]
+        tablets = [
+            Tablet(**{"ssh_key_path": self.ssh_key_path, **section})
+            for section in self.tablets
+        ]
+        names = [tablet.name for tablet in tablets]
+        if len(set(names)) != len(names) or not all(
+            re.fullmatch(r"[\w\-]+", name) for name in names
+        ):
+            raise ConfigLoadError(f"Tablet names must be unique and non-empty: {names}")
+        return tablets
 
     def reload(self):
-        try:
-            new = self._load()
-        except tomllib.TOMLDecodeError as e:
-            logger.error(f"Unable to load toml file: {e}")
-            raise ConfigLoadError from e
-        except FileNotFoundError as e:
-            logger.error(f"Unable to load toml file: {e}")
-            raise ConfigLoadError from e
-        for key, value in asdict(new).items():
-            setattr(self, key, value)
+        """Apply changes to `config.toml`.
+
+        Only changed settings are replaced, all in one go, so threads in the middle of a
+        cycle never see a half-applied reload, or any change at all if there is none.
+        """
+        with _reload_lock:
+            try:
+                new = self._load()
+            except tomllib.TOMLDecodeError as e:
+                logger.error(f"Unable to load toml file: {e}")
+                raise ConfigLoadError from e
+            except FileNotFoundError as e:
+                logger.error(f"Unable to load toml file: {e}")
+                raise ConfigLoadError from e
+            except TypeError as e:
+                logger.error(f"Invalid config: {e}")
+                raise ConfigLoadError from e
+            changed = {
+                key: value
+                for key, value in asdict(new).items()
+                if getattr(self, key) != value
+            }
+            vars(self).update(changed)
 
 
 Config = _Config()
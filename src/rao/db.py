@@ -1,23 +1,174 @@
-from collections.abc import Iterable
+import json
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import wraps
+from itertools import batched
+from pathlib import Path
 
 from loguru import logger
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session
 
-from .config import DB_CACHE_PATH
+from .config import DB_CACHE_PATH, Config, Tablet
 from .file_processing_config import ProcessingConfig
-from .models import Base, Metadata, Page, RemarkableFile, RemarkablePage
+from .models import (
+    PAGE_TEXT_FTS_DDL,
+    Base,
+    Metadata,
+    Page,
+    PageText,
+    RemarkableFile,
+    RemarkablePage,
+    SyncState,
+)
 
+# SQLite caps the number of bound parameters per statement (999 on older builds),
+# so large `IN (...)` lookups are split into chunks of this size.
+QUERY_CHUNK_SIZE = 500
 
-def get_engine() -> Engine:
-    engine = create_engine(f"sqlite:///{DB_CACHE_PATH}", echo=True)
-    Base.metadata.create_all(engine)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -16000,  # in KiB, i.e. 16MB
+    "busy_timeout": 5000,  # in ms
+}
+
+
+def _set_sqlite_pragmas(dbapi_connection, pragmas: dict[str, str | int]):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+# Each entry upgrades the schema by one version (tracked in `PRAGMA user_version`).
+# Fresh DBs are created from the models directly and stamped with the latest version,
+# so only ever append to this list.
+SCHEMA_MIGRATIONS: list[list[str]] = [
+    # 1: Look up pages by document
+    ["CREATE INDEX IF NOT EXISTS ix_page_parent_uuid ON page (parent_uuid)"],
+    # 2: Remember where a document was rendered to, so outputs can be cleaned up
+    ["ALTER TABLE metadata ADD COLUMN path VARCHAR"],
+    # 3: Key/value store for state carried between sync cycles
+    [
+        "CREATE TABLE IF NOT EXISTS sync_state "
+        "(key VARCHAR NOT NULL PRIMARY KEY, value VARCHAR)"
+    ],
+    # 4: Full-text search over the converted pages
+    [
+        "CREATE TABLE IF NOT EXISTS page_text (id INTEGER NOT NULL PRIMARY KEY, "
+        "uuid VARCHAR NOT NULL UNIQUE, parent_uuid VARCHAR, path VARCHAR, "
+        "page_idx INTEGER, text VARCHAR)",
+        "CREATE INDEX IF NOT EXISTS ix_page_text_parent_uuid "
+        "ON page_text (parent_uuid)",
+        *PAGE_TEXT_FTS_DDL,
+    ],
+]
+LIBRARY_FINGERPRINT_KEY = "library_fingerprint"
+# Pages of a force-reprocessed document converted so far, kept until the pass is done
+FORCED_PASS_KEY = "forced_pass:{}"
+# Set once the pages converted before the search index existed have been indexed
+PAGE_TEXT_SEEDED_KEY = "page_text_seeded"
+
+
+# When garbage was last collected, by DB, as every tablet's DB is collected on its own
+_gc_last_run: dict[str, float] = {}
+
+
+@dataclass(frozen=True)
+class SearchHit:
+    path: str | None
+    page_idx: int
+    uuid: str
+    snippet: str
+    rank: float  # Lower is better
+
+
+def db_path_for(tablet: Tablet) -> Path:
+    """Every named tablet has a DB of its own, so their documents can't get mixed up."""
+    if not tablet.name:
+        return DB_CACHE_PATH
+    return DB_CACHE_PATH.with_name(
+        f"{DB_CACHE_PATH.stem}-{tablet.name}{DB_CACHE_PATH.suffix}"
+    )
+
+
+def get_engine(db_path: Path | None = None) -> Engine:
+    engine = create_sqlite_engine(db_path or DB_CACHE_PATH)
+    _migrate(engine)
     return engine
 
 
+def create_sqlite_engine(
+    db_path: Path, pragmas: dict[str, str | int] = SQLITE_PRAGMAS
+) -> Engine:
+    engine = create_engine(f"sqlite:///{db_path}", echo=Config.db_echo)
+    event.listen(
+        engine,
+        "connect",
+        lambda dbapi_connection, _: _set_sqlite_pragmas(dbapi_connection, pragmas),
+    )
+    return engine
+
+
+def _migrate(engine: Engine) -> None:
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if not inspect(conn).get_table_names():
+            logger.info("Creating new DB")
+            Base.metadata.create_all(conn)
+            version = len(SCHEMA_MIGRATIONS)
+        for migration in SCHEMA_MIGRATIONS[version:]:
+            version += 1
+            logger.info(f"Migrating DB schema to version {version}")
+            for statement in migration:
+                conn.exec_driver_sql(statement)
+        conn.exec_driver_sql(f"PRAGMA user_version={version}")
+
+
+@contextmanager
+def session_scope(engine: Engine, label: str = "this cycle") -> Iterator[Session]:
+    """Unit of work, e.g. for one sync cycle: a single session and transaction, committed on success."""
+    session = Session(bind=engine)
+    session.info["db_time"] = 0.0
+    try:
+        yield session
+        start = time.perf_counter()
+        session.commit()
+        session.info["db_time"] += time.perf_counter() - start
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        logger.info(f"DB time {label}: {session.info['db_time']:.3f}s")
+        session.close()
+
+
+def _timed(func: Callable) -> Callable:
+    @wraps(func)
+    def wrapper(*args, session: Session, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, session=session, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            session.info["db_time"] = session.info.get("db_time", 0.0) + elapsed
+
+    return wrapper
+
+
+def _chunked(uuids: Iterable[str]) -> Iterator[tuple[str, ...]]:
+    return batched(uuids, QUERY_CHUNK_SIZE)
+
+
+@_timed
 def out_of_sync_files(
-    file_configs: dict[RemarkableFile, ProcessingConfig], engine: Engine
+    file_configs: dict[RemarkableFile, ProcessingConfig], *, session: Session
 ) -> list[RemarkableFile]:
     logger.info("Fetching files to process from DB")
     files_to_update = [
@@ -27,14 +178,12 @@ def out_of_sync_files(
         file for file, config in file_configs.items() if not config.force_reprocess
     ]
 
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    existing = (
-        session.query(Metadata)
-        .filter(Metadata.uuid.in_([f.uuid for f in files_to_check_sync]))
-        .all()
-    )
-    meta_by_uuid = {meta.uuid: meta for meta in existing}
+    meta_by_uuid = {}
+    for chunk in _chunked([f.uuid for f in files_to_check_sync]):
+        rows = session.query(
+            Metadata.uuid, Metadata.last_modified, Metadata.prompt_hash
+        ).filter(Metadata.uuid.in_(chunk))
+        meta_by_uuid.update({row.uuid: row for row in rows})
     for file in files_to_check_sync:
         if (
             file.uuid not in meta_by_uuid
@@ -46,68 +195,278 @@ def out_of_sync_files(
     return files_to_update
 
 
-def out_of_sync_pages(
+@_timed
+def page_hashes_for_files(
+    files: Iterable[RemarkableFile], *, session: Session
+) -> dict[str, str]:
+    """Hashes of all known pages of the given documents, keyed by page uuid."""
+    hashes = {}
+    for chunk in _chunked([file.uuid for file in files]):
+        rows = session.query(Page.uuid, Page.hash).filter(Page.parent_uuid.in_(chunk))
+        hashes.update({uuid: page_hash for uuid, page_hash in rows})
+    return hashes
+
+
+def pages_needing_update(
     pages: Iterable[RemarkablePage],
     file_configs: dict[RemarkableFile, ProcessingConfig],
-    engine: Engine,
+    db_hashes: dict[str, str],
+    forced_pass: dict[str, str] | None = None,
 ) -> list[RemarkablePage]:
-    logger.info("Fetching pages that need updating from DB")
-    page_ids = [page.uuid for page in pages]
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    db_pages = session.query(Page).filter(Page.uuid.in_(page_ids)).all()
-    to_update = {
+    """Changed pages, and all pages of forced documents not converted in this pass yet."""
+    forced_pass = forced_pass or {}
+    return [
         page
         for page in pages
-        if page.parent in file_configs and file_configs[page.parent].force_reprocess
-    }
-    for page in pages:
-        db_page = next((p for p in db_pages if p.uuid == page.uuid), None)
-        if db_page is None or db_page.hash != page.hash:
-            to_update.add(page)
-    logger.info(f"Got {len(to_update)} out of sync pages from DB")
-    return list(to_update)
+        if (
+            page.parent in file_configs
+            and file_configs[page.parent].force_reprocess
+            and forced_pass.get(page.uuid) != page.hash
+        )
+        or db_hashes.get(page.uuid) != page.hash
+    ]
+
+
+@_timed
+def forced_pass_hashes(
+    files: Iterable[RemarkableFile], *, session: Session
+) -> dict[str, str]:
+    """Hashes of the pages of force-reprocessed documents converted in their current pass.
+
+    A pass over a forced document can take several cycles if it doesn't fit into one
+    cycle's budget, and these pages aren't converted again before it's done.
+    """
+    hashes = {}
+    keys = [FORCED_PASS_KEY.format(file.uuid) for file in files]
+    for chunk in _chunked(keys):
+        rows = session.query(SyncState.value).filter(SyncState.key.in_(chunk))
+        for (value,) in rows:
+            hashes.update(json.loads(value))
+    return hashes
+
+
+@_timed
+def continue_forced_pass(
+    file: RemarkableFile, pages: list[RemarkablePage], *, session: Session
+):
+    """Record pages converted in the current pass over a force-reprocessed document."""
+    key = FORCED_PASS_KEY.format(file.uuid)
+    state = session.get(SyncState, key)
+    hashes = json.loads(state.value) if state is not None else {}
+    hashes.update({page.uuid: page.hash for page in pages})
+    _upsert(session, SyncState, [{"key": key, "value": json.dumps(hashes)}])
 
 
+@_timed
+def end_forced_pass(file: RemarkableFile, *, session: Session):
+    """The document is fully reprocessed, so the next forced pass starts from scratch."""
+    session.query(SyncState).filter(
+        SyncState.key == FORCED_PASS_KEY.format(file.uuid)
+    ).delete()
+
+
+@_timed
 def mark_as_synced(
     saved: dict[RemarkableFile, list[RemarkablePage]],
     file_configs: dict[RemarkableFile, ProcessingConfig],
-    engine: Engine,
+    *,
+    session: Session,
 ):
-    file_uuids = [file.uuid for file in saved.keys()]
-    page_uuids = [page.uuid for pages in saved.values() for page in pages]
+    metadata_rows = [
+        {
+            "uuid": file.uuid,
+            "visible_name": file.name,
+            "last_modified": file.last_modified,
+            "parent_uuid": file.parent_uuid,
+            "type": file.type,
+            "prompt_hash": file_configs[file].prompt_hash,
+            "path": str(file.path),
+        }
+        for file in saved
+    ]
+    page_rows = [
+        {"uuid": page.uuid, "hash": page.hash, "parent_uuid": file.uuid}
+        for file, pages in saved.items()
+        for page in pages
+    ]
 
-    logger.info(f"Updating {len(file_uuids)} files and {len(page_uuids)} pages in DB")
+    logger.info(f"Updating {len(metadata_rows)} files and {len(page_rows)} pages in DB")
     if len(saved) == 0:
         return
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    existing_files = session.query(Metadata).filter(Metadata.uuid.in_(file_uuids)).all()
-    existing_files = {f.uuid: f for f in existing_files}
-    existing_pages = session.query(Page).filter(Page.uuid.in_(page_uuids)).all()
-    existing_pages = {p.uuid: p for p in existing_pages}
-
-    for file, pages in saved.items():
-        if file.uuid in existing_files:
-            metadata = existing_files[file.uuid]
-        else:
-            metadata = Metadata(uuid=file.uuid)
-        metadata.visible_name = file.name
-        metadata.last_modified = file.last_modified
-        metadata.parent_uuid = file.parent_uuid
-        metadata.type = file.type
-        metadata.prompt_hash = file_configs[file].prompt_hash
-        new_pages = []
-        for page in pages:
-            if page.uuid in existing_pages:
-                orm_page = existing_pages[page.uuid]
-                orm_page.hash = page.hash
-            else:
-                new_pages.append(Page(uuid=page.uuid, hash=page.hash))
-        if new_pages:
-            metadata.pages.extend(new_pages)
-        if file.uuid not in existing_files:
-            session.add(metadata)
-    session.commit()
-    session.close()
+    _upsert(session, Metadata, metadata_rows)
+    _upsert(session, Page, page_rows)
+    _delete_removed_pages(saved, session)
+    session.flush()
+
+
+@_timed
+def mark_pages_synced(pages: list[RemarkablePage], *, session: Session):
+    """Record converted pages of a document which can't be marked as synced as a whole yet.
+
+    This way only the remaining pages are converted again on the next attempt.
+    """
+    logger.info(f"Updating {len(pages)} pages in DB")
+    _upsert(
+        session,
+        Page,
+        [
+            {"uuid": page.uuid, "hash": page.hash, "parent_uuid": page.parent.uuid}
+            for page in pages
+        ],
+    )
+
+
+def _delete_removed_pages(
+    saved: dict[RemarkableFile, list[RemarkablePage]], session: Session
+) -> None:
+    """Drop DB pages of the saved documents that no longer exist on the tablet."""
+    current = {page.uuid for pages in saved.values() for page in pages}
+    removed = []
+    for chunk in _chunked([file.uuid for file in saved]):
+        rows = session.query(Page.uuid).filter(Page.parent_uuid.in_(chunk))
+        removed += [uuid for (uuid,) in rows if uuid not in current]
+    for chunk in _chunked(removed):
+        session.query(Page).filter(Page.uuid.in_(chunk)).delete()
+        session.query(PageText).filter(PageText.uuid.in_(chunk)).delete()
+    if removed:
+        logger.info(f"Removed {len(removed)} deleted pages from DB")
+
+
+def gc_due(engine: Engine) -> bool:
+    last_run = _gc_last_run.get(str(engine.url))
+    return last_run is None or time.monotonic() - last_run >= Config.gc_interval
+
+
+@_timed
+def collect_garbage(files: list[RemarkableFile], *, session: Session) -> list[Path]:
+    """Remove documents that were deleted or trashed on the tablet from the DB.
+
+    Returns the paths of documents whose rendered outputs are stale, either because
+    the document is gone or because it has since moved to a different path.
+    """
+    _gc_last_run[str(session.get_bind().url)] = time.monotonic()
+    if not files:
+        logger.warning("No files found on tablet, skipping garbage collection")
+        return []
+    current = {file.uuid: file.path for file in files}
+    current_paths = set(current.values())
+    deleted = []
+    stale_paths = []
+    for uuid, path in session.query(Metadata.uuid, Metadata.path):
+        if uuid not in current:
+            deleted.append(uuid)
+        if path is not None and Path(path) not in current_paths:
+            stale_paths.append(Path(path))
+    for chunk in _chunked(deleted):
+        session.query(Page).filter(Page.parent_uuid.in_(chunk)).delete()
+        session.query(PageText).filter(PageText.parent_uuid.in_(chunk)).delete()
+        session.query(Metadata).filter(Metadata.uuid.in_(chunk)).delete()
+        session.query(SyncState).filter(
+            SyncState.key.in_([FORCED_PASS_KEY.format(uuid) for uuid in chunk])
+        ).delete()
+    logger.info(
+        f"Garbage collected {len(deleted)} documents and {len(stale_paths)} stale outputs"
+    )
+    return stale_paths
+
+
+@_timed
+def index_page_text(
+    file: RemarkableFile, pages: dict[RemarkablePage, str], *, session: Session
+):
+    """Add a document's converted pages to the search index, replacing their old text."""
+    for chunk in _chunked([page.uuid for page in pages]):
+        session.query(PageText).filter(PageText.uuid.in_(chunk)).delete()
+    if pages:
+        session.execute(
+            insert(PageText),
+            [
+                {
+                    "uuid": page.uuid,
+                    "parent_uuid": file.uuid,
+                    "path": str(file.path),
+                    "page_idx": page.page_idx,
+                    "text": md,
+                }
+                for page, md in pages.items()
+            ],
+        )
+    # The document may have been moved since its other pages were indexed
+    session.query(PageText).filter(PageText.parent_uuid == file.uuid).update(
+        {"path": str(file.path)}
+    )
+
+
+@_timed
+def seed_page_text(
+    md_pages: Callable[[], Iterable[tuple[Path, str, int, str]]], *, session: Session
+) -> int:
+    """Index the pages converted before the search index existed, once per DB.
+
+    `md_pages` reads the converted pages from disk, as (document path, page uuid, page
+    index, markdown). Pages that aren't in this DB, e.g. another tablet's, or that are
+    indexed already are skipped. Returns how many pages were indexed.
+    """
+    if session.get(SyncState, PAGE_TEXT_SEEDED_KEY) is not None:
+        return 0
+    parents = dict(session.query(Page.uuid, Page.parent_uuid))
+    paths = dict(session.query(Metadata.uuid, Metadata.path))
+    indexed = {uuid for (uuid,) in session.query(PageText.uuid)}
+    rows = [
+        {
+            "uuid": uuid,
+            "parent_uuid": parents[uuid],
+            # Documents synced before their path was tracked use the markdown's path
+            "path": paths.get(parents[uuid]) or str(doc_path),
+            "page_idx": page_idx,
+            "text": md,
+        }
+        for doc_path, uuid, page_idx, md in md_pages()
+        if uuid in parents and uuid not in indexed
+    ]
+    for chunk in batched(rows, QUERY_CHUNK_SIZE):
+        session.execute(insert(PageText), list(chunk))
+    _upsert(session, SyncState, [{"key": PAGE_TEXT_SEEDED_KEY, "value": "1"}])
+    logger.info(f"Added {len(rows)} previously converted pages to the search index")
+    return len(rows)
+
+
+@_timed
+def search_pages(query: str, limit: int = 20, *, session: Session) -> list[SearchHit]:
+    """Best matches for an FTS5 query, e.g. `meeting notes` or `"exact phrase"`."""
+    rows = session.execute(
+        text(
+            "SELECT page_text.path, page_text.page_idx, page_text.uuid, "
+            "snippet(page_text_fts, 0, '**', '**', '...', 16), page_text_fts.rank "
+            "FROM page_text_fts JOIN page_text ON page_text.id = page_text_fts.rowid "
+            "WHERE page_text_fts MATCH :query ORDER BY page_text_fts.rank LIMIT :limit"
+        ),
+        {"query": query, "limit": limit},
+    )
+    return [SearchHit(*row) for row in rows]
+
+
+@_timed
+def get_sync_state(key: str, *, session: Session) -> str | None:
+    state = session.get(SyncState, key)
+    return state.value if state is not None else None
+
+
+@_timed
+def set_sync_state(key: str, value: str | None, *, session: Session) -> None:
+    _upsert(session, SyncState, [{"key": key, "value": value}])
+
+
+def _upsert(session: Session, model: type[Base], rows: list[dict]) -> None:
+    """Bulk `INSERT ... ON CONFLICT(<primary key>) DO UPDATE` of all given columns."""
+    if not rows:
+        return
+    keys = [column.name for column in model.__table__.primary_key]
+    stmt = insert(model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            column: stmt.excluded[column] for column in rows[0] if column not in keys
+        },
+    )
+    session.execute(stmt, rows)
@@ -6,49 +6,45 @@ from google.genai import types
 from loguru import logger
 from pydantic import BaseModel
 from ratelimit import limits, sleep_and_retry
-from tqdm import tqdm
 
 from .config import Config
 from .file_processing_config import ProcessingConfig
-from .models import RemarkableFile, RemarkablePage
+from .models import RemarkablePage
+from .scheduler import CycleBudget
+
+# Model API quota shared by all conversions in this process
+API_CALLS_PER_MINUTE = 60
 
 
 class MDContentSchema(BaseModel):
     markdown: str
 
 
-def pages_to_md(
-    pages: list[RemarkablePage], file_configs: dict[RemarkableFile, ProcessingConfig]
-) -> tuple[dict[RemarkablePage, str], set[RemarkablePage]]:
-    rendered = {}
-    failed: set[RemarkablePage] = set()
-    for page in tqdm(pages, f"Converting {len(pages)} to markdown"):
-        if file_configs[page.parent].pdf_only:
-            continue
-        prompt = file_configs[page.parent].prompt
-        if not prompt:
-            logger.warning(
-                f"Page {page.page_idx} for file {page.parent.name} has no prompt!"
-            )
-            continue
-        md = _pdf2md(page.pdf_data, prompt=prompt)
-        if md:
-            rendered[page] = md
-        else:
-            failed.add(page)
-    for page in failed:
+def needs_conversion(page: RemarkablePage, config: ProcessingConfig) -> bool:
+    if config.pdf_only:
+        return False
+    if not config.prompt:
+        logger.warning(
+            f"Page {page.page_idx} for file {page.parent.name} has no prompt!"
+        )
+        return False
+    return True
+
+
+def page_to_md(
+    page: RemarkablePage, config: ProcessingConfig, budget: CycleBudget | None = None
+) -> str | None:
+    md = _pdf2md(page.pdf_data, prompt=config.prompt, budget=budget)
+    if not md:
         logger.error(
             f"Failed to convert page {page.page_idx} of file {page.parent.name} to markdown."
         )
-    logger.info(
-        f"Converted {len(rendered)} to markdown, failed to convert {len(failed)}"
-    )
-    return rendered, failed
+    return md
 
 
 @sleep_and_retry
 @on_exception(expo, google_exceptions.ResourceExhausted, max_tries=3)
-@limits(calls=60, period=60)
+@limits(calls=API_CALLS_PER_MINUTE, period=60)
 def _call_api_rate_limited(
     client: genai.Client, model_name: str, prompt: str, pdf_data: bytes
 ):
@@ -69,10 +65,24 @@ def _call_api_rate_limited(
         raise e
 
 
-def _pdf2md(pdf_data: bytes, prompt: str) -> str | None:
+def pdf_to_md(pdf_data: bytes, prompt: str, model: str) -> str | None:
+    """Convert a page queued by another process with the `model` it chose, and only
+    that model, as the result is stored under it. The queue falls back to the backup
+    model itself, see `job_queue.convert`."""
+    return _pdf2md(pdf_data, prompt, models=[model])
+
+
+def _pdf2md(
+    pdf_data: bytes,
+    prompt: str,
+    budget: CycleBudget | None = None,
+    models: list[str] | None = None,
+) -> str | None:
     client = genai.Client(api_key=Config.google_api_key)
     exception = None
-    for model_name in [Config.model, Config.backup_model]:
+    for model_name in models or [Config.model, Config.backup_model]:
+        if budget is not None and not budget.spend_api_call():
+            return None
         try:
             return _call_api_rate_limited(client, model_name, prompt, pdf_data)
         except Exception as e:
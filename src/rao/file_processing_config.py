@@ -1,6 +1,10 @@
+import threading
+from collections.abc import Callable, Iterable
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
 from hashlib import sha256
+from io import BytesIO
 from pathlib import Path
 
 import pandas as pd
@@ -15,12 +19,20 @@ class ProcessingConfig:
     pdf_only: bool
     force_reprocess: bool
     prompt: str | None
+    priority: int = 0
+    # Path of the whitelist rule forcing a reprocess `once`, cleared once it's done
+    reprocess_once_rule: str | None = None
 
     @property
     def prompt_hash(self) -> str | None:
         if self.prompt is None:
             return None
-        return sha256(self.prompt.encode("utf-8")).hexdigest()
+        return _hash_prompt(self.prompt)
+
+
+@lru_cache(maxsize=256)
+def _hash_prompt(prompt: str) -> str:
+    return sha256(prompt.encode("utf-8")).hexdigest()
 
 
 class ReprocessValues(Enum):
@@ -28,26 +40,138 @@ class ReprocessValues(Enum):
     ALWAYS = "always"
 
 
-def _load_filters() -> tuple[pd.DataFrame | None, pd.DataFrame | None]:
+@dataclass
+class _CachedFile[T]:
+    stamp: tuple[int, int]  # (mtime in ns, size)
+    content_hash: str
+    value: T
+
+
+@dataclass
+class _Rules:
+    df: pd.DataFrame
+    trie: "PathTrie"
+
+
+# Parsed input files, only reloaded when they change on disk
+_file_cache: dict[Path, _CachedFile] = {}
+# The whitelist is shared by all tablets, whose threads may clear rules at once
+_whitelist_lock = threading.Lock()
+
+
+def _file_stamp(path: Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _load_cached[T](path: Path, parse: Callable[[bytes], T]) -> T | None:
+    if not path.exists():
+        _file_cache.pop(path, None)
+        return None
+    stamp = _file_stamp(path)
+    cached = _file_cache.get(path)
+    if cached is not None and cached.stamp == stamp:
+        return cached.value
+    data = path.read_bytes()
+    content_hash = sha256(data).hexdigest()
+    if cached is not None and cached.content_hash == content_hash:
+        cached.stamp = stamp  # Touched, but not changed
+        return cached.value
+    logger.info(f"Loading {path}")
+    value = parse(data)
+    _file_cache[path] = _CachedFile(stamp=stamp, content_hash=content_hash, value=value)
+    return value
+
+
+def _parse_rules(data: bytes) -> _Rules:
+    df = pd.read_csv(BytesIO(data))
+    return _Rules(df=df, trie=_compile_rules(df))
+
+
+def _load_filters() -> tuple[_Rules | None, _Rules | None]:
     whitelist = blacklist = None
-    if Path(Config.whitelist_path).exists():
-        whitelist = pd.read_csv(Config.whitelist_path)
-    if Path(Config.blacklist_path).exists():
-        blacklist = pd.read_csv(Config.blacklist_path)
+    if Config.whitelist_path:
+        whitelist = _load_cached(Path(Config.whitelist_path), _parse_rules)
+    if Config.blacklist_path:
+        blacklist = _load_cached(Path(Config.blacklist_path), _parse_rules)
     return whitelist, blacklist
 
 
-def _get_matches_in_dataframe(file: RemarkableFile, df: pd.DataFrame) -> pd.DataFrame:
-    return df[df.path.apply(lambda path: str(file.path).startswith(path))]
+def _save_whitelist(whitelist: pd.DataFrame):
+    """Atomically rewrite the whitelist, keeping the cache in sync with it."""
+    path = Path(Config.whitelist_path)
+    data = whitelist.to_csv(index=False).encode("utf-8")
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+    _file_cache[path] = _CachedFile(
+        stamp=_file_stamp(path),
+        content_hash=sha256(data).hexdigest(),
+        value=_Rules(df=whitelist, trie=_compile_rules(whitelist)),
+    )
+
+
+class PathTrie[T]:
+    """Rules keyed by path, looked up by longest prefix on whole path components.
+
+    I.e. a rule for `A/Work` applies to `A/Work` and `A/Work/notes`, but not to
+    `A/Workshop`. Lookups are memoised per path.
+    """
+
+    __slots__ = ("_root", "_cache")
+
+    def __init__(self, rules: Iterable[tuple[str, T]] = ()):
+        self._root = _TrieNode()
+        self._cache: dict[Path, T | None] = {}
+        for path, value in rules:
+            self.insert(path, value)
+
+    def insert(self, path: str, value: T):
+        node = self._root
+        for part in Path(path).parts:
+            node = node.children.setdefault(part, _TrieNode())
+        if not node.has_value:  # The first of several rules for the same path wins
+            node.value = value
+            node.has_value = True
+        self._cache.clear()
+
+    def longest_prefix(self, path: Path) -> T | None:
+        if path not in self._cache:
+            node = self._root
+            match = node.value
+            for part in path.parts:
+                node = node.children.get(part)
+                if node is None:
+                    break
+                if node.has_value:
+                    match = node.value
+            self._cache[path] = match
+        return self._cache[path]
+
+
+class _TrieNode:
+    __slots__ = ("children", "value", "has_value")
+
+    def __init__(self):
+        self.children: dict[str, _TrieNode] = {}
+        self.value = None
+        self.has_value = False
+
+
+def _compile_rules(df: pd.DataFrame) -> PathTrie:
+    return PathTrie(
+        (str(rule.path), rule)
+        for rule in df.itertuples(index=False)
+        if not pd.isna(rule.path)
+    )
 
 
 def _get_processing_config_for_file(
-    file: RemarkableFile, whitelist: pd.DataFrame, prompts: dict[str, str]
+    file: RemarkableFile, whitelist: PathTrie, prompts: dict[str, str]
 ) -> ProcessingConfig | None:
-    matches = _get_matches_in_dataframe(file, whitelist)
-    if len(matches) == 0:
+    most_specific = whitelist.longest_prefix(file.path)
+    if most_specific is None:
         return None
-    most_specific = matches.iloc[matches.path.str.len().argmax()]
     prompt = Config.default_prompt
     if most_specific.prompt_path and not pd.isna(most_specific.prompt_path):
         if most_specific.prompt_path not in prompts:
@@ -57,9 +181,11 @@ def _get_processing_config_for_file(
             return None
         prompt = prompts[most_specific.prompt_path]
     force_reprocess = False
+    reprocess_once_rule = None
     if not pd.isna(most_specific.force_reprocess):
         reprocess_values = [e.value for e in ReprocessValues]
-        if str(most_specific.force_reprocess).lower() not in reprocess_values:
+        reprocess_value = str(most_specific.force_reprocess).lower()
+        if reprocess_value not in reprocess_values:
             logger.error(
                 f"Trying to force reprocessing of {file.path},\n"
                 f"but incorrect reprocessing config given: {most_specific.force_reprocess}\n"
@@ -68,10 +194,15 @@ def _get_processing_config_for_file(
             )
             return None
         force_reprocess = True
+        if reprocess_value == ReprocessValues.ONCE.value:
+            reprocess_once_rule = str(most_specific.path)
+    priority = getattr(most_specific, "priority", None)
     return ProcessingConfig(
         pdf_only=bool(most_specific.pdf_only),
         prompt=prompt,
         force_reprocess=force_reprocess,
+        priority=0 if priority is None or pd.isna(priority) else int(priority),
+        reprocess_once_rule=reprocess_once_rule,
     )
 
 
@@ -79,40 +210,81 @@ def _load_prompts() -> dict[str, str]:
     prompts = {}
     prompts_dir = Path(Config.prompts_dir)
     if prompts_dir.exists():
-        for path in Path(Config.prompts_dir).rglob("*.txt"):
-            prompts[str(path.relative_to(prompts_dir))] = path.read_text()
+        for path in prompts_dir.rglob("*.txt"):
+            prompt = _load_cached(path, lambda data: data.decode("utf-8"))
+            if prompt is not None:
+                prompts[str(path.relative_to(prompts_dir))] = prompt
     return prompts
 
 
+def inputs_fingerprint() -> str:
+    """Cheap hash over the local inputs that decide which files get processed and how."""
+    digest = sha256(Config.default_prompt.encode("utf-8"))
+    paths = [Path(p) for p in [Config.whitelist_path, Config.blacklist_path] if p]
+    prompts_dir = Path(Config.prompts_dir)
+    if prompts_dir.exists():
+        paths += sorted(prompts_dir.rglob("*.txt"))
+    for path in paths:
+        stat = path.stat() if path.exists() else None
+        state = f"{stat.st_size}\0{stat.st_mtime_ns}" if stat else "missing"
+        digest.update(f"{path}\0{state}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
 def get_configs_for_files(
     files: list[RemarkableFile],
 ) -> dict[RemarkableFile, ProcessingConfig]:
     whitelist, blacklist = _load_filters()
+    whitelist_rules = whitelist.trie if whitelist is not None else None
+    blacklist_rules = blacklist.trie if blacklist is not None else None
     prompts = _load_prompts()
     configs = {}
     for file in files:
-        if whitelist is not None:
-            config = _get_processing_config_for_file(file, whitelist, prompts)
+        if whitelist_rules is not None:
+            config = _get_processing_config_for_file(file, whitelist_rules, prompts)
         else:
             config = ProcessingConfig(
                 pdf_only=False, prompt=Config.default_prompt, force_reprocess=False
             )
         if (
-            blacklist is not None
-            and len(_get_matches_in_dataframe(file, blacklist)) > 0
+            blacklist_rules is not None
+            and blacklist_rules.longest_prefix(file.path) is not None
         ):
             config = None
         if config is not None:
             configs[file] = config
-    if whitelist is not None:
-        whitelist = _update_reprocess_values(whitelist)
-        whitelist.to_csv(Path(Config.whitelist_path), index=False)
     return configs
 
 
-def _update_reprocess_values(df: pd.DataFrame) -> pd.DataFrame:
-    df.loc[
-        df.force_reprocess.astype(str).str.lower() == ReprocessValues.ONCE.value,
-        "force_reprocess",
-    ] = pd.NA
-    return df
+def consume_reprocess_once(
+    file_configs: dict[RemarkableFile, ProcessingConfig],
+    done: set[RemarkableFile],
+):
+    """Clear the `once` rules whose documents have all been reprocessed.
+
+    Rules with documents that were deferred or failed stay, so those are forced again
+    on the next cycle.
+    """
+    rules = {config.reprocess_once_rule for config in file_configs.values()}
+    pending = {
+        config.reprocess_once_rule
+        for file, config in file_configs.items()
+        if file not in done
+    }
+    finished = rules - pending - {None}
+    if not finished or not Config.whitelist_path:
+        return
+    with _whitelist_lock:
+        whitelist = _load_cached(Path(Config.whitelist_path), _parse_rules)
+        if whitelist is None:
+            return
+        df = whitelist.df.copy()
+        once = (
+            df.force_reprocess.astype(str).str.lower() == ReprocessValues.ONCE.value
+        ) & (df.path.astype(str).isin(finished))
+        if once.any():
+            logger.info(
+                f"Reprocessed {', '.join(sorted(finished))} once, clearing rules"
+            )
+            df.loc[once, "force_reprocess"] = pd.NA
+            _save_whitelist(df)
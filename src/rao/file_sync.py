@@ -1,73 +1,209 @@
+import json
+import queue
 import re
 import shutil
+import sqlite3
 import subprocess
+import threading
+import time
 from collections import defaultdict
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import closing, nullcontext
+from dataclasses import dataclass
+from hashlib import sha256
 from io import BytesIO
 from pathlib import Path
+from typing import BinaryIO
 from urllib.request import pathname2url
 
 from loguru import logger
-from pypdf import PdfWriter
+from pypdf import PdfReader, PdfWriter
 
 from .config import DB_CACHE_PATH, Config
+from .metrics import Metrics
 from .models import RemarkableFile, RemarkablePage
 
-PAGE_SEPARATOR = re.compile(r"^## Page \d+ - \[[0-9a-f\-]+\]$")
+PAGE_SEPARATOR = re.compile(r"^## Page (\d+) - \[([0-9a-f\-]+)\]$")
 
+# Backoff after a failed commit or push to the markdown repo, doubled with every failure
+SUBREPO_RETRY_SECONDS = 60
+SUBREPO_MAX_RETRY_SECONDS = 3600
 
-def save(
+# Page number -> (page uuid, start, end) byte offsets of the page in a markdown file
+MdIndex = dict[int, tuple[str, int, int]]
+
+
+def save_to_disk(
     all_pages: list[RemarkablePage],
     rendered_pages: dict[RemarkablePage, str],
-) -> dict[RemarkableFile, list[RemarkablePage]]:
+) -> tuple[dict[RemarkableFile, list[RemarkablePage]], list[Path]]:
     _save_mds_to_disk(rendered_pages)
-    saved_pdf_files, saved_paths = _save_pdfs_to_disk(all_pages)
-    _sync_with_subrepo()
-    _copy_rendered_pdfs_to_external_folder(saved_paths)
-    return saved_pdf_files
+    return _save_pdfs_to_disk(all_pages)
+
 
+def publish(saved_paths: list[Path], md_paths: list[Path]):
+    """Push saved files to the markdown repo and external PDF folder, if configured."""
+    subrepo.submit(md_paths)
+    pdf_copier.submit(saved_paths)
 
-def _split_md_into_pages(md: str) -> dict[int, list[str]]:
-    pages: dict[int, list[str]] = {}
-    current_page = None
-    current_page_lines: list[str] = []
+
+def _render_md_page(page_number: int, page: RemarkablePage, md: str) -> str:
+    lines = [f"## Page {page_number} - [{page.uuid}]\n"]
     for line in md.split("\n"):
-        page_separators = re.findall(PAGE_SEPARATOR, line)
-        if len(page_separators) > 1:
-            raise ValueError("Multiple page separators found in line.")
-        if len(page_separators) > 0:
-            if current_page is not None:
-                pages[current_page] = current_page_lines
-            page_sep = page_separators[0]
-            page_num = int(page_sep.split(" - ")[0].split("## Page ")[1])
-            current_page = page_num
-            current_page_lines = []
-        current_page_lines.append(line)
-    if current_page is not None:
-        pages[current_page] = current_page_lines
-    return pages
+        if line.startswith("#"):
+            line = "##" + line
+        lines.append(line)
+    lines.append("\n")
+    return "\n".join(lines)
+
+
+def _index_md(data: bytes) -> MdIndex:
+    """Locate the pages of an existing markdown file by scanning it for page separators."""
+    index: MdIndex = {}
+    current = None
+    offset = 0
+    for line in data.split(b"\n"):
+        if line.startswith(b"## Page ") and (
+            match := PAGE_SEPARATOR.fullmatch(line.decode("utf-8", "replace"))
+        ):
+            if current is not None:
+                index[current[0]] = (current[1], current[2], offset - 1)
+            current = (int(match[1]), match[2], offset)
+        offset += len(line) + 1
+    if current is not None:
+        index[current[0]] = (current[1], current[2], len(data))
+    return index
+
+
+def _write_md(
+    out: BinaryIO,
+    file_name: str,
+    pages: dict[RemarkablePage, str],
+    existing: BinaryIO | None,
+    index: MdIndex,
+) -> MdIndex:
+    """Write a document's markdown, splicing the converted `pages` in between the
+    unchanged pages of the `existing` file, which are copied over by their `index`.
+    Returns the index of the new file.
+    """
+    new_pages = {page.page_idx + 1: page for page in pages}
+    new_index: MdIndex = {}
+    offset = out.write(f"# {file_name}\n".encode())
+    for page_number in sorted(index.keys() | new_pages.keys()):
+        offset += out.write(b"\n")
+        if page_number in new_pages:
+            page = new_pages[page_number]
+            uuid = page.uuid
+            block = _render_md_page(page_number, page, pages[page]).encode()
+        else:
+            uuid, start, end = index[page_number]
+            existing.seek(start)
+            block = existing.read(end - start)
+        new_index[page_number] = (uuid, offset, offset + len(block))
+        offset += out.write(block)
+    return new_index
 
 
 def _combine_md_pages(
     file_name: str, pages: dict[RemarkablePage, str], existing_md: str | None
 ) -> str:
-    existing_pages = _split_md_into_pages(existing_md) if existing_md else {}
-    new_pages = {p.page_idx + 1: p for p in pages.keys()}
-    all_page_numbers = set(existing_pages.keys()) | set(new_pages.keys())
-
-    lines = [f"# {file_name}\n"]
-    for page_idx in sorted(all_page_numbers):
-        if page_idx in new_pages:
-            page = new_pages[page_idx]
-            lines.append(f"## Page {page_idx} - [{page.uuid}]\n")
-            for line in pages[page].split("\n"):
-                if line.startswith("#"):
-                    line = "##" + line
-                lines.append(line)
-            lines.append("\n")
-            continue
-        if page_idx in existing_pages:
-            lines += existing_pages[page_idx]
-    return "\n".join(lines)
+    existing = (existing_md or "").encode()
+    out = BytesIO()
+    _write_md(out, file_name, pages, BytesIO(existing), _index_md(existing))
+    return out.getvalue().decode()
+
+
+def _load_md_index(md_path: Path, index_path: Path) -> MdIndex:
+    if not md_path.exists():
+        return {}
+    stat = md_path.stat()
+    try:
+        data = json.loads(index_path.read_text())
+        if data["size"] == stat.st_size and data["mtime_ns"] == stat.st_mtime_ns:
+            return {
+                int(number): tuple(entry) for number, entry in data["pages"].items()
+            }
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    logger.debug(f"No valid page index for {md_path}, scanning it")
+    return _index_md(md_path.read_bytes())
+
+
+def _save_md_index(md_path: Path, index_path: Path, index: MdIndex):
+    stat = md_path.stat()
+    data = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "pages": index}
+    tmp_path = index_path.with_name(index_path.name + ".tmp")
+    tmp_path.write_text(json.dumps(data))
+    tmp_path.replace(index_path)
+
+
+def _update_md_file(
+    md_path: Path, index_path: Path, pages: dict[RemarkablePage, str]
+) -> None:
+    """Splice converted pages into a document's markdown file, atomically.
+
+    The byte range of every page is kept in a sidecar index, so unchanged pages are
+    copied over without parsing the file. The new file is written next to the index
+    (on the same filesystem, but outside the markdown tree that gets published) and
+    renamed into place.
+    """
+    index_path.parent.mkdir(exist_ok=True, parents=True)
+    index = _load_md_index(md_path, index_path)
+    tmp_path = index_path.with_name(index_path.name + ".md.tmp")
+    try:
+        with (
+            tmp_path.open("wb") as out,
+            md_path.open("rb") if index else nullcontext() as existing,
+        ):
+            new_index = _write_md(out, md_path.stem, pages, existing, index)
+        tmp_path.replace(md_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    _save_md_index(md_path, index_path, new_index)
+
+
+def _rendered_path(base_dir: Path, doc_path: Path, suffix: str) -> Path:
+    doc_path = base_dir / doc_path
+    return doc_path.parent / f"{doc_path.stem}{suffix}"
+
+
+def rendered_md_path(file: RemarkableFile) -> Path:
+    return _rendered_path(Path(Config.render_path) / "md", file.path, ".md")
+
+
+def rendered_md_pages() -> Iterator[tuple[Path, str, int, str]]:
+    """Every converted page in `render_path/md`, as (document path, page uuid, page
+    index, markdown), e.g. to index pages converted before the search index existed."""
+    md_dir = Path(Config.render_path) / "md"
+    index_dir = Path(Config.render_path) / "md_index"
+    for md_path in sorted(md_dir.rglob("*.md")):
+        doc_path = md_path.relative_to(md_dir).with_suffix("")
+        index = _load_md_index(md_path, _rendered_path(index_dir, doc_path, ".json"))
+        data = md_path.read_bytes()
+        for page_number, (uuid, start, end) in sorted(index.items()):
+            # Without the page separator, and undoing `_render_md_page`'s heading shift
+            lines = data[start:end].decode(errors="replace").split("\n")[1:]
+            md = "\n".join(
+                line[2:] if line.startswith("###") else line for line in lines
+            )
+            yield doc_path, uuid, page_number - 1, md.strip()
+
+
+def remove_rendered_files(doc_paths: list[Path]):
+    render_path = Path(Config.render_path)
+    removed = 0
+    for doc_path in doc_paths:
+        for base_dir, suffix in [
+            (render_path / "md", ".md"),
+            (render_path / "md_index", ".json"),
+            (render_path / "pdf", ".pdf"),
+            (render_path / "pdf_index", ".json"),
+        ]:
+            target_path = _rendered_path(base_dir, doc_path, suffix)
+            if target_path.exists():
+                target_path.unlink()
+                removed += 1
+    logger.info(f"Removed {removed} stale rendered files")
 
 
 def _save_mds_to_disk(
@@ -85,16 +221,11 @@ def _save_mds_to_disk(
         f"Updating {len(md_files)} rendered markdown pages on disk in {len(pages_per_file)} documents"
     )
 
+    index_dir = Path(Config.render_path) / "md_index"
     for parent, pages in pages_per_file.items():
-        parent_path = base_dir / parent.path
-        target_dir = parent_path.parent
-        target_dir.mkdir(exist_ok=True, parents=True)
-        file_name = parent_path.stem
-        md_path = target_dir / f"{file_name}.md"
-        existing = md_path.read_text() if md_path.exists() else None
-        md_combined = _combine_md_pages(file_name, pages, existing)
-        with open(md_path, "w") as f:
-            f.write(md_combined)
+        md_path = _rendered_path(base_dir, parent.path, ".md")
+        md_path.parent.mkdir(exist_ok=True, parents=True)
+        _update_md_file(md_path, _rendered_path(index_dir, parent.path, ".json"), pages)
         saved[parent] = pages
     return saved
 
@@ -115,137 +246,589 @@ def _save_pdfs_to_disk(
         f"Updating {len(pages)} rendered PDF pages on disk in {len(pages_per_file)} documents"
     )
 
+    index_dir = Path(Config.render_path) / "pdf_index"
     for parent, pages in pages_per_file.items():
-        parent_path = base_dir / parent.path
-        target_dir = parent_path.parent
-        target_dir.mkdir(exist_ok=True, parents=True)
-        file_name = parent_path.stem
-        target_path = target_dir / f"{file_name}.pdf"
-        _save_combined_pdf(target_path, pages)
+        target_path = _rendered_path(base_dir, parent.path, ".pdf")
+        target_path.parent.mkdir(exist_ok=True, parents=True)
+        _save_combined_pdf(
+            target_path, _rendered_path(index_dir, parent.path, ".json"), pages
+        )
         saved[parent] = pages
         file_paths.append(target_path)
     return saved, file_paths
 
 
-def _save_combined_pdf(pdf_path: Path, pages: list[RemarkablePage]) -> None:
-    writer = PdfWriter()
-    for page in sorted(pages, key=lambda p: p.page_idx):
-        writer.append(BytesIO(page.pdf_data))
-    writer.write(pdf_path)
-    writer.close()
-
+def _load_pdf_index(pdf_path: Path, index_path: Path) -> dict | None:
+    if not pdf_path.exists():
+        return None
+    stat = pdf_path.stat()
+    try:
+        index = json.loads(index_path.read_text())
+    except (OSError, ValueError):
+        return None
+    if index.get("size") != stat.st_size or index.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+    return index
+
+
+def _save_combined_pdf(
+    pdf_path: Path, index_path: Path, pages: list[RemarkablePage]
+) -> None:
+    """Write a document's PDF, atomically.
+
+    A sidecar index records the uuid and hash of every page in the file. If only the
+    content of some pages changed, just those page objects are replaced, appended to
+    the existing file as a PDF incremental update. The file is rebuilt from scratch
+    when pages were added, removed, or reordered, or when it has an incremental update
+    already, as pypdf can't stack another one on top of it without corrupting the file.
+    """
+    pages = sorted(pages, key=lambda p: p.page_idx)
+    index_path.parent.mkdir(exist_ok=True, parents=True)
+    index = _load_pdf_index(pdf_path, index_path)
+    incremental = (
+        index is not None
+        and [uuid for uuid, _ in index["pages"]] == [page.uuid for page in pages]
+        and index["size"] == index["base_size"]
+    )
+    if incremental:
+        changed = [
+            (i, page)
+            for i, (page, (_, page_hash)) in enumerate(zip(pages, index["pages"]))
+            if page.hash != page_hash
+        ]
+        if not changed:
+            return
+        writer = PdfWriter(PdfReader(pdf_path), incremental=True)
+        for i, page in changed:
+            writer.insert_page(PdfReader(BytesIO(page.pdf_data)).pages[0], i)
+            writer.remove_page(i + 1)
+        Metrics.increment("pdf_incremental_updates")
+    else:
+        writer = PdfWriter()
+        for page in pages:
+            writer.append(BytesIO(page.pdf_data))
+        Metrics.increment("pdf_full_rebuilds")
 
-def _sync_with_subrepo():
-    if not Config.md_repo_path:
-        return
-    logger.info("Syncing markdown files with subrepo ...")
+    tmp_path = index_path.with_name(index_path.name + ".pdf.tmp")
+    try:
+        with tmp_path.open("wb") as f:
+            writer.write(f)
+        writer.close()
+        tmp_path.replace(pdf_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    stat = pdf_path.stat()
+    new_index = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "base_size": index["base_size"] if incremental else stat.st_size,
+        "pages": [[page.uuid, page.hash] for page in pages],
+    }
+    tmp_index_path = index_path.with_name(index_path.name + ".tmp")
+    tmp_index_path.write_text(json.dumps(new_index))
+    tmp_index_path.replace(index_path)
+
+
+def _copy_to_subrepo(md_paths: list[Path]) -> list[Path]:
+    """Copy markdown files into the repo's `documents` dir. Returns their paths in the repo."""
     base_dir = Path(Config.render_path) / "md"
-    if not Path(Config.md_repo_path).exists():
+    repo_path = Path(Config.md_repo_path)
+    if not repo_path.exists():
         logger.error("Repo to save markdown files to does not exist! Aborting ...")
-        return
-    shutil.copytree(
-        base_dir, Path(Config.md_repo_path) / "documents", dirs_exist_ok=True
-    )
-    _save_markdown_repo_readme_file()
-    try:
-        subprocess.run(
-            ["git", "add", "."],
-            cwd=Config.md_repo_path,
-            check=True,
-            capture_output=True,
-        )
-        subprocess.run(
-            ["git", "commit", "-m", "Update files"],
-            cwd=Config.md_repo_path,
-            check=True,
-            capture_output=True,
-        )
-        subprocess.run(
-            ["git", "push"], cwd=Config.md_repo_path, check=True, capture_output=True
-        )
-    except subprocess.CalledProcessError as e:
-        if e.stdout is not None and "nothing to commit" in e.stdout.decode("utf-8"):
+        return []
+    copied = []
+    for path in md_paths:
+        target_path = repo_path / "documents" / path.relative_to(base_dir)
+        target_path.parent.mkdir(exist_ok=True, parents=True)
+        shutil.copyfile(path, target_path)
+        copied.append(target_path.relative_to(repo_path))
+    return copied
+
+
+class SubrepoPublisher:
+    """Commits and pushes the markdown files copied to the repo in a background thread.
+
+    Changes from several cycles are coalesced into one commit. It's pushed once
+    `md_repo_push_interval` seconds have passed since the last push, or as soon as
+    `md_repo_push_files` files are pending. Failed attempts are retried with exponential
+    backoff, so a slow or unreachable remote never holds up syncing.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._pending: set[Path] = set()
+        self._unpushed = False
+        # Every file in the repo's `documents` dir, to list them in the README
+        self._documents: set[Path] | None = None
+        self._last_publish: float | None = None
+        self._retry_at = 0.0
+        self._failures = 0
+        self._condition = threading.Condition()
+        self._publish_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def submit(self, md_paths: list[Path]):
+        if not Config.md_repo_path or not md_paths:
             return
-        logger.error(
-            f"Unable to sync files with with subrepo: {e}. stdout={e.stdout}. stderr={e.stderr}"
+        # Copying is cheap, and leaves nothing to lose if the process stops before the commit
+        copied = _copy_to_subrepo(md_paths)
+        with self._condition:
+            self._pending.update(copied)
+            Metrics.set("md_repo_pending_files", len(self._pending))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="md-repo", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify_all()
+
+    def flush(self) -> bool:
+        """Commit and push everything pending right away. Returns whether it succeeded."""
+        with self._condition:
+            if not self._pending and not self._unpushed:
+                return True
+        return self._publish()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while (delay := self._delay()) != 0:
+                    self._condition.wait(delay)
+            self._publish()
+
+    def _delay(self) -> float | None:
+        """Seconds until the pending changes are due, or None if there aren't any."""
+        if not self._pending and not self._unpushed:
+            return None
+        due = self._retry_at
+        if self._last_publish is not None and (
+            len(self._pending) < Config.md_repo_push_files
+        ):
+            due = max(due, self._last_publish + Config.md_repo_push_interval)
+        return max(due - self._clock(), 0)
+
+    def _publish(self) -> bool:
+        with self._publish_lock:
+            with self._condition:
+                batch, self._pending = self._pending, set()
+            try:
+                if batch:
+                    self._commit(batch)
+                if self._unpushed:
+                    _git("push")
+                    self._unpushed = False
+                    Metrics.increment("md_repo_pushes")
+            except subprocess.CalledProcessError as e:
+                logger.error(
+                    f"Unable to sync files with with subrepo: {e}. stdout={e.stdout}. stderr={e.stderr}"
+                )
+                self._failed(batch)
+                return False
+            except Exception as e:
+                # E.g. the README can't be written, or git is missing: retry all the same
+                logger.error(f"Unable to sync files with subrepo: {e!r}")
+                self._failed(batch)
+                return False
+            with self._condition:
+                self._failures = 0
+                self._retry_at = 0.0
+                self._last_publish = self._clock()
+                Metrics.set("md_repo_pending_files", len(self._pending))
+            return True
+
+    def _commit(self, batch: set[Path]):
+        logger.info(f"Committing {len(batch)} markdown files to subrepo ...")
+        paths = list(batch)
+        if self._documents is None:
+            self._documents = _scan_documents()
+            # Pick up files a previous run copied, but was stopped before committing
+            paths.append(Path("documents"))
+        self._documents |= batch
+        # Always staged, in case an earlier attempt updated it but failed to commit
+        paths.append(_save_markdown_repo_readme_file(self._documents))
+        _git(
+            "add",
+            "--pathspec-from-file=-",
+            "--pathspec-file-nul",
+            input="\0".join(str(path) for path in paths),
         )
+        if _commit_index(_commit_message(batch)):
+            self._unpushed = True
+            Metrics.increment("md_repo_commits")
+
+    def _failed(self, batch: set[Path]):
+        with self._condition:
+            self._pending |= batch
+            self._failures += 1
+            backoff = min(
+                SUBREPO_RETRY_SECONDS * 2 ** (self._failures - 1),
+                SUBREPO_MAX_RETRY_SECONDS,
+            )
+            self._retry_at = self._clock() + backoff
+        logger.info(f"Retrying subrepo sync in {backoff} seconds")
+        Metrics.increment("md_repo_failures")
+
+
+subrepo = SubrepoPublisher()
+
+
+def _git(*args: str, input: str | None = None) -> str:
+    result = subprocess.run(
+        ["git", *args],
+        cwd=Config.md_repo_path,
+        check=True,
+        capture_output=True,
+        text=True,
+        input=input,
+    )
+    return result.stdout.strip()
+
 
+def _commit_message(changed: set[Path]) -> str:
+    documents = sorted(
+        str(path.relative_to("documents").with_suffix("")) for path in changed
+    )
+    return f"Update {len(documents)} documents\n\n" + "\n".join(
+        f"- {document}" for document in documents
+    )
 
-def _save_markdown_repo_readme_file():
+
+def _commit_index(message: str) -> bool:
+    """Commit the staged changes, if there are any. Returns whether a commit was made."""
+    tree = _git("write-tree")
+    try:
+        parent = _git("rev-parse", "--verify", "--quiet", "HEAD")
+    except subprocess.CalledProcessError:
+        parent = None  # No commits yet
+    if parent is not None and _git("rev-parse", f"{parent}^{{tree}}") == tree:
+        return False
+    parents = [parent] if parent else []
+    commit = _git("commit-tree", tree, *[f"-p{p}" for p in parents], input=message)
+    # Passing the old value makes this fail if HEAD was moved in the meantime
+    _git("update-ref", "HEAD", commit, *parents)
+    return True
+
+
+def _scan_documents() -> set[Path]:
+    repo_path = Path(Config.md_repo_path)
+    return {
+        path.relative_to(repo_path)
+        for path in (repo_path / "documents").rglob("*")
+        if path.is_file()
+    }
+
+
+def _save_markdown_repo_readme_file(documents: Iterable[Path]) -> Path:
+    """Update the README's list of documents, if it changed. Returns its path."""
     readme_path = [
         p for p in Path(Config.md_repo_path).glob("*.md") if p.stem.lower() == "readme"
     ]
     DOCS_HEADER = "\n\n## Documents\n\n"
     if not readme_path:
         readme_path = Path(Config.md_repo_path) / "README.md"
+        existing = None
         readme = "# Markdown Documents from Remarkable"
     else:
         readme_path = readme_path[0]
-        readme = readme_path.read_text()
-        readme = readme.split(DOCS_HEADER)[0]
+        existing = readme_path.read_text()
+        readme = existing.split(DOCS_HEADER)[0]
 
-    doc_tree = "\n".join(
-        _dir_to_md_tree(
-            Path(Config.md_repo_path), Path(Config.md_repo_path) / "documents"
-        )
-    )
+    doc_tree = "\n".join(_md_tree(documents, Path("documents")))
     combined = f"{readme}{DOCS_HEADER}{doc_tree}"
-    readme_path.write_text(combined)
+    if combined != existing:
+        readme_path.write_text(combined)
+    return readme_path.relative_to(Config.md_repo_path)
+
+
+def _md_tree(files: Iterable[Path], root: Path, prefix="  ") -> list[str]:
+    """Nested markdown list of `files` below `root`, files before subdirectories.
 
+    Built from the paths alone, so listing a large repo doesn't touch the disk.
+    """
+    tree: dict = {}
+    for file in files:
+        node = tree
+        for part in file.relative_to(root).parts[:-1]:
+            node = node.setdefault(part, {})
+        node[file.name] = None
+    return _md_tree_lines(tree, root, prefix)
 
-def _dir_to_md_tree(root_path: Path, path: Path, prefix="  "):
+
+def _md_tree_lines(tree: dict, path: Path, prefix: str) -> list[str]:
     indent = "  "
     item_prefix = "* "
 
-    paths = list(path.glob("*"))
-    files = [path for path in paths if path.is_file()]
-    files.sort(key=lambda f: f.name)
+    files = sorted(name for name, subtree in tree.items() if subtree is None)
     lines = [
-        f"{prefix}{item_prefix}[{file.name}]({pathname2url(str(file.relative_to(root_path)))})"
-        for file in files
+        f"{prefix}{item_prefix}[{name}]({pathname2url(str(path / name))})"
+        for name in files
     ]
 
-    dirs = [path for path in paths if path.is_dir()]
-    dirs.sort(key=lambda d: d.name)
+    dirs = sorted(name for name, subtree in tree.items() if subtree is not None)
     for dir in dirs:
-        lines.append(
-            f"{prefix}{item_prefix}[{dir.name}/]({dir.relative_to(root_path)})"
-        )
-        lines += _dir_to_md_tree(root_path, dir, prefix + indent)
+        lines.append(f"{prefix}{item_prefix}[{dir}/]({path / dir})")
+        lines += _md_tree_lines(tree[dir], path / dir, prefix + indent)
     return lines
 
 
-def _copy_rendered_pdfs_to_external_folder(paths: list[Path]):
-    if not Config.pdf_copy_path:
-        return
-    logger.info("Copying PDFs to target directory ...")
-    base_dir = Path(Config.render_path) / "pdf"
-    if not Path(Config.pdf_copy_path).exists():
-        logger.error(
-            "Directory to save pdf files to does not exist! Have you mounted/started e.g. google drive?"
-        )
-        return
-    for path in paths:
-        target_path = Config.pdf_copy_path / (path.relative_to(base_dir))
+class PdfCopier:
+    """Copies rendered PDFs to `pdf_copy_path`, e.g. a google drive mount, in the background.
+
+    A copy is skipped if the target still has the size and hash of what was copied there
+    last. Copies are written to a temporary name and renamed into place, and are given up
+    on after `pdf_copy_timeout` seconds, so a stalled mount can't freeze the service.
+    The backlog is saved to `render_path`, so copies that failed or were still pending
+    when the service stopped are retried, with the next sync or on restart.
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue[str] = queue.Queue()
+        self._lock = threading.Lock()
+        self._backlog: set[str] = set()
+        self._queued: set[str] = set()
+        self._in_flight: set[str] = set()
+        self._copied: dict[str, str] = {}  # Path -> hash of what was last copied there
+        self._workers: list[threading.Thread] = []
+        self._bytes = 0
+        self._seconds = 0.0
+
+    @property
+    def _state_path(self) -> Path:
+        return Path(Config.render_path) / "pdf_copy.json"
+
+    def start(self):
+        """Load the backlog of a previous run, and start copying it."""
+        if not Config.pdf_copy_path:
+            return
+        with self._lock:
+            if self._workers:
+                return
+            if self._state_path.exists():
+                state = json.loads(self._state_path.read_text())
+                self._backlog.update(state["backlog"])
+                self._copied.update(state["copied"])
+            self._workers = [
+                threading.Thread(target=self._run, name=f"pdf-copy-{i}", daemon=True)
+                for i in range(max(Config.pdf_copy_workers, 1))
+            ]
+            self._enqueue_backlog()
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, paths: list[Path]):
+        """Queue rendered PDFs to be copied, along with any earlier copies that failed."""
+        if not Config.pdf_copy_path:
+            return
+        self.start()
+        base_dir = Path(Config.render_path) / "pdf"
+        with self._lock:
+            self._backlog.update(str(path.relative_to(base_dir)) for path in paths)
+            self._enqueue_backlog()
+
+    def wait(self):
+        """Block until every queued copy was attempted."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            try:
+                self._process(path)
+            except Exception as e:
+                logger.error(f"Unable to record the copy of {path}: {e!r}")
+            finally:
+                self._queue.task_done()
+
+    def _process(self, path: str):
+        with self._lock:
+            self._queued.discard(path)
+            self._in_flight.add(path)
+        try:
+            digest = self._copy(path)
+            failed = False
+        except Exception as e:
+            logger.error(f"Unable to copy {path} to {Config.pdf_copy_path}: {e!r}")
+            Metrics.increment("pdf_copy_failures")
+            failed = True
+        with self._lock:
+            self._in_flight.discard(path)
+            if not failed:
+                if digest is None:
+                    self._copied.pop(path, None)
+                else:
+                    self._copied[path] = digest
+                # Otherwise the PDF was updated while being copied, and is copied again
+                if path not in self._queued:
+                    self._backlog.discard(path)
+            self._save_state()
+
+    def _copy(self, path: str) -> str | None:
+        """Returns the hash of the copied file, or None if it was removed since."""
+        source_path = Path(Config.render_path) / "pdf" / path
+        if not source_path.exists():
+            return None
+        if not Path(Config.pdf_copy_path).exists():
+            raise FileNotFoundError(
+                "Directory to save pdf files to does not exist! Have you mounted/started e.g. google drive?"
+            )
+        data = source_path.read_bytes()
+        digest = sha256(data).hexdigest()
+        target_path = Path(Config.pdf_copy_path) / path
+        if (
+            self._copied.get(path) == digest
+            and target_path.exists()
+            and target_path.stat().st_size == len(data)
+        ):
+            Metrics.increment("pdf_copies_skipped")
+            return digest
         target_path.parent.mkdir(exist_ok=True, parents=True)
-        subprocess.check_call(["cp", str(path), str(target_path)])
-
-
-def load_db_file_from_backup():
+        tmp_path = target_path.with_name(f".{target_path.name}.tmp")
+        start = time.perf_counter()
+        try:
+            # A separate process, as one stuck on the mount can be killed, unlike a thread
+            subprocess.run(
+                ["cp", str(source_path), str(tmp_path)],
+                check=True,
+                capture_output=True,
+                timeout=Config.pdf_copy_timeout,
+            )
+            tmp_path.replace(target_path)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        with self._lock:
+            self._bytes += len(data)
+            self._seconds += time.perf_counter() - start
+            Metrics.set(
+                "pdf_copy_mb_per_second",
+                round(self._bytes / 1e6 / max(self._seconds, 1e-9), 2),
+            )
+        Metrics.increment("pdf_copies")
+        return digest
+
+    def _enqueue_backlog(self):
+        for path in self._backlog - self._queued - self._in_flight:
+            self._queued.add(path)
+            self._queue.put(path)
+        self._save_state()
+
+    def _save_state(self):
+        Metrics.set("pdf_copy_backlog", len(self._backlog))
+        state = {"backlog": sorted(self._backlog), "copied": self._copied}
+        self._state_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self._state_path.with_name(self._state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(state))
+        tmp_path.replace(self._state_path)
+
+
+pdf_copier = PdfCopier()
+
+
+class DBBackupError(Exception):
+    pass
+
+
+@dataclass
+class _DBBackupState:
+    dirty: bool = False
+    last_backup: float | None = None
+
+
+# Keyed by DB file name, as there's one DB per tablet
+_db_backup_states: dict[str, _DBBackupState] = defaultdict(_DBBackupState)
+_db_backup_lock = threading.Lock()
+
+
+def mark_db_dirty(db_path: Path | None = None):
+    _db_backup_states[(db_path or DB_CACHE_PATH).name].dirty = True
+
+
+def load_db_file_from_backup(db_path: Path | None = None):
     if not Config.db_data_dir:
         return
+    db_path = db_path or DB_CACHE_PATH
     logger.info("Loading DB files ...")
-    db_path = Path(Config.db_data_dir) / DB_CACHE_PATH.name
-    if not db_path.exists():
+    backup_path = Path(Config.db_data_dir) / db_path.name
+    if not backup_path.exists():
         raise FileNotFoundError("DB backup does not exist!")
-    DB_CACHE_PATH.parent.mkdir(exist_ok=True)
-    subprocess.check_call(["cp", str(db_path), str(DB_CACHE_PATH)])
+    _check_db_integrity(backup_path)
+    db_path.parent.mkdir(exist_ok=True)
+    _backup_db(backup_path, db_path)
+
 
+def db_is_intact(db_path: Path) -> bool:
+    """Whether a local DB exists and passes SQLite's integrity check."""
+    if not db_path.exists():
+        return False
+    try:
+        _check_db_integrity(db_path, read_only=False)
+    except DBBackupError as e:
+        logger.warning(e)
+        return False
+    return True
 
-def save_db_file_to_backup():
+
+def save_db_file_to_backup(force: bool = False, db_path: Path | None = None):
     if not Config.db_data_dir:
         return
+    with _db_backup_lock:
+        _save_db_file_to_backup(force, db_path or DB_CACHE_PATH)
+
+
+def flush_db_backup(db_path: Path | None = None):
+    """Back up changes deferred by `db_backup_interval`, e.g. when shutting down."""
+    if not Config.db_data_dir:
+        return
+    db_path = db_path or DB_CACHE_PATH
+    with _db_backup_lock:
+        if _db_backup_states[db_path.name].dirty:
+            _save_db_file_to_backup(True, db_path)
+
+
+def _save_db_file_to_backup(force: bool, db_path: Path):
+    state = _db_backup_states[db_path.name]
+    if not (state.dirty or force):
+        return
+    last_backup = state.last_backup
+    if (
+        not force
+        and last_backup is not None
+        and time.monotonic() - last_backup < Config.db_backup_interval
+    ):
+        logger.debug("DB changed, but backed up recently. Deferring backup ...")
+        return
     logger.info("Saving DB files ...")
-    db_path = Path(Config.db_data_dir) / DB_CACHE_PATH.name
-    db_path.parent.mkdir(exist_ok=True, parents=True)
-    subprocess.check_call(["cp", str(DB_CACHE_PATH), str(db_path)])
+    backup_path = Path(Config.db_data_dir) / db_path.name
+    backup_path.parent.mkdir(exist_ok=True, parents=True)
+    _backup_db(db_path, backup_path)
+    state.dirty = False
+    state.last_backup = time.monotonic()
+
+
+def _check_db_integrity(db_path: Path, read_only: bool = True):
+    # Opened writable, a DB in use recovers its WAL first, which read-only can't
+    mode = "ro" if read_only else "rw"
+    with closing(sqlite3.connect(f"{db_path.as_uri()}?mode={mode}", uri=True)) as conn:
+        try:
+            result = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+        except sqlite3.DatabaseError as e:
+            raise DBBackupError(f"DB {db_path} is unreadable: {e}") from e
+    if result != ["ok"]:
+        raise DBBackupError(f"DB {db_path} failed integrity check: {result}")
+
+
+def _backup_db(source_path: Path, target_path: Path):
+    """Consistent copy via SQLite's online backup API, atomically renamed into place."""
+    tmp_path = target_path.with_name(target_path.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    with (
+        closing(sqlite3.connect(source_path)) as source,
+        closing(sqlite3.connect(tmp_path)) as target,
+    ):
+        source.backup(target)
+        # Keep the copy self-contained, without -wal/-shm side files
+        target.execute("PRAGMA journal_mode=DELETE")
+    for suffix in ("-wal", "-shm"):
+        target_path.with_name(target_path.name + suffix).unlink(missing_ok=True)
+    tmp_path.replace(target_path)
@@ -0,0 +1,392 @@
+import threading
+import time
+from hashlib import sha256
+from pathlib import Path
+
+from loguru import logger
+from sqlalchemy import and_, case, delete, func, inspect, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import doc_parsing as dp
+from .config import Config
+from .db import SQLITE_PRAGMAS, create_sqlite_engine
+from .file_processing_config import ProcessingConfig
+from .metrics import Metrics
+from .models import Job, JobBase, JobWorker, RemarkablePage
+from .scheduler import CycleBudget
+
+# How often the syncing process checks on its jobs, and idle workers look for new ones
+POLL_SECONDS = 1.0
+# Jobs failing this often, or whose workers keep disappearing, are given up on
+MAX_ATTEMPTS = 3
+# Idle workers check in this often, and are presumed gone once they haven't for longer
+# than `WORKER_TIMEOUT_SECONDS`, so the syncing process doesn't wait on an empty queue
+HEARTBEAT_SECONDS = 30.0
+WORKER_TIMEOUT_SECONDS = 120.0
+# Finished jobs are kept this long, e.g. for a cycle that stopped waiting on a page to
+# pick up its result, then pruned by idle workers
+FINISHED_RETENTION_SECONDS = 24 * 3600.0
+
+# The queue's directory may be shared over a network file system, which WAL's shared
+# memory doesn't work on, so it uses a rollback journal, and waits longer for locks
+QUEUE_PRAGMAS = SQLITE_PRAGMAS | {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL",
+    "busy_timeout": 30000,  # in ms
+}
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+# One engine per queue directory for the lifetime of the process
+_engines: dict[Path, Engine] = {}
+_engines_lock = threading.Lock()
+# When the syncing process last warned that no worker is around
+_no_workers_warned = 0.0
+
+
+def get_engine() -> Engine:
+    """The queue's DB in `job_queue_dir`, shared by the syncing process and the workers."""
+    queue_dir = Path(Config.job_queue_dir)
+    with _engines_lock:
+        if queue_dir not in _engines:
+            (queue_dir / "blobs").mkdir(exist_ok=True, parents=True)
+            engine = create_sqlite_engine(queue_dir / "jobs.sqlite", QUEUE_PRAGMAS)
+            JobBase.metadata.create_all(engine)
+            _add_missing_columns(engine)
+            _engines[queue_dir] = engine
+        return _engines[queue_dir]
+
+
+def _add_missing_columns(engine: Engine):
+    """Upgrade a queue created by an older version, which `create_all` leaves as is."""
+    with engine.begin() as conn:
+        columns = {column["name"] for column in inspect(conn).get_columns("job")}
+        if "finished_at" not in columns:
+            conn.exec_driver_sql("ALTER TABLE job ADD COLUMN finished_at FLOAT")
+
+
+def _blob_path(pdf_hash: str) -> Path:
+    return Path(Config.job_queue_dir) / "blobs" / f"{pdf_hash}.pdf"
+
+
+def convert(
+    engine: Engine,
+    page: RemarkablePage,
+    config: ProcessingConfig,
+    budget: CycleBudget | None = None,
+) -> str | None:
+    """Queue a page for the workers to convert, and wait for its markdown.
+
+    Stands in for `doc_parsing.page_to_md`, including its fallback: once the workers
+    give up on the page, it's queued again for `backup_model`. Returns None if
+    converting it failed, or no worker is around, or the cycle ran out of time, in
+    which case the job is left for the next cycle to pick up.
+    """
+    for model in dict.fromkeys([Config.model, Config.backup_model]):
+        result, status = _convert_with(engine, page, config, model, budget)
+        if status != FAILED:
+            return result
+    logger.error(
+        f"Failed to convert page {page.page_idx} of file {page.parent.name} to markdown."
+    )
+    return None
+
+
+def _convert_with(
+    engine: Engine,
+    page: RemarkablePage,
+    config: ProcessingConfig,
+    model: str,
+    budget: CycleBudget | None,
+) -> tuple[str | None, str]:
+    """Queue a page for `model` and wait for the job to be done or failed. Returns the
+    job's result and last seen status."""
+    with Session(engine) as session, session.begin():
+        job_id, status, result = submit(page, config, model, session=session)
+    if status == DONE:
+        Metrics.increment("ocr_jobs_reused")
+        return result, status
+    # The workers make the API calls, but they still count against this cycle
+    if budget is not None and not budget.spend_api_call():
+        return None, status
+    Metrics.increment("ocr_jobs_submitted")
+    while True:
+        with Session(engine) as session:
+            status, result = session.execute(
+                select(Job.status, Job.result).where(Job.id == job_id)
+            ).one()
+            if status in (DONE, FAILED):
+                return result, status
+            if not _workers_alive(session=session):
+                _warn_no_workers()
+                return None, status
+        if budget is not None and budget.out_of_time():
+            return None, status
+        time.sleep(POLL_SECONDS)
+
+
+def _workers_alive(*, session: Session) -> bool:
+    """Whether a worker has checked in recently, or still holds a lease on a job."""
+    now = time.time()
+    seen = session.execute(
+        select(JobWorker.name)
+        .where(JobWorker.last_seen >= now - WORKER_TIMEOUT_SECONDS)
+        .limit(1)
+    ).first()
+    if seen is not None:
+        return True
+    leased = session.execute(
+        select(Job.id).where(Job.status == LEASED, Job.lease_expires > now).limit(1)
+    ).first()
+    return leased is not None
+
+
+def _warn_no_workers():
+    global _no_workers_warned
+    if time.time() - _no_workers_warned >= WORKER_TIMEOUT_SECONDS:
+        _no_workers_warned = time.time()
+        logger.warning(
+            f"No job worker seen in the last {WORKER_TIMEOUT_SECONDS:.0f}s, leaving "
+            f"pages queued in {Config.job_queue_dir}. Start one with `rm-auto-ocr worker`."
+        )
+
+
+def submit(
+    page: RemarkablePage,
+    config: ProcessingConfig,
+    model: str | None = None,
+    *,
+    session: Session,
+) -> tuple[int, str, str | None]:
+    """Queue a page, unless the same PDF was queued with the same prompt and model before.
+
+    The model defaults to `Config.model`. Failed jobs are queued again, and so are done
+    ones if the page is to be reprocessed (`config.force_reprocess`). Returns the job's
+    id, status, and result.
+    """
+    data = page.pdf_data
+    pdf_hash = sha256(data).hexdigest()
+    stmt = insert(Job).values(
+        pdf_hash=pdf_hash,
+        prompt=config.prompt,
+        prompt_hash=config.prompt_hash,
+        model=model or Config.model,
+        status=PENDING,
+        attempts=0,
+    )
+    retry = (
+        Job.status.in_([FAILED, DONE])
+        if config.force_reprocess
+        else Job.status == FAILED
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["pdf_hash", "prompt_hash", "model"],
+        set_={
+            "status": case((retry, PENDING), else_=Job.status),
+            "attempts": case((retry, 0), else_=Job.attempts),
+            "result": case((retry, None), else_=Job.result),
+            "finished_at": case((retry, None), else_=Job.finished_at),
+        },
+    ).returning(Job.id, Job.status, Job.result)
+    job_id, status, result = session.execute(stmt).one()
+    # Written before the job is committed, so workers never see it without its PDF
+    blob_path = _blob_path(pdf_hash)
+    if status != DONE and not blob_path.exists():
+        tmp_path = blob_path.with_name(f".{pdf_hash}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(blob_path)
+    return job_id, status, result
+
+
+def claim(worker: str, *, session: Session) -> Job | None:
+    """Lease the oldest job that's pending, or whose lease ran out, to `worker`."""
+    now = time.time()
+    expired = and_(Job.status == LEASED, Job.lease_expires <= now)
+    session.execute(
+        update(Job)
+        .where(expired, Job.attempts >= MAX_ATTEMPTS)
+        .values(status=FAILED, error="Lease expired too often", finished_at=now)
+    )
+    next_job = (
+        select(Job.id)
+        .where(or_(Job.status == PENDING, expired))
+        .order_by(Job.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    return session.scalars(
+        update(Job)
+        .where(Job.id == next_job)
+        .values(
+            status=LEASED,
+            worker=worker,
+            lease_expires=now + Config.job_lease_seconds,
+            attempts=Job.attempts + 1,
+        )
+        .returning(Job)
+    ).one_or_none()
+
+
+def complete(
+    job_id: int, worker: str, result: str, seconds: float, *, session: Session
+) -> bool:
+    """Record a job's result. Returns False if another worker completed it already."""
+    done = (
+        session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status != DONE)
+            .values(
+                status=DONE,
+                worker=worker,
+                result=result,
+                lease_expires=None,
+                finished_at=time.time(),
+            )
+        ).rowcount
+        == 1
+    )
+    _record_work(worker, seconds, done=int(done), failed=0, session=session)
+    return done
+
+
+def fail(job_id: int, worker: str, error: str, seconds: float, *, session: Session):
+    """Give a job back to be retried, or give up on it after `MAX_ATTEMPTS`."""
+    given_up = Job.attempts >= MAX_ATTEMPTS
+    session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.status == LEASED, Job.worker == worker)
+        .values(
+            status=case((given_up, FAILED), else_=PENDING),
+            error=error,
+            lease_expires=None,
+            finished_at=case((given_up, time.time()), else_=None),
+        )
+    )
+    _record_work(worker, seconds, done=0, failed=1, session=session)
+
+
+def _record_work(worker: str, seconds: float, done: int, failed: int, session: Session):
+    stmt = insert(JobWorker).values(
+        name=worker,
+        jobs_done=done,
+        jobs_failed=failed,
+        busy_seconds=seconds,
+        last_seen=time.time(),
+    )
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["name"],
+            set_={
+                "jobs_done": JobWorker.jobs_done + done,
+                "jobs_failed": JobWorker.jobs_failed + failed,
+                "busy_seconds": JobWorker.busy_seconds + seconds,
+                "last_seen": stmt.excluded.last_seen,
+            },
+        )
+    )
+
+
+def prune(*, session: Session) -> int:
+    """Delete the jobs finished more than `FINISHED_RETENTION_SECONDS` ago, along with
+    the PDFs failed ones kept. Returns how many were deleted."""
+    cutoff = time.time() - FINISHED_RETENTION_SECONDS
+    pruned = session.execute(
+        delete(Job)
+        .where(
+            Job.status.in_([DONE, FAILED]),
+            # Jobs finished before `finished_at` was tracked
+            or_(Job.finished_at.is_(None), Job.finished_at < cutoff),
+        )
+        .returning(Job.pdf_hash)
+    ).all()
+    for pdf_hash in {pdf_hash for (pdf_hash,) in pruned}:
+        _discard_blob(pdf_hash, session=session)
+    if pruned:
+        logger.info(f"Pruned {len(pruned)} finished jobs from the queue")
+    return len(pruned)
+
+
+def _discard_blob(pdf_hash: str, *, session: Session):
+    """Remove a page's PDF once no job needs it anymore."""
+    still_needed = session.execute(
+        select(Job.id).where(Job.pdf_hash == pdf_hash, Job.status != DONE).limit(1)
+    ).first()
+    if still_needed is None:
+        _blob_path(pdf_hash).unlink(missing_ok=True)
+
+
+def work(
+    engine: Engine,
+    worker: str,
+    threads: int = 1,
+    until_idle: bool = False,
+    stop: threading.Event | None = None,
+):
+    """Convert queued pages until stopped, or until the queue is empty if `until_idle`."""
+    stop = stop or threading.Event()
+    runners = [
+        threading.Thread(
+            target=_work,
+            args=(engine, worker, until_idle, stop),
+            name=f"job-worker-{i}",
+            daemon=True,
+        )
+        for i in range(max(threads, 1))
+    ]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+
+
+def _work(engine: Engine, worker: str, until_idle: bool, stop: threading.Event):
+    last_heartbeat = 0.0
+    while not stop.is_set():
+        with Session(engine) as session, session.begin():
+            job = claim(worker, session=session)
+            if job is None and time.time() - last_heartbeat >= HEARTBEAT_SECONDS:
+                # Lets syncing processes tell an idle worker from a missing one
+                _record_work(worker, 0.0, done=0, failed=0, session=session)
+                prune(session=session)
+                last_heartbeat = time.time()
+            if job is not None:
+                job_id, pdf_hash, prompt, model = (
+                    job.id,
+                    job.pdf_hash,
+                    job.prompt,
+                    job.model,
+                )
+        if job is None:
+            if until_idle:
+                return
+            stop.wait(POLL_SECONDS)
+            continue
+        logger.info(f"Worker {worker} converting job {job_id}")
+        start = time.perf_counter()
+        try:
+            md = dp.pdf_to_md(_blob_path(pdf_hash).read_bytes(), prompt, model)
+            error = None if md else "Conversion failed"
+        except Exception as e:
+            md, error = None, repr(e)
+        seconds = time.perf_counter() - start
+        with Session(engine) as session, session.begin():
+            if md:
+                complete(job_id, worker, md, seconds, session=session)
+                _discard_blob(pdf_hash, session=session)
+            else:
+                logger.warning(f"Worker {worker} failed job {job_id}: {error}")
+                fail(job_id, worker, error, seconds, session=session)
+
+
+def stats(*, session: Session) -> tuple[dict[str, int], list[JobWorker]]:
+    """Number of jobs by status, and the workers' throughput."""
+    counts = dict(
+        session.execute(select(Job.status, func.count()).group_by(Job.status)).all()
+    )
+    return counts, list(session.scalars(select(JobWorker).order_by(JobWorker.name)))
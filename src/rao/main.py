@@ -1,68 +1,488 @@
-import itertools
-import time
+import os
+import signal
+import socket
+import threading
+from contextlib import ExitStack, nullcontext
+from datetime import datetime
+from functools import partial
+from itertools import zip_longest
 from pathlib import Path
 
 import click
 from loguru import logger
 from sqlalchemy import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
 
-from rao import db, remarkable
-from rao import doc_parsing as dp
+from rao import backfill, db, job_queue, remarkable, watcher
 from rao import file_processing_config as fpc
 from rao import file_sync as fs
-from rao.config import Config
+from rao.config import Config, Tablet
+from rao.metrics import Metrics
+from rao.models import RemarkableFile
+from rao.pipeline import DocumentResult, SyncPipeline
+from rao.scheduler import (
+    AdaptiveScheduler,
+    CycleBudget,
+    CycleOutcome,
+    FairShare,
+    prioritise,
+)
 
 
 def run():
     logger.info("Service is running...")
     Config.reload()  # Must succeed on startup
-    fs.load_db_file_from_backup()
-    engine = db.get_engine()
+    tablets = Config.devices()
+    triggers = [watcher.SyncTrigger() for _ in tablets]
+    watcher.start(watcher.TriggerGroup(triggers))
+    # E.g. `docker stop`: exit through the `finally` below instead of being killed
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    fs.pdf_copier.start()  # Resume copies left over from the last run
+    # One pool of OCR slots for all tablets, on top of the process-wide rate limit
+    ocr_slots = FairShare(Config.ocr_workers)
+    try:
+        if len(tablets) == 1:
+            _run_tablet(tablets[0], triggers[0], ocr_slots)
+            return
+        threads = [
+            threading.Thread(
+                target=_run_tablet,
+                args=(tablet, trigger, ocr_slots),
+                name=f"sync-{tablet.name}",
+                daemon=True,
+            )
+            for tablet, trigger in zip(tablets, triggers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        # Checkpoints committed since the last backup would be lost otherwise
+        for tablet in tablets:
+            fs.flush_db_backup(db.db_path_for(tablet))
+
+
+def _exit_on_signal(signum: int, _frame=None):
+    logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+    raise SystemExit(128 + signum)
+
+
+def _run_tablet(tablet: Tablet, trigger: watcher.SyncTrigger, ocr_slots: FairShare):
+    db_path = db.db_path_for(tablet)
+    _restore_db(db_path)
+    engine = db.get_engine(db_path)
+    _seed_search_index(engine)
+    scheduler = AdaptiveScheduler()
     check_interval = 0
     while True:
-        time.sleep(check_interval)
-        check_interval = Config.check_interval
+        if reasons := trigger.wait(check_interval):
+            logger.info(f"Syncing ahead of schedule: {', '.join(reasons)}")
         try:
-            run_once(engine)
-        except Exception:
-            logger.error(
-                f"Failure during sync, trying again in {check_interval} seconds..."
+            outcome = run_once(
+                engine,
+                connect_retries=scheduler.connect_retries,
+                tablet=tablet,
+                ocr_slots=ocr_slots,
             )
+        except Exception:
+            logger.error("Failure during sync")
+            outcome = CycleOutcome.FAILED
+        check_interval = scheduler.next_interval(outcome)
+        Metrics.report()
+
+
+def _restore_db(db_path: Path):
+    """Restore a DB from its backup, unless the local copy is intact. It's at least as
+    recent, as backups are deferred by `db_backup_interval`."""
+    if fs.db_is_intact(db_path):
+        return
+    try:
+        fs.load_db_file_from_backup(db_path)
+    except FileNotFoundError:
+        # E.g. a tablet that was added to `tablets` since the last run
+        logger.warning(f"No backup of {db_path.name} yet, starting with a fresh DB")
+
+
+def _seed_search_index(engine: Engine):
+    with db.session_scope(engine, label="seeding the search index") as db_session:
+        db.seed_page_text(fs.rendered_md_pages, session=db_session)
 
 
 @logger.catch(reraise=True)
-def run_once(engine: Engine):
+def run_once(
+    engine: Engine,
+    connect_retries: int = 5,
+    tablet: Tablet | None = None,
+    ocr_slots: FairShare | None = None,
+) -> CycleOutcome:
     Config.reload()
-    with remarkable.connect() as session:
-        if session is None:
-            return
-        files = remarkable.get_files(session)
-        file_configs = fpc.get_configs_for_files(files)
-        files_to_update = db.out_of_sync_files(file_configs, engine)
-        if not files_to_update:
-            return
-        pages = [remarkable.render_pages(session, file) for file in files_to_update]
-
-    all_pages = list(itertools.chain.from_iterable(pages))
-    out_of_sync_pages = db.out_of_sync_pages(all_pages, file_configs, engine)
-    rendered, failed = dp.pages_to_md(out_of_sync_pages, file_configs)
-    saved = fs.save(all_pages, rendered)
-    saved = {
-        file: pages
-        for file, pages in saved.items()
-        if not any([p in failed for p in pages])
+    # Pick up changes to the tablet's section, e.g. a new IP address
+    name = tablet.name if tablet is not None else ""
+    tablet = next((t for t in Config.devices() if t.name == name), tablet)
+    if tablet.name:
+        logger.info(f"Syncing tablet {tablet.name}")
+    Metrics.increment("cycles")
+    db_path = Path(engine.url.database)
+    with db.session_scope(engine) as db_session:
+        outcome = _sync(db_session, connect_retries, tablet, ocr_slots)
+    if outcome == CycleOutcome.CHANGED:
+        fs.mark_db_dirty(db_path)
+        logger.info("Syncing complete")
+    fs.save_db_file_to_backup(db_path=db_path)
+    return outcome
+
+
+def _sync(
+    db_session: Session,
+    connect_retries: int,
+    tablet: Tablet,
+    ocr_slots: FairShare | None,
+) -> CycleOutcome:
+    snapshot = (
+        remarkable.LocalSnapshot(Path(tablet.snapshot_path))
+        if tablet.snapshot_path
+        else None
+    )
+    with ExitStack() as connection:
+        client = connection.enter_context(
+            remarkable.connect(retries=connect_retries, tablet=tablet)
+        )
+        online = client is not None
+        if snapshot is not None:
+            # Only use the tablet to transfer files, and process them from the snapshot
+            if online:
+                remarkable.mirror(client, snapshot)
+            connection.close()
+            source = snapshot
+        elif online:
+            source = client
+        else:
+            return CycleOutcome.OFFLINE
+        if not online and not snapshot.files_root.is_dir():
+            return CycleOutcome.OFFLINE
+        if not online:
+            logger.info(f"Tablet offline, processing from snapshot {snapshot.root}")
+            Metrics.increment("cycles_from_snapshot")
+        outcome = _sync_from(source, db_session, connection, tablet, ocr_slots)
+    if not online and outcome == CycleOutcome.IDLE:
+        return CycleOutcome.OFFLINE
+    return outcome
+
+
+def _sync_from(
+    source: remarkable.Source,
+    db_session: Session,
+    connection: ExitStack,
+    tablet: Tablet,
+    ocr_slots: FairShare | None,
+) -> CycleOutcome:
+    """Sync the documents in `source`, closing the tablet `connection` as soon as it's not needed."""
+    files_df = remarkable.list_files(source)
+    fingerprint = (
+        f"{remarkable.library_fingerprint(files_df)}:{fpc.inputs_fingerprint()}"
+    )
+    last_fingerprint = db.get_sync_state(db.LIBRARY_FINGERPRINT_KEY, session=db_session)
+    if fingerprint == last_fingerprint:
+        logger.info("Nothing changed since last sync")
+        Metrics.increment("cycles_skipped_unchanged")
+        return CycleOutcome.IDLE
+    files = remarkable.get_files(source, files_df, namespace=tablet.name)
+    # Templates are listed once per cycle, rather than checked for every document
+    remarkable.template_cache.forget_listings()
+    if db.gc_due(db_session.get_bind()):
+        stale_paths = db.collect_garbage(files, session=db_session)
+        # Only remove the outputs once the DB no longer refers to them
+        db_session.commit()
+        fs.remove_rendered_files(stale_paths)
+    file_configs = fpc.get_configs_for_files(files)
+    files_to_update = db.out_of_sync_files(file_configs, session=db_session)
+    if not files_to_update:
+        db.set_sync_state(db.LIBRARY_FINGERPRINT_KEY, fingerprint, session=db_session)
+        return CycleOutcome.IDLE
+    db_hashes = db.page_hashes_for_files(files_to_update, session=db_session)
+    forced_pass = db.forced_pass_hashes(
+        [file for file in files_to_update if file_configs[file].force_reprocess],
+        session=db_session,
+    )
+    # Release the DB for the per-document checkpoints made by the pipeline
+    db_session.commit()
+    budget = CycleBudget.from_config()
+    sync_pipeline = SyncPipeline(
+        source,
+        file_configs,
+        db_hashes,
+        render_workers=Config.render_workers,
+        ocr_workers=Config.ocr_workers,
+        save_workers=Config.save_workers,
+        queue_size=Config.pipeline_queue_size,
+        on_saved=partial(_checkpoint, db_session.get_bind(), file_configs),
+        budget=budget,
+        ocr_slots=ocr_slots,
+        tablet=tablet.name,
+        job_queue=job_queue.get_engine() if Config.job_queue_dir else None,
+        forced_pass=forced_pass,
+    )
+    sync_pipeline.start()
+    # Recent edits first, so a large backlog can't hold them up
+    for file in prioritise(files_to_update, file_configs):
+        sync_pipeline.submit(file)
+    sync_pipeline.finish_rendering()
+    connection.close()
+
+    results = sync_pipeline.finish()
+    budget.report()
+    fs.publish(
+        [doc.pdf_path for doc in results if doc.pdf_path],
+        [doc.md_path for doc in results if doc.md_path],
+    )
+    fpc.consume_reprocess_once(file_configs, _fully_synced(results))
+    incomplete = (
+        budget.exhausted_reason is not None
+        or bool(sync_pipeline.failed_files)
+        or any(doc.failed or doc.deferred or not doc.checkpointed for doc in results)
+    )
+    # Only skip future cycles if there is nothing left to retry or reprocess
+    forced = any(config.force_reprocess for config in file_configs.values())
+    db.set_sync_state(
+        db.LIBRARY_FINGERPRINT_KEY,
+        None if incomplete or forced else fingerprint,
+        session=db_session,
+    )
+    # E.g. documents that keep failing to render shouldn't keep the scheduler busy
+    if not any(doc.checkpointed for doc in results):
+        return CycleOutcome.IDLE
+    return CycleOutcome.CHANGED
+
+
+def _fully_synced(results: list[DocumentResult]) -> set[RemarkableFile]:
+    return {
+        doc.file
+        for doc in results
+        if doc.checkpointed and not doc.failed and not doc.deferred
     }
-    db.mark_as_synced(saved, file_configs, engine)
-    fs.save_db_file_to_backup()
-    logger.info("Syncing complete")
 
 
-@click.command()
-def main():
+def _checkpoint(
+    engine: Engine,
+    file_configs: dict[RemarkableFile, fpc.ProcessingConfig],
+    doc: DocumentResult,
+):
+    """Commit a saved document, so it isn't converted again if the service stops."""
+    with db.session_scope(engine, label=f"saving {doc.file.name}") as db_session:
+        if doc.failed or doc.deferred:
+            pending = doc.failed | doc.deferred
+            converted = [page for page in doc.pages if page not in pending]
+            db.mark_pages_synced(converted, session=db_session)
+            if file_configs[doc.file].force_reprocess:
+                # Carry on with the remaining pages next cycle, rather than starting over
+                db.continue_forced_pass(doc.file, converted, session=db_session)
+        else:
+            db.mark_as_synced({doc.file: doc.pages}, file_configs, session=db_session)
+            if file_configs[doc.file].force_reprocess:
+                db.end_forced_pass(doc.file, session=db_session)
+        db.index_page_text(doc.file, doc.rendered, session=db_session)
+    db_path = Path(engine.url.database)
+    fs.mark_db_dirty(db_path)
+    fs.save_db_file_to_backup(db_path=db_path)
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def main(ctx: click.Context):
+    if ctx.invoked_subcommand is not None:
+        return
     log_dir = Path("/data/logs")
     logger.add(log_dir / "debug.log", level="INFO")
     run()
 
 
+@main.command()
+def sync_now():
+    """Ask the running service to sync immediately."""
+    Config.reload()
+    if not Config.control_socket_path:
+        raise click.ClickException("No control_socket_path configured")
+    click.echo(watcher.send_command("sync", Path(Config.control_socket_path)))
+
+
+@main.command()
+@click.argument("query")
+@click.option("--limit", default=20, show_default=True, help="Most results to show.")
+def search(query: str, limit: int):
+    """Search the converted pages, e.g. `meeting AND budget` or `"exact phrase"`."""
+    Config.reload()
+    hits_by_db = []
+    for tablet in Config.devices():
+        db_path = db.db_path_for(tablet)
+        if not db_path.exists():
+            continue
+        with db.session_scope(db.get_engine(db_path), label="searching") as db_session:
+            try:
+                hits_by_db.append(db.search_pages(query, limit, session=db_session))
+            except OperationalError as e:
+                raise click.ClickException(f"Invalid search query: {e.orig}")
+    # Ranks are relative to each DB's pages, so the DBs' best matches take turns
+    hits = [hit for hits in zip_longest(*hits_by_db) for hit in hits if hit][:limit]
+    for hit in hits:
+        click.echo(f"{hit.path} (page {hit.page_idx + 1}): {hit.snippet}")
+    if not hits:
+        click.echo("No matches")
+
+
+@main.command()
+@click.option(
+    "--name", help="Identifies the worker in the stats. Defaults to host-pid."
+)
+@click.option(
+    "--threads", default=4, show_default=True, help="Pages converted in parallel."
+)
+@click.option("--until-idle", is_flag=True, help="Exit once the queue is empty.")
+@click.option(
+    "--stats", is_flag=True, help="Show the queue and worker stats, and exit."
+)
+def worker(name: str | None, threads: int, until_idle: bool, stats: bool):
+    """Convert pages queued by the service, e.g. on another host sharing job_queue_dir."""
+    Config.reload()
+    if not Config.job_queue_dir:
+        raise click.ClickException("No job_queue_dir configured")
+    engine = job_queue.get_engine()
+    if stats:
+        with Session(engine) as db_session:
+            counts, workers = job_queue.stats(session=db_session)
+        click.echo(", ".join(f"{count} {status}" for status, count in counts.items()))
+        for stat in workers:
+            per_minute = 60 * stat.jobs_done / max(stat.busy_seconds, 1e-9)
+            last_seen = datetime.fromtimestamp(stat.last_seen).isoformat(sep=" ")
+            click.echo(
+                f"{stat.name}: {stat.jobs_done} done, {stat.jobs_failed} failed, "
+                f"{per_minute:.1f} pages/min, last seen {last_seen}"
+            )
+        return
+    name = name or f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"Worker {name} converting queued pages from {Config.job_queue_dir}")
+    job_queue.work(engine, name, threads=threads, until_idle=until_idle)
+
+
+@main.command(name="backfill")
+@click.option(
+    "--snapshot",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Local copy of the tablet's files to process, instead of the tablet itself.",
+)
+@click.option(
+    "--ocr-workers",
+    default=16,
+    show_default=True,
+    help="Pages converted in parallel, enough to saturate the API quota.",
+)
+@click.option(
+    "--tablet", "tablet_name", help="Which of the configured tablets to process."
+)
+@click.option("--yes", is_flag=True, help="Don't ask for confirmation.")
+def backfill_command(
+    snapshot: Path | None, ocr_workers: int, tablet_name: str | None, yes: bool
+):
+    """Process the whole library in one go, e.g. when setting up.
+
+    Progress is checkpointed per document, so an interrupted backfill resumes where
+    it left off when run again.
+    """
+    Config.reload()
+    tablets = {tablet.name: tablet for tablet in Config.devices()}
+    if tablet_name is None and len(tablets) > 1:
+        raise click.UsageError(f"--tablet must be one of {', '.join(tablets)}")
+    tablet = tablets.get(tablet_name) if tablet_name else next(iter(tablets.values()))
+    if tablet is None:
+        raise click.UsageError(f"Unknown tablet {tablet_name}")
+    db_path = db.db_path_for(tablet)
+    _restore_db(db_path)
+    engine = db.get_engine(db_path)
+    _seed_search_index(engine)
+    source = (
+        nullcontext(remarkable.LocalSnapshot(snapshot))
+        if snapshot
+        else remarkable.connect(tablet=tablet)
+    )
+    with source as client:
+        if client is None:
+            raise click.ClickException("Could not connect to the tablet")
+        _backfill(engine, client, tablet, ocr_workers, confirm=not yes)
+    Metrics.report()
+
+
+def _backfill(
+    engine: Engine,
+    client: remarkable.Source,
+    tablet: Tablet,
+    ocr_workers: int,
+    confirm: bool,
+):
+    with db.session_scope(engine, label="planning the backfill") as db_session:
+        files = remarkable.get_files(
+            client, remarkable.list_files(client), namespace=tablet.name
+        )
+        file_configs = fpc.get_configs_for_files(files)
+        files_to_update = db.out_of_sync_files(file_configs, session=db_session)
+        db_hashes = db.page_hashes_for_files(files_to_update, session=db_session)
+        forced_pass = db.forced_pass_hashes(
+            [file for file in files_to_update if file_configs[file].force_reprocess],
+            session=db_session,
+        )
+    plan = backfill.estimate(client, files_to_update, file_configs)
+    click.echo(f"Backfill: {plan}")
+    if not files_to_update:
+        return
+    if confirm:
+        click.confirm("Continue?", abort=True)
+
+    progress = backfill.BackfillProgress(plan)
+
+    def on_saved(doc: DocumentResult):
+        _checkpoint(engine, file_configs, doc)
+        progress.document_done(doc)
+
+    sync_pipeline = SyncPipeline(
+        client,
+        file_configs,
+        db_hashes,
+        render_workers=Config.render_workers,
+        ocr_workers=ocr_workers,
+        save_workers=Config.save_workers,
+        queue_size=Config.pipeline_queue_size,
+        on_saved=on_saved,
+        retain_pages=False,
+        tablet=tablet.name,
+        job_queue=job_queue.get_engine() if Config.job_queue_dir else None,
+        forced_pass=forced_pass,
+    )
+    sync_pipeline.start()
+    for file in prioritise(files_to_update, file_configs):
+        sync_pipeline.submit(file)
+    sync_pipeline.finish_rendering()
+    results = sync_pipeline.finish()
+    fs.publish(
+        [doc.pdf_path for doc in results if doc.pdf_path],
+        [doc.md_path for doc in results if doc.md_path],
+    )
+    fpc.consume_reprocess_once(file_configs, _fully_synced(results))
+    fs.subrepo.flush()
+    fs.pdf_copier.wait()
+
+    with db.session_scope(engine, label="finishing the backfill") as db_session:
+        # Make the service check every document again on its next cycle
+        db.set_sync_state(db.LIBRARY_FINGERPRINT_KEY, None, session=db_session)
+    db_path = Path(engine.url.database)
+    fs.mark_db_dirty(db_path)
+    fs.save_db_file_to_backup(force=True, db_path=db_path)
+    failed = sum(len(doc.failed) for doc in results)
+    click.echo(
+        f"Backfill done: {progress.documents} documents, "
+        f"{progress.converted} pages converted, {failed} pages failed, "
+        f"{len(sync_pipeline.failed_files)} documents failed to render"
+    )
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,56 @@
+import json
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from loguru import logger
+
+from .config import Config
+
+
+class _Metrics:
+    """Process-wide counters and gauges.
+
+    Reported to the log after every sync cycle, and written to `Config.metrics_path`
+    as JSON if set, so they can be picked up by external monitoring.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._report_lock = threading.Lock()
+        self._counters: dict[str, float] = defaultdict(float)
+        self._gauges: dict[str, float | str] = {}
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set(self, name: str, value: float | str):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self) -> dict[str, float | str]:
+        with self._lock:
+            return {**self._counters, **self._gauges}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+
+    def report(self):
+        snapshot = self.snapshot()
+        logger.info(
+            "Metrics: " + ", ".join(f"{k}={v}" for k, v in sorted(snapshot.items()))
+        )
+        if not Config.metrics_path:
+            return
+        path = Path(Config.metrics_path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with self._report_lock:  # Reported by every tablet's sync loop
+            tmp_path.write_text(json.dumps(snapshot, indent=2, sort_keys=True))
+            tmp_path.replace(path)
+
+
+Metrics = _Metrics()
@@ -1,11 +1,24 @@
 import datetime
+import weakref
 from dataclasses import dataclass
 from pathlib import Path
 
-from sqlalchemy import Column, DateTime, ForeignKey, String
+from sqlalchemy import (
+    DDL,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Integer,
+    String,
+    UniqueConstraint,
+    event,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from . import blob_store
+
 Base = declarative_base()
 
 
@@ -18,6 +31,7 @@ class Metadata(Base):
     parent_uuid = Column(String)
     type = Column(String)
     prompt_hash = Column(String, nullable=True)
+    path = Column(String, nullable=True)
     pages: Mapped[list["Page"]] = relationship()
 
 
@@ -26,7 +40,85 @@ class Page(Base):
 
     uuid = Column(String, primary_key=True)
     hash = Column(String)
-    parent_uuid: Mapped[String] = mapped_column(ForeignKey("metadata.uuid"))
+    parent_uuid: Mapped[String] = mapped_column(ForeignKey("metadata.uuid"), index=True)
+
+
+class PageText(Base):
+    """A converted page's markdown, indexed for full-text search by `page_text_fts`."""
+
+    __tablename__ = "page_text"
+
+    id = Column(Integer, primary_key=True)
+    uuid = Column(String, unique=True, nullable=False)
+    parent_uuid = Column(String, index=True)
+    path = Column(String)
+    page_idx = Column(Integer)
+    text = Column(String)
+
+
+# The search index itself, an FTS5 table kept up to date by triggers on `page_text`.
+# SQLAlchemy can't model virtual tables, so it's created alongside `page_text`.
+PAGE_TEXT_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS page_text_fts "
+    "USING fts5(text, content='page_text', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS page_text_ai AFTER INSERT ON page_text BEGIN "
+    "INSERT INTO page_text_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS page_text_ad AFTER DELETE ON page_text BEGIN "
+    "INSERT INTO page_text_fts(page_text_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS page_text_au AFTER UPDATE OF text ON page_text BEGIN "
+    "INSERT INTO page_text_fts(page_text_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO page_text_fts(rowid, text) VALUES (new.id, new.text); END",
+]
+for statement in PAGE_TEXT_FTS_DDL:
+    event.listen(PageText.__table__, "after_create", DDL(statement))
+event.listen(
+    PageText.__table__, "before_drop", DDL("DROP TABLE IF EXISTS page_text_fts")
+)
+
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=True)
+
+
+# Tables of the OCR job queue, which lives in a DB of its own shared by all processes
+JobBase = declarative_base()
+
+
+class Job(JobBase):
+    """A page to convert to markdown, see `job_queue`."""
+
+    __tablename__ = "job"
+    __table_args__ = (UniqueConstraint("pdf_hash", "prompt_hash", "model"),)
+
+    id = Column(Integer, primary_key=True)
+    pdf_hash = Column(String, nullable=False)  # Names the page's PDF in the blob dir
+    prompt = Column(String, nullable=False)
+    prompt_hash = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    status = Column(String, nullable=False, index=True)
+    worker = Column(String, nullable=True)
+    lease_expires = Column(Float, nullable=True)  # Unix time
+    finished_at = Column(Float, nullable=True)  # Unix time, once done or failed
+    attempts = Column(Integer, nullable=False, default=0)
+    result = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+
+
+class JobWorker(JobBase):
+    """Throughput of a process working on the job queue."""
+
+    __tablename__ = "job_worker"
+
+    name = Column(String, primary_key=True)
+    jobs_done = Column(Integer, nullable=False, default=0)
+    jobs_failed = Column(Integer, nullable=False, default=0)
+    busy_seconds = Column(Float, nullable=False, default=0.0)
+    last_seen = Column(Float, nullable=True)  # Unix time
 
 
 @dataclass(eq=True, frozen=True)
@@ -47,10 +139,45 @@ class RemarkableFile:
         return any([p.endswith(".pdf") for p in self.other_files])
 
 
-@dataclass(eq=True, frozen=True)
 class RemarkablePage:
-    uuid: str
-    hash: str
-    parent: RemarkableFile
-    page_idx: int
-    pdf_data: bytes
+    """A page of a document, identified by its own and its document's uuid.
+
+    The rendered PDF is kept in the blob store and only read when `pdf_data` is
+    accessed, so pages are cheap to hold, hash, and compare, whatever their size.
+    """
+
+    __slots__ = ("uuid", "hash", "parent", "page_idx", "_blob", "__weakref__")
+
+    def __init__(
+        self,
+        uuid: str,
+        hash: str,
+        parent: RemarkableFile,
+        page_idx: int,
+        pdf_data: bytes,
+    ):
+        self.uuid = uuid
+        self.hash = hash
+        self.parent = parent
+        self.page_idx = page_idx
+        self._blob = blob_store.store.put(pdf_data)
+        if isinstance(self._blob, Path):
+            weakref.finalize(self, blob_store.store.discard, self._blob)
+
+    @property
+    def pdf_data(self) -> bytes:
+        return blob_store.store.get(self._blob)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, RemarkablePage):
+            return NotImplemented
+        return self.uuid == other.uuid and self.parent.uuid == other.parent.uuid
+
+    def __hash__(self) -> int:
+        return hash((self.parent.uuid, self.uuid))
+
+    def __repr__(self) -> str:
+        return (
+            f"RemarkablePage(uuid={self.uuid!r}, page_idx={self.page_idx}, "
+            f"parent={self.parent.name!r})"
+        )
@@ -0,0 +1,283 @@
+import queue
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+from sqlalchemy.engine import Engine
+
+from . import db, job_queue, remarkable
+from . import doc_parsing as dp
+from . import file_sync as fs
+from .file_processing_config import ProcessingConfig
+from .metrics import Metrics
+from .models import RemarkableFile, RemarkablePage
+from .scheduler import CycleBudget, FairShare
+
+_STOP = object()
+
+
+class Stage[T]:
+    """A pool of worker threads processing items from a bounded queue.
+
+    Producers block when the queue is full, so a slow stage throttles the ones
+    feeding it instead of buffering unbounded amounts of rendered PDFs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[T], None],
+        workers: int,
+        queue_size: int,
+        on_error: Callable[[T], None] | None = None,
+    ):
+        self.name = name
+        self._func = func
+        self._on_error = on_error
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(max(workers, 1))
+        ]
+        self._lock = threading.Lock()
+        self._busy = 0.0
+        self._items = 0
+        self._max_depth = 0
+        self._started: float | None = None
+        self._elapsed = 0.0
+
+    def start(self):
+        self._started = time.perf_counter()
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, item: T):
+        self._queue.put(item)
+        with self._lock:
+            self._max_depth = max(self._max_depth, self._queue.qsize())
+
+    def close(self):
+        """Wait until all queued items are processed and stop the workers."""
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._elapsed = time.perf_counter() - self._started
+
+    def _work(self):
+        while (item := self._queue.get()) is not _STOP:
+            start = time.perf_counter()
+            try:
+                self._func(item)
+            except Exception:
+                logger.exception(f"Unhandled error in {self.name} stage")
+                if self._on_error is not None:
+                    self._on_error(item)
+            finally:
+                with self._lock:
+                    self._busy += time.perf_counter() - start
+                    self._items += 1
+
+    @property
+    def utilisation(self) -> float:
+        capacity = self._elapsed * len(self._threads)
+        return self._busy / capacity if capacity else 0.0
+
+    def report(self):
+        logger.info(
+            f"Stage {self.name}: {self._items} items, {len(self._threads)} workers, "
+            f"{self.utilisation:.0%} utilisation, max queue depth {self._max_depth}"
+        )
+        Metrics.increment(f"pipeline_{self.name}_items", self._items)
+        Metrics.set(f"pipeline_{self.name}_utilisation", round(self.utilisation, 3))
+        Metrics.set(f"pipeline_{self.name}_max_queue_depth", self._max_depth)
+
+
+@dataclass
+class DocumentResult:
+    file: RemarkableFile
+    pages: list[RemarkablePage]
+    to_convert: list[RemarkablePage]
+    rendered: dict[RemarkablePage, str] = field(default_factory=dict)
+    failed: set[RemarkablePage] = field(default_factory=set)
+    deferred: set[RemarkablePage] = field(default_factory=set)
+    pdf_path: Path | None = None
+    md_path: Path | None = None
+    checkpointed: bool = False
+    _remaining: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class SyncPipeline:
+    """Downloads and renders, converts, and saves documents concurrently.
+
+    Documents flow through three stages with their own worker pools: while one
+    document is being converted to markdown page by page, the next one can be
+    rendered, and a finished one saved. Rendering needs the tablet connection, so it
+    can be drained separately via `finish_rendering` to release the tablet early.
+
+    `on_saved` is called from the save stage for every document written to disk, so
+    progress can be checkpointed as it is made rather than at the end of the cycle.
+
+    Pages beyond the cycle's `budget` are deferred: not converted, and not recorded
+    as synced, so they're picked up again by a later cycle. For force-reprocessed
+    documents, pages in `forced_pass` were converted by an earlier cycle of the same
+    pass, and are skipped.
+
+    Documents that couldn't be rendered have no result, and are listed in
+    `failed_files` instead.
+
+    Without `retain_pages`, the pages and markdown of checkpointed documents are
+    dropped once saved, so memory use doesn't grow with the number of documents.
+
+    With `ocr_slots`, conversions wait for a slot shared with the pipelines of other
+    tablets, identified by `tablet`, which also keeps their templates apart.
+
+    With a `job_queue` engine, pages are converted by worker processes instead, see
+    `job_queue.convert`.
+    """
+
+    def __init__(
+        self,
+        client: remarkable.Source,
+        file_configs: dict[RemarkableFile, ProcessingConfig],
+        db_hashes: dict[str, str],
+        *,
+        render_workers: int,
+        ocr_workers: int,
+        save_workers: int,
+        queue_size: int,
+        on_saved: Callable[[DocumentResult], None] | None = None,
+        budget: CycleBudget | None = None,
+        retain_pages: bool = True,
+        ocr_slots: FairShare | None = None,
+        tablet: str = "",
+        job_queue: Engine | None = None,
+        forced_pass: dict[str, str] | None = None,
+    ):
+        self._job_queue = job_queue
+        self._forced_pass = forced_pass or {}
+        self._ocr_slots = ocr_slots
+        self._tablet = tablet
+        self._retain_pages = retain_pages
+        self._client = client
+        self._budget = budget if budget is not None else CycleBudget()
+        self._on_saved = on_saved
+        self._file_configs = file_configs
+        self._db_hashes = db_hashes
+        self._results: list[DocumentResult] = []
+        self._results_lock = threading.Lock()
+        self.failed_files: list[RemarkableFile] = []
+        self._render = Stage(
+            "render",
+            self._render_document,
+            render_workers,
+            queue_size,
+            on_error=self._render_failed,
+        )
+        self._ocr = Stage("ocr", self._convert_page, ocr_workers, queue_size)
+        self._save = Stage("save", self._save_document, save_workers, queue_size)
+        self._stages = [self._render, self._ocr, self._save]
+
+    def start(self):
+        for stage in self._stages:
+            stage.start()
+
+    def submit(self, file: RemarkableFile):
+        self._render.put(file)
+
+    def finish_rendering(self):
+        self._render.close()
+
+    def finish(self) -> list[DocumentResult]:
+        for stage in self._stages[1:]:
+            stage.close()
+        for stage in self._stages:
+            stage.report()
+        return self._results
+
+    def _render_document(self, file: RemarkableFile):
+        if self._budget.out_of_time():
+            logger.info(f"Deferring {file.name} to the next cycle")
+            return
+        pages = remarkable.render_pages(self._client, file, tablet=self._tablet)
+        if not pages:
+            self._render_failed(file)
+            return
+        config = self._file_configs[file]
+        to_convert = [
+            page
+            for page in db.pages_needing_update(
+                pages, self._file_configs, self._db_hashes, self._forced_pass
+            )
+            if dp.needs_conversion(page, config)
+        ]
+        granted = self._budget.reserve_pages(len(to_convert))
+        to_convert, deferred = to_convert[:granted], set(to_convert[granted:])
+        if deferred:
+            logger.info(f"Deferring {len(deferred)} pages of {file.name}")
+        doc = DocumentResult(
+            file=file,
+            pages=pages,
+            to_convert=to_convert,
+            deferred=deferred,
+            _remaining=len(to_convert),
+        )
+        if not to_convert:
+            self._save.put(doc)
+        for page in to_convert:
+            self._ocr.put((doc, page))
+
+    def _render_failed(self, file: RemarkableFile):
+        with self._results_lock:
+            self.failed_files.append(file)
+
+    def _convert_page(self, item: tuple[DocumentResult, RemarkablePage]):
+        doc, page = item
+        md = None
+        deferred = not self._budget.can_convert()
+        try:
+            if not deferred:
+                md = self._page_to_md(page, self._file_configs[doc.file])
+                deferred = md is None and not self._budget.can_convert()
+        finally:
+            with doc._lock:
+                if md:
+                    doc.rendered[page] = md
+                elif deferred:
+                    doc.deferred.add(page)
+                else:
+                    doc.failed.add(page)
+                doc._remaining -= 1
+                done = doc._remaining == 0
+            if done:
+                self._save.put(doc)
+
+    def _page_to_md(self, page: RemarkablePage, config: ProcessingConfig) -> str | None:
+        if self._ocr_slots is None:
+            return self._convert(page, config)
+        with self._ocr_slots.slot(self._tablet):
+            return self._convert(page, config)
+
+    def _convert(self, page: RemarkablePage, config: ProcessingConfig) -> str | None:
+        if self._job_queue is None:
+            return dp.page_to_md(page, config, self._budget)
+        return job_queue.convert(self._job_queue, page, config, self._budget)
+
+    def _save_document(self, doc: DocumentResult):
+        try:
+            _, paths = fs.save_to_disk(doc.pages, doc.rendered)
+            doc.pdf_path = paths[0]
+            if doc.rendered:
+                doc.md_path = fs.rendered_md_path(doc.file)
+            if self._on_saved is not None:
+                self._on_saved(doc)
+            doc.checkpointed = True
+            if not self._retain_pages:
+                doc.pages, doc.to_convert, doc.rendered = [], [], {}
+        finally:
+            with self._results_lock:
+                self._results.append(doc)
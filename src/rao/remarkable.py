@@ -1,9 +1,13 @@
 import json
+import os
 import re
+import shutil
 import stat
 import tempfile
+import threading
 from collections.abc import Iterator
 from contextlib import contextmanager
+from dataclasses import replace
 from datetime import datetime
 from hashlib import sha256
 from io import BytesIO
@@ -16,7 +20,8 @@ from paramiko import SFTPClient
 from pypdf import PageObject, PdfReader, PdfWriter
 from remarks.remarks import process_document
 
-from .config import Config
+from .config import Config, Tablet
+from .metrics import Metrics
 from .models import RemarkableFile, RemarkablePage
 
 FILES_ROOT = Path("/home/root/.local/share/remarkable/xochitl/")
@@ -28,10 +33,76 @@ TEMPLATE_CACHE_DIR = Path("/data/templates_cache")
 RENDER_TEMPLATES = True
 
 
+class _LocalSFTP:
+    """The subset of `paramiko.SFTPClient` used here, served from a local directory."""
+
+    def __init__(self, snapshot: "LocalSnapshot"):
+        self._snapshot = snapshot
+
+    def _local(self, remote_path: str) -> Path:
+        path = Path(remote_path)
+        for remote_root, local_root in [
+            (FILES_ROOT, self._snapshot.files_root),
+            (TEMPLATES_ROOT, self._snapshot.templates_root),
+        ]:
+            if path.is_relative_to(remote_root):
+                return local_root / path.relative_to(remote_root)
+        raise FileNotFoundError(remote_path)
+
+    def listdir_attr(self, path: str) -> list[paramiko.SFTPAttributes]:
+        return [
+            paramiko.SFTPAttributes.from_stat(entry.stat(), entry.name)
+            for entry in os.scandir(self._local(path))
+        ]
+
+    def listdir(self, path: str) -> list[str]:
+        return os.listdir(self._local(path))
+
+    def stat(self, path: str) -> os.stat_result:
+        return self._local(path).stat()
+
+    def open(self, path: str, mode: str = "rb"):
+        return self._local(path).open(mode)
+
+    def get(self, remote_path: str, local_path: str):
+        shutil.copyfile(self._local(remote_path), local_path)
+
+    def close(self):
+        pass
+
+
+class LocalSnapshot:
+    """Stands in for the tablet's SSH connection, reading from a local copy of its files.
+
+    `root` is either a copy of the tablet's xochitl directory, or a directory
+    containing such a copy at `xochitl/`, and optionally its templates at `templates/`.
+    Snapshots made by `mirror` use the latter layout.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        is_xochitl_copy = self.root.is_dir() and any(self.root.glob("*.metadata"))
+        self.files_root = self.root if is_xochitl_copy else self.root / "xochitl"
+        self.templates_root = self.root / "templates"
+
+    def open_sftp(self) -> _LocalSFTP:
+        return _LocalSFTP(self)
+
+    def close(self):
+        pass
+
+
+# Anything files can be listed and rendered from
+Source = paramiko.SSHClient | LocalSnapshot
+
+
 @contextmanager
-def connect(retries: int = 5) -> Iterator[paramiko.SSHClient | None]:
-    logger.info(f"Connecting to tablet at {Config.ssh_key_path}")
-    pk_file = Path(Config.ssh_key_path)
+def connect(
+    retries: int = 5, tablet: Tablet | None = None
+) -> Iterator[paramiko.SSHClient | None]:
+    tablet = tablet or Config.devices()[0]
+    logger.info(f"Connecting to tablet at {tablet.ssh_key_path}")
+    pk_file = Path(tablet.ssh_key_path)
     if not pk_file.exists():
         raise FileNotFoundError(pk_file)
     loader = (
@@ -45,7 +116,7 @@ def connect(retries: int = 5) -> Iterator[paramiko.SSHClient | None]:
     for i in range(retries):
         try:
             client.connect(
-                Config.remarkable_ip_address, username="root", pkey=pkey, timeout=5
+                tablet.remarkable_ip_address, username="root", pkey=pkey, timeout=5
             )
             connected = True
             break
@@ -55,26 +126,125 @@ def connect(retries: int = 5) -> Iterator[paramiko.SSHClient | None]:
             continue
 
     if not connected:
-        logger.warning(
-            f"Could not connect to Remarkable, trying again in {Config.check_interval} seconds"
-        )
+        logger.warning("Could not connect to Remarkable")
     try:
         yield client if connected else None
     finally:
         client.close()
 
 
-def get_files(
-    client: paramiko.SSHClient,
-) -> list[RemarkableFile]:
+def mirror(client: paramiko.SSHClient, snapshot: LocalSnapshot) -> int:
+    """Bring the snapshot up to date with the tablet. Returns the number of files copied.
+
+    Only files whose size or modification time differ are transferred, and modification
+    times are kept, so documents look the same whether listed from the tablet or the
+    snapshot. A document's directories are only compared file by file when its
+    `.metadata` changed, which the tablet rewrites on every edit.
+    """
+    logger.info(f"Mirroring tablet to {snapshot.files_root}")
+    sftp = client.open_sftp()
+    snapshot.files_root.mkdir(exist_ok=True, parents=True)
+    entries = [
+        attr
+        for attr in sftp.listdir_attr(str(FILES_ROOT))
+        if not attr.filename.endswith(".thumbnails")
+    ]
+    changed_docs = {
+        Path(attr.filename).stem
+        for attr in entries
+        if attr.filename.endswith(".metadata")
+        and not _is_mirrored(attr, snapshot.files_root / attr.filename)
+    }
+    copied = 0
+    for attr in entries:
+        local_path = snapshot.files_root / attr.filename
+        if stat.S_ISDIR(attr.st_mode):
+            if attr.filename.split(".")[0] in changed_docs or not local_path.is_dir():
+                copied += _mirror_dir(sftp, FILES_ROOT / attr.filename, local_path)
+        elif not _is_mirrored(attr, local_path):
+            _mirror_file(sftp, FILES_ROOT / attr.filename, local_path, attr)
+            copied += 1
+    _remove_unlisted(snapshot.files_root, {attr.filename for attr in entries})
+    copied += _mirror_dir(sftp, TEMPLATES_ROOT, snapshot.templates_root)
+    sftp.close()
+    logger.info(f"Copied {copied} changed files from tablet")
+    return copied
+
+
+def _is_mirrored(attr: paramiko.SFTPAttributes, local_path: Path) -> bool:
+    if not local_path.is_file():
+        return False
+    local = local_path.stat()
+    return local.st_size == attr.st_size and int(local.st_mtime) == int(attr.st_mtime)
+
+
+def _mirror_file(
+    sftp: SFTPClient, remote_path: Path, local_path: Path, attr: paramiko.SFTPAttributes
+):
+    tmp_path = local_path.with_name(local_path.name + ".tmp")
+    sftp.get(str(remote_path), str(tmp_path))
+    os.utime(tmp_path, (attr.st_mtime, attr.st_mtime))
+    tmp_path.replace(local_path)
+
+
+def _mirror_dir(sftp: SFTPClient, remote_dir: Path, local_dir: Path) -> int:
+    if local_dir.exists() and not local_dir.is_dir():
+        local_dir.unlink()
+    local_dir.mkdir(exist_ok=True)
+    copied = 0
+    entries = sftp.listdir_attr(str(remote_dir))
+    for attr in entries:
+        local_path = local_dir / attr.filename
+        if stat.S_ISDIR(attr.st_mode):
+            copied += _mirror_dir(sftp, remote_dir / attr.filename, local_path)
+        elif not _is_mirrored(attr, local_path):
+            _mirror_file(sftp, remote_dir / attr.filename, local_path, attr)
+            copied += 1
+    _remove_unlisted(local_dir, {attr.filename for attr in entries})
+    return copied
+
+
+def _remove_unlisted(local_dir: Path, names: set[str]):
+    """Delete what's no longer on the tablet from a snapshot directory."""
+    for path in local_dir.iterdir():
+        if path.name in names:
+            continue
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+
+def list_files(client: Source) -> pd.DataFrame:
     logger.info("Fetching file list from remarkable ...")
     sftp = client.open_sftp()
     files_df = pd.DataFrame(
         [attr.__dict__ for attr in sftp.listdir_attr(str(FILES_ROOT))]
     )
+    sftp.close()
+    return files_df
+
+
+def library_fingerprint(files_df: pd.DataFrame) -> str:
+    """Cheap hash over the names, sizes, and mtimes of all files on the tablet."""
+    digest = sha256()
+    if files_df.empty:
+        return digest.hexdigest()
+    listing = files_df.sort_values("filename")[["filename", "st_size", "st_mtime"]]
+    for filename, size, mtime in listing.itertuples(index=False):
+        digest.update(f"{filename}\0{size}\0{mtime}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_files(
+    client: Source, files_df: pd.DataFrame, namespace: str = ""
+) -> list[RemarkableFile]:
+    """Documents on the tablet, with paths prefixed by `namespace` if given."""
+    logger.info("Loading metadata files from remarkable ...")
+    sftp = client.open_sftp()
     files = _load_metadata_files(sftp, files_df)
     files = [
-        file
+        replace(file, path=Path(namespace) / file.path) if namespace else file
         for file in files
         if file.type == "DocumentType" and file.parent_uuid != "trash"
     ]
@@ -137,11 +307,25 @@ def _load_file_paths(
     return paths
 
 
+def count_pages(client: Source, files: list[RemarkableFile]) -> dict[str, int]:
+    """Number of pages of each document by uuid, read from the `.content` files."""
+    sftp = client.open_sftp()
+    counts = {}
+    for file in files:
+        try:
+            with sftp.open(str(FILES_ROOT / f"{file.uuid}.content")) as content_file:
+                pages, _ = _load_pages_and_templates(json.loads(content_file.read()))
+        except (OSError, ValueError, KeyError):
+            pages = []
+        counts[file.uuid] = len(pages)
+    sftp.close()
+    return counts
+
+
 def render_pages(
-    client: paramiko.SSHClient, metadata_file: RemarkableFile
+    client: Source, metadata_file: RemarkableFile, tablet: str = ""
 ) -> list[RemarkablePage]:
     logger.info(f"Rendering pages for file {metadata_file.name}")
-    TEMPLATE_CACHE_DIR.mkdir(exist_ok=True, parents=True)
     sftp = client.open_sftp()
     with tempfile.TemporaryDirectory() as tmpdir:
         tmpdir = Path(tmpdir)
@@ -157,7 +341,9 @@ def render_pages(
             return []
         pages, templates_per_page = _load_pages_and_templates(content_file)
         template_paths = (
-            _download_templates(templates_per_page, sftp) if RENDER_TEMPLATES else None
+            _download_templates(templates_per_page, sftp, tablet)
+            if RENDER_TEMPLATES
+            else None
         )
         output_path = tmpdir / "rendered"
         try:
@@ -206,15 +392,123 @@ def _download_files(
     return file_paths
 
 
+class TemplateCache:
+    """The tablet's page templates, downloaded once and shared by all documents and workers.
+
+    Templates are stored by content hash, and looked up by tablet, name, size, and
+    modification time on the tablet, so templates changed by a firmware update are
+    downloaded again, and tablets on different firmware don't evict each other's.
+    The sizes and modification times come from one listing of the tablet's templates,
+    kept until `forget_listings`, e.g. once per sync cycle.
+    """
+
+    def __init__(self, root: Path):
+        self._root = root
+        self._lock = threading.Lock()
+        self._known: dict[str, tuple[int, int, str]] | None = None
+        self._listings: dict[str, dict[str, tuple[int, int]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def _index_path(self) -> Path:
+        return self._root / "index.json"
+
+    def get(self, template: str, sftp: SFTPClient, tablet: str = "") -> Path | None:
+        remote_path = str(TEMPLATES_ROOT / f"{template}.svg")
+        key = f"{tablet}/{template}" if tablet else template
+        version = self._listing(sftp, tablet).get(template)
+        if version is None:
+            logger.warning(f"Template {template} not found, rendering without it")
+            return None
+        with self._lock:
+            known = self._load_index().get(key)
+        if known is not None and tuple(known[:2]) == version:
+            path = self._path(known[2], template)
+            if path.exists():
+                self._count(hit=True)
+                return path
+        self._count(hit=False)
+        digest = self._download(template, remote_path, sftp)
+        with self._lock:
+            self._load_index()[key] = (*version, digest)
+            self._save_index()
+        return self._path(digest, template)
+
+    def forget_listings(self):
+        """List the tablets' templates again on the next lookup."""
+        with self._lock:
+            self._listings.clear()
+
+    def _listing(self, sftp: SFTPClient, tablet: str) -> dict[str, tuple[int, int]]:
+        """Template name -> (size, modification time) on the tablet."""
+        with self._lock:
+            listing = self._listings.get(tablet)
+        if listing is None:
+            try:
+                entries = sftp.listdir_attr(str(TEMPLATES_ROOT))
+            except FileNotFoundError:
+                entries = []
+            listing = {
+                entry.filename.removesuffix(".svg"): (
+                    entry.st_size,
+                    int(entry.st_mtime),
+                )
+                for entry in entries
+                if entry.filename.endswith(".svg")
+            }
+            with self._lock:
+                self._listings[tablet] = listing
+        return listing
+
+    def _path(self, digest: str, template: str) -> Path:
+        return self._root / digest / f"{template}.svg"
+
+    def _download(self, template: str, remote_path: str, sftp: SFTPClient) -> str:
+        self._root.mkdir(exist_ok=True, parents=True)
+        tmp_path = self._root / f".{template}.{threading.get_ident()}.tmp"
+        sftp.get(remote_path, str(tmp_path))
+        digest = sha256(tmp_path.read_bytes()).hexdigest()
+        path = self._path(digest, template)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path.replace(path)
+        return digest
+
+    def _load_index(self) -> dict[str, tuple[int, int, str]]:
+        if self._known is None:
+            self._known = (
+                json.loads(self._index_path.read_text())
+                if self._index_path.exists()
+                else {}
+            )
+        return self._known
+
+    def _save_index(self):
+        tmp_path = self._index_path.with_name(self._index_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self._known))
+        tmp_path.replace(self._index_path)
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            hit_rate = self.hits / (self.hits + self.misses)
+        Metrics.increment("template_cache_hits" if hit else "template_cache_misses")
+        Metrics.set("template_cache_hit_rate", round(hit_rate, 3))
+
+
+template_cache = TemplateCache(TEMPLATE_CACHE_DIR)
+
+
 def _download_templates(
-    templates_per_page: dict[str, str], sftp: SFTPClient
+    templates_per_page: dict[str, str], sftp: SFTPClient, tablet: str = ""
 ) -> dict[str, Path]:
     downloaded = {}
-    for page, template in templates_per_page.items():
-        target_path = TEMPLATE_CACHE_DIR / (template + ".svg")
-        if not target_path.exists():
-            sftp.get(str(TEMPLATES_ROOT / target_path.name), str(target_path))
-        downloaded[target_path.stem] = target_path
+    for template in set(templates_per_page.values()):
+        if path := template_cache.get(template, sftp, tablet):
+            downloaded[template] = path
     return downloaded
 
 
@@ -0,0 +1,220 @@
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from enum import Enum
+
+from loguru import logger
+
+from .config import Config, Seconds
+from .file_processing_config import ProcessingConfig
+from .metrics import Metrics
+from .models import RemarkableFile
+
+
+class CycleOutcome(Enum):
+    CHANGED = "changed"  # Files were synced, the tablet is likely being written on
+    IDLE = "idle"  # Nothing to sync
+    OFFLINE = "offline"  # Couldn't connect to the tablet
+    FAILED = "failed"  # Sync raised an error
+
+
+class AdaptiveScheduler:
+    """Decides how long to wait before the next sync cycle.
+
+    Polls every `min_check_interval` seconds while the tablet is being edited, and
+    backs off exponentially from `check_interval` up to `max_check_interval` while
+    it is idle or unreachable. While the tablet is reachable, the wait never pushes
+    the next check past `max_staleness` seconds after the last successful check.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._last_success = clock()
+        self._backoff: Seconds | None = None
+        self._offline_streak = 0
+        self.interval: Seconds = 0
+        self.reason = "startup"
+
+    @property
+    def connect_retries(self) -> int:
+        """Don't wait for several connection timeouts if the tablet was already offline."""
+        return 1 if self._offline_streak else 5
+
+    def next_interval(self, outcome: CycleOutcome) -> Seconds:
+        now = self._clock()
+        if outcome in [CycleOutcome.CHANGED, CycleOutcome.IDLE]:
+            self._last_success = now
+        self._offline_streak = (
+            self._offline_streak + 1 if outcome == CycleOutcome.OFFLINE else 0
+        )
+
+        if outcome == CycleOutcome.CHANGED:
+            self._backoff = None
+            interval, reason = Config.min_check_interval, "recent edits"
+        else:
+            self._backoff = (
+                Config.check_interval
+                if self._backoff is None
+                else min(self._backoff * 2, Config.max_check_interval)
+            )
+            interval, reason = self._backoff, f"{outcome.value}, backing off"
+
+        # Offline or failing, checking sooner wouldn't make the outputs any fresher
+        staleness_budget = self._last_success + Config.max_staleness - now
+        succeeded = outcome in [CycleOutcome.CHANGED, CycleOutcome.IDLE]
+        if succeeded and interval > staleness_budget:
+            interval = max(Config.min_check_interval, int(staleness_budget))
+            reason = "max staleness"
+
+        self.interval, self.reason = interval, reason
+        logger.info(f"Next sync in {interval} seconds ({reason})")
+        Metrics.set("check_interval", interval)
+        Metrics.set("schedule_reason", reason)
+        Metrics.increment(f"cycles_{outcome.value}")
+        return interval
+
+
+class CycleBudget:
+    """Limits how much work a single sync cycle takes on.
+
+    Whatever doesn't fit into the budget is left for later cycles, so that a large
+    backlog can't hold up recent edits for hours. Thread-safe, as it's shared by the
+    pipeline's workers.
+    """
+
+    def __init__(
+        self,
+        max_pages: int | None = None,
+        max_api_calls: int | None = None,
+        max_seconds: Seconds | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._max_pages = max_pages
+        self._max_api_calls = max_api_calls
+        self._clock = clock
+        self._deadline = clock() + max_seconds if max_seconds is not None else None
+        self._lock = threading.Lock()
+        self.pages = 0
+        self.api_calls = 0
+        self.exhausted_reason: str | None = None
+
+    @classmethod
+    def from_config(cls) -> "CycleBudget":
+        return cls(
+            max_pages=Config.max_pages_per_cycle,
+            max_api_calls=Config.max_api_calls_per_cycle,
+            max_seconds=Config.max_cycle_seconds,
+        )
+
+    def out_of_time(self) -> bool:
+        if self._deadline is not None and self._clock() >= self._deadline:
+            self._exhaust("time")
+            return True
+        return False
+
+    def can_convert(self) -> bool:
+        """Whether there's time and API calls left to convert another page."""
+        with self._lock:
+            calls_left = (
+                self._max_api_calls is None or self.api_calls < self._max_api_calls
+            )
+        return calls_left and not self.out_of_time()
+
+    def reserve_pages(self, n: int) -> int:
+        """Reserve up to `n` pages to convert. Returns how many were granted."""
+        if self.out_of_time():
+            return 0
+        with self._lock:
+            granted = n
+            if self._max_pages is not None:
+                granted = max(min(n, self._max_pages - self.pages), 0)
+            self.pages += granted
+        if granted < n:
+            self._exhaust("pages")
+        return granted
+
+    def spend_api_call(self) -> bool:
+        if self.out_of_time():
+            return False
+        with self._lock:
+            if (
+                self._max_api_calls is not None
+                and self.api_calls >= self._max_api_calls
+            ):
+                allowed = False
+            else:
+                self.api_calls += 1
+                allowed = True
+        if not allowed:
+            self._exhaust("API calls")
+        return allowed
+
+    def _exhaust(self, reason: str):
+        with self._lock:
+            if self.exhausted_reason is not None:
+                return
+            self.exhausted_reason = reason
+        logger.warning(f"Cycle budget for {reason} used up, deferring remaining work")
+
+    def report(self):
+        Metrics.set("budget_pages_used", self.pages)
+        Metrics.set("budget_api_calls_used", self.api_calls)
+        Metrics.set("budget_exhausted", self.exhausted_reason or "")
+
+
+def prioritise(
+    files: list[RemarkableFile], file_configs: dict[RemarkableFile, ProcessingConfig]
+) -> list[RemarkableFile]:
+    """Order files by their rule's priority, then most recently edited first."""
+    return sorted(
+        files,
+        key=lambda file: (
+            -file_configs[file].priority,
+            -file.last_modified.timestamp(),
+        ),
+    )
+
+
+class FairShare:
+    """Shares a number of concurrent slots, e.g. for OCR requests, between tablets.
+
+    While several tablets are waiting, slots are handed out to them in turn, so one
+    tablet's backlog can't starve the others.
+    """
+
+    def __init__(self, slots: int):
+        self._slots = max(slots, 1)
+        self._in_use = 0
+        self._waiting: dict[str, int] = {}
+        self._turns: deque[str] = deque()
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, tablet: str) -> Iterator[None]:
+        self._acquire(tablet)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _acquire(self, tablet: str):
+        with self._condition:
+            self._waiting[tablet] = self._waiting.get(tablet, 0) + 1
+            if tablet not in self._turns:
+                self._turns.append(tablet)
+            self._condition.wait_for(
+                lambda: self._in_use < self._slots and self._turns[0] == tablet
+            )
+            self._in_use += 1
+            self._waiting[tablet] -= 1
+            self._turns.popleft()
+            if self._waiting[tablet]:
+                self._turns.append(tablet)
+            self._condition.notify_all()
+
+    def _release(self):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify_all()
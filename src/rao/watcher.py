@@ -0,0 +1,243 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import socket
+import struct
+import threading
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from .config import CONFIG_PATH, Config
+from .metrics import Metrics
+
+# Batches of file events (e.g. an editor's write + rename) are coalesced into one sync
+DEBOUNCE_SECONDS = 1.0
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_WATCH_MASK = (
+    _IN_MODIFY
+    | _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+)
+_IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class SyncTrigger:
+    """Cuts the sleep between sync cycles short, e.g. when the inputs change."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._reasons: list[str] = []
+
+    def fire(self, reason: str):
+        with self._lock:
+            if reason not in self._reasons:
+                self._reasons.append(reason)
+        self._event.set()
+
+    def wait(self, timeout: float) -> list[str]:
+        """Sleep for up to `timeout` seconds. Returns why it was woken early, if it was."""
+        if not self._event.wait(timeout):
+            return []
+        time.sleep(DEBOUNCE_SECONDS)
+        with self._lock:
+            reasons, self._reasons = self._reasons, []
+            self._event.clear()
+        Metrics.increment("cycles_triggered")
+        return reasons
+
+
+class TriggerGroup:
+    """Fires several triggers at once, e.g. one per tablet."""
+
+    def __init__(self, triggers: list[SyncTrigger]):
+        self._triggers = triggers
+
+    def fire(self, reason: str):
+        for trigger in self._triggers:
+            trigger.fire(reason)
+
+
+def start(trigger: SyncTrigger | TriggerGroup):
+    """Start everything that can trigger a sync ahead of schedule."""
+    relay = SignalRelay(trigger)
+    signal.signal(signal.SIGHUP, relay.on_signal)
+    relay.start()
+    if Config.watch_inputs:
+        InputWatcher(trigger).start()
+    if Config.control_socket_path:
+        ControlServer(trigger, Path(Config.control_socket_path)).start()
+
+
+class SignalRelay(threading.Thread):
+    """Fires the trigger when the process receives a signal, e.g. SIGHUP.
+
+    Signal handlers run in the main thread, possibly while it holds the trigger's lock
+    in `SyncTrigger.wait`, so the handler only writes to a pipe, and this thread fires
+    the trigger.
+    """
+
+    def __init__(self, trigger: SyncTrigger | TriggerGroup):
+        super().__init__(name="signal-relay", daemon=True)
+        self._trigger = trigger
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._write_fd, False)
+
+    def on_signal(self, signum: int, _frame=None):
+        try:
+            os.write(self._write_fd, bytes([signum]))
+        except BlockingIOError:
+            pass  # Plenty of signals pending already
+
+    def run(self):
+        while data := os.read(self._read_fd, 64):
+            for signum in dict.fromkeys(data):
+                self._trigger.fire(signal.Signals(signum).name)
+
+
+def _input_files() -> set[Path]:
+    paths = [CONFIG_PATH, Config.whitelist_path, Config.blacklist_path]
+    return {Path(path) for path in paths if path}
+
+
+def _is_input(path: Path) -> bool:
+    prompts_dir = Path(Config.prompts_dir)
+    return path in _input_files() or (
+        prompts_dir in path.parents and path.suffix == ".txt"
+    )
+
+
+class InputWatcher(threading.Thread):
+    """Fires the trigger when `config.toml`, the white-/blacklist, or any prompt changes.
+
+    Uses inotify where available, and falls back to polling file stats otherwise.
+    """
+
+    def __init__(self, trigger: SyncTrigger | TriggerGroup):
+        super().__init__(name="input-watcher", daemon=True)
+        self._trigger = trigger
+        self._watches: dict[int, Path] = {}
+
+    def run(self):
+        try:
+            fd = self._inotify_init()
+        except OSError as e:
+            logger.warning(f"inotify unavailable ({e}), polling for input changes")
+            self._poll()
+            return
+        logger.info("Watching inputs for changes using inotify")
+        self._watch(fd)
+
+    def _watched_dirs(self) -> set[Path]:
+        dirs = {path.parent for path in _input_files()}
+        prompts_dir = Path(Config.prompts_dir)
+        if prompts_dir.exists():
+            dirs.add(prompts_dir)
+            dirs |= {path for path in prompts_dir.rglob("*") if path.is_dir()}
+        return {path for path in dirs if path.exists()}
+
+    def _inotify_init(self) -> int:
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return fd
+
+    def _add_watches(self, fd: int):
+        for path in self._watched_dirs() - set(self._watches.values()):
+            wd = self._libc.inotify_add_watch(fd, str(path).encode(), _IN_WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = path
+
+    def _watch(self, fd: int):
+        while True:
+            self._add_watches(fd)
+            ready, _, _ = select.select([fd], [], [], Config.watch_poll_interval)
+            if not ready:
+                continue
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0").decode()
+                offset += length
+                if wd in self._watches and _is_input(self._watches[wd] / name):
+                    self._trigger.fire(f"{self._watches[wd] / name} changed")
+
+    def _poll(self):
+        last = self._stamps()
+        while True:
+            time.sleep(Config.watch_poll_interval)
+            current = self._stamps()
+            for path in current.keys() | last.keys():
+                if current.get(path) != last.get(path):
+                    self._trigger.fire(f"{path} changed")
+            last = current
+
+    def _stamps(self) -> dict[Path, tuple[int, int]]:
+        paths = set(_input_files())
+        prompts_dir = Path(Config.prompts_dir)
+        if prompts_dir.exists():
+            paths |= set(prompts_dir.rglob("*.txt"))
+        stamps = {}
+        for path in paths:
+            if path.exists():
+                stat = path.stat()
+                stamps[path] = (stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+
+class ControlServer(threading.Thread):
+    """Local unix socket accepting commands, e.g. `sync` to force an immediate cycle."""
+
+    def __init__(self, trigger: SyncTrigger | TriggerGroup, socket_path: Path):
+        super().__init__(name="control-server", daemon=True)
+        self._trigger = trigger
+        self._socket_path = socket_path
+
+    def run(self):
+        self._socket_path.unlink(missing_ok=True)
+        self._socket_path.parent.mkdir(exist_ok=True, parents=True)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(self._socket_path))
+            server.listen()
+            logger.info(f"Listening for commands on {self._socket_path}")
+            while True:
+                conn, _ = server.accept()
+                with conn:
+                    try:
+                        command = conn.recv(1024).decode().strip()
+                        conn.sendall(self._run_command(command).encode() + b"\n")
+                    except OSError as e:
+                        logger.warning(f"Failed to handle control command: {e}")
+
+    def _run_command(self, command: str) -> str:
+        if command == "sync":
+            self._trigger.fire("sync requested")
+            return "ok"
+        return f"unknown command: {command}"
+
+
+def send_command(command: str, socket_path: Path) -> str:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        client.sendall(command.encode() + b"\n")
+        return client.recv(1024).decode().strip()
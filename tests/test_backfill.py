@@ -0,0 +1,53 @@
+# tests/test_backfill.py
+from collections.abc import Callable
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from rao.backfill import BackfillEstimate, BackfillProgress, estimate
+from rao.file_processing_config import ProcessingConfig
+from rao.models import RemarkableFile
+from rao.pipeline import DocumentResult
+
+
+@patch("rao.backfill.remarkable.count_pages")
+def test_estimate(
+    mock_count_pages: MagicMock, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    notes, sketch = files(2)
+    mock_count_pages.return_value = {notes.uuid: 100, sketch.uuid: 20}
+    configs = {
+        notes: ProcessingConfig(pdf_only=False, force_reprocess=False, prompt="p"),
+        sketch: ProcessingConfig(pdf_only=True, force_reprocess=False, prompt="p"),
+    }
+
+    # When
+    plan = estimate(MagicMock(), [notes, sketch], configs)
+
+    # Then
+    assert plan == BackfillEstimate(documents=2, pages=120, api_calls=100)
+    assert plan.duration == timedelta(minutes=100 / 60)
+
+
+def test_backfill_progress(files: Callable[[int], list[RemarkableFile]]):
+    # Given
+    (file,) = files(1)
+    now = 0.0
+    progress = BackfillProgress(
+        BackfillEstimate(documents=2, pages=20, api_calls=20), clock=lambda: now
+    )
+    doc = DocumentResult(
+        file=file,
+        pages=[MagicMock()] * 10,
+        to_convert=[],
+        rendered={MagicMock(): "md" for _ in range(10)},
+    )
+
+    # When
+    now = 60.0
+    progress.document_done(doc)
+
+    # Then
+    assert progress.documents == 1
+    assert progress.pages == 10
+    assert progress.converted == 10
@@ -0,0 +1,44 @@
+# tests/test_blob_store.py
+import gc
+from collections.abc import Callable
+from pathlib import Path
+from unittest.mock import patch
+
+from rao.blob_store import BlobStore
+from rao.models import RemarkableFile, RemarkablePage
+
+
+def test_blob_store_spills_large_blobs(tmp_path: Path):
+    store = BlobStore(root=tmp_path, inline_limit=4)
+
+    small = store.put(b"abc")
+    large = store.put(b"a" * 100)
+
+    assert small == b"abc"
+    assert isinstance(large, Path) and large.parent == tmp_path
+    assert store.get(small) == b"abc"
+    assert store.get(large) == b"a" * 100
+    store.discard(large)
+    assert not large.exists()
+
+
+def test_page_payload_lives_in_blob_store(
+    tmp_path: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (file,) = files(1)
+    with patch("rao.blob_store.store", new=BlobStore(root=tmp_path, inline_limit=4)):
+        page = RemarkablePage(
+            uuid="p1", hash="h1", parent=file, page_idx=0, pdf_data=b"x" * 100
+        )
+        same_page = RemarkablePage(
+            uuid="p1", hash="h2", parent=file, page_idx=0, pdf_data=b"y" * 100
+        )
+
+        # When/Then
+        assert page.pdf_data == b"x" * 100
+        assert page == same_page and hash(page) == hash(same_page)
+        assert len(list(tmp_path.iterdir())) == 2
+        del page, same_page
+        gc.collect()
+        assert not list(tmp_path.iterdir())
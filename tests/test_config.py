@@ -1,11 +1,12 @@
 # tests/test_config.py
+import threading
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
 import pytest
 import tomllib
 
-from rao.config import ConfigLoadError, _Config
+from rao.config import ConfigLoadError, Tablet, _Config
 
 
 # Mock the tomllib.load function
@@ -80,3 +81,80 @@ def test_config_reload_success(mock_tomllib_load):
     # Assert that the config values are loaded correctly
     assert config.google_api_key == "test_key"
     assert config.default_prompt == "new_prompt"
+
+
+@patch("tomllib.load")
+def test_config_tablets(mock_tomllib_load: MagicMock):
+    # Given
+    mock_tomllib_load.return_value = {
+        "remarkable-auto-ocr-app": {
+            "ssh_key_path": "shared_key",
+            "tablets": [
+                {"name": "alice", "remarkable_ip_address": "ip1"},
+                {"name": "bob", "remarkable_ip_address": "ip2", "ssh_key_path": "key"},
+            ],
+        }
+    }
+
+    # When
+    config = _Config()
+    config.reload()
+
+    # Then
+    assert config.devices() == [
+        Tablet(name="alice", remarkable_ip_address="ip1", ssh_key_path="shared_key"),
+        Tablet(name="bob", remarkable_ip_address="ip2", ssh_key_path="key"),
+    ]
+
+
+@patch("tomllib.load")
+def test_config_single_tablet(mock_tomllib_load: MagicMock):
+    mock_tomllib_load.return_value = {
+        "remarkable-auto-ocr-app": {
+            "remarkable_ip_address": "ip",
+            "ssh_key_path": "key",
+        }
+    }
+    config = _Config()
+    config.reload()
+    assert config.devices() == [
+        Tablet(name="", remarkable_ip_address="ip", ssh_key_path="key")
+    ]
+
+
+@patch("tomllib.load")
+def test_config_duplicate_tablets(mock_tomllib_load: MagicMock):
+    mock_tomllib_load.return_value = {
+        "remarkable-auto-ocr-app": {
+            "tablets": [
+                {"name": "alice", "remarkable_ip_address": "ip1"},
+                {"name": "alice", "remarkable_ip_address": "ip2"},
+            ],
+        }
+    }
+    with pytest.raises(ConfigLoadError):
+        _Config().reload()
+
+
+@patch("tomllib.load")
+def test_config_concurrent_reloads_keep_unchanged_values(mock_tomllib_load: MagicMock):
+    # Given
+    mock_tomllib_load.return_value = {
+        "remarkable-auto-ocr-app": {
+            "tablets": [{"name": "alice", "remarkable_ip_address": "ip1"}],
+        }
+    }
+    config = _Config()
+    config.reload()
+    tablets = config.tablets
+
+    # When
+    threads = [threading.Thread(target=config.reload) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Then
+    assert config.tablets is tablets  # Not replaced, not even briefly
+    assert mock_tomllib_load.call_count == 5
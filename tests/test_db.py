@@ -1,14 +1,19 @@
+import sqlite3
+import time
 from collections.abc import Callable
+from contextlib import closing
+from dataclasses import replace
 from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, insert, inspect, text
 from sqlalchemy.orm import Session
 
 from rao import db
 from rao.file_processing_config import ProcessingConfig
-from rao.models import Base, RemarkableFile
+from rao.models import Base, Metadata, Page, RemarkableFile, RemarkablePage
 
 
 @patch("rao.db.Base")
@@ -26,7 +31,44 @@ def test_get_engine(
 
     # Then
     assert engine.url.database == str(db_dir / "db.sqlite")
-    mock_base.metadata.create_all.assert_called_once_with(engine)
+    assert not engine.echo
+    mock_base.metadata.create_all.assert_called_once()
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+
+@patch("rao.db.DB_CACHE_PATH")
+def test_get_engine_migrates_legacy_db(mock_db_cache_path: MagicMock, tmp_path: Path):
+    # Given
+    db_path = tmp_path / "db.sqlite"
+    mock_db_cache_path.__str__.return_value = str(db_path)
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.executescript(
+            """
+            CREATE TABLE metadata (
+                uuid VARCHAR PRIMARY KEY, visible_name VARCHAR,
+                last_modified DATETIME, parent_uuid VARCHAR, type VARCHAR,
+                prompt_hash VARCHAR
+            );
+            CREATE TABLE page (
+                uuid VARCHAR PRIMARY KEY, hash VARCHAR,
+                parent_uuid VARCHAR REFERENCES metadata (uuid)
+            );
+            """
+        )
+
+    # When
+    engine = db.get_engine()
+    db.get_engine()  # Migrations are only applied once
+
+    # Then
+    inspector = inspect(engine)
+    assert "path" in {c["name"] for c in inspector.get_columns("metadata")}
+    assert "ix_page_parent_uuid" in {i["name"] for i in inspector.get_indexes("page")}
+    assert "page_text_fts" in inspector.get_table_names()
+    with engine.connect() as conn:
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+    assert version == len(db.SCHEMA_MIGRATIONS)
 
 
 def test_out_of_sync_files(
@@ -48,7 +90,7 @@ def test_out_of_sync_files(
     session.commit()
 
     # When
-    out_of_sync = db.out_of_sync_files(file_configs, engine)
+    out_of_sync = db.out_of_sync_files(file_configs, session=session)
 
     # Then
     assert len(out_of_sync) == 3
@@ -57,3 +99,300 @@ def test_out_of_sync_files(
     assert any(f.uuid == "uuid2" for f in out_of_sync)
 
     Base.metadata.drop_all(engine)  # Cleanup
+
+
+def _pages_for(file: RemarkableFile, n: int) -> list[RemarkablePage]:
+    return [
+        RemarkablePage(
+            uuid=f"{file.uuid}-page{i}",
+            hash=f"hash{i}",
+            parent=file,
+            page_idx=i,
+            pdf_data=b"",
+        )
+        for i in range(n)
+    ]
+
+
+def test_pages_needing_update(
+    files_and_configs: Callable[[int], dict[RemarkableFile, ProcessingConfig]],
+):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = Session(bind=engine)
+
+    files, configs, meta = files_and_configs(2)
+    file_configs = {f: c for f, c in zip(files, configs)}
+    configs[1].force_reprocess = True
+    pages = _pages_for(files[0], 3) + _pages_for(files[1], 1)
+
+    session.add_all(meta)
+    session.add(Page(uuid=pages[0].uuid, hash=pages[0].hash, parent_uuid="uuid0"))
+    session.add(Page(uuid=pages[1].uuid, hash="stale", parent_uuid="uuid0"))
+    session.add(Page(uuid=pages[3].uuid, hash=pages[3].hash, parent_uuid="uuid1"))
+    session.commit()
+
+    # When
+    db_hashes = db.page_hashes_for_files(files, session=session)
+    out_of_sync = db.pages_needing_update(pages, file_configs, db_hashes)
+
+    # Then
+    assert {p.uuid for p in out_of_sync} == {
+        pages[1].uuid,  # Hash changed
+        pages[2].uuid,  # Not in DB yet
+        pages[3].uuid,  # Force reprocess
+    }
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_pages_needing_update_100k(
+    files_and_configs: Callable[[int], dict[RemarkableFile, ProcessingConfig]],
+):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    files, configs, meta = files_and_configs(1)
+    file_configs = {files[0]: configs[0]}
+    pages = _pages_for(files[0], 100_000)
+    with Session(bind=engine) as session:
+        session.add_all(meta)
+        session.execute(
+            insert(Page),
+            [
+                {"uuid": p.uuid, "hash": p.hash, "parent_uuid": "uuid0"}
+                for p in pages[::2]
+            ],
+        )
+        session.commit()
+
+    # When
+    start = time.perf_counter()
+    with db.session_scope(engine) as session:
+        db_hashes = db.page_hashes_for_files(files, session=session)
+    out_of_sync = db.pages_needing_update(pages, file_configs, db_hashes)
+    elapsed = time.perf_counter() - start
+
+    # Then
+    assert len(out_of_sync) == 50_000
+    assert elapsed < 30, f"Diffing 100k pages took {elapsed:.1f}s"
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_mark_as_synced_upserts(
+    files_and_configs: Callable[[int], dict[RemarkableFile, ProcessingConfig]],
+):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    files, configs, meta = files_and_configs(2)
+    file_configs = {f: c for f, c in zip(files, configs)}
+    pages = _pages_for(files[0], 2)
+    with db.session_scope(engine) as session:
+        session.add(meta[0])
+        session.add(Page(uuid=pages[0].uuid, hash="stale", parent_uuid="uuid0"))
+        session.add(Page(uuid="deleted", hash="deleted", parent_uuid="uuid0"))
+
+    # When
+    with db.session_scope(engine) as session:
+        db.mark_as_synced(
+            {files[0]: pages, files[1]: []}, file_configs, session=session
+        )
+
+    # Then
+    with Session(bind=engine) as session:
+        assert {m.uuid: m.visible_name for m in session.query(Metadata)} == {
+            "uuid0": "file0",
+            "uuid1": "file1",
+        }
+        assert {p.uuid: p.hash for p in session.query(Page)} == {
+            pages[0].uuid: pages[0].hash,
+            pages[1].uuid: pages[1].hash,
+        }
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_collect_garbage(
+    files_and_configs: Callable[[int], dict[RemarkableFile, ProcessingConfig]],
+):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    files, _, meta = files_and_configs(3)
+    for m, f in zip(meta, files):
+        m.path = str(f.path)
+    meta[1].path = "old/file1"  # Moved since last sync
+    with db.session_scope(engine) as session:
+        session.add_all(meta)
+        session.add(Page(uuid="page0", hash="hash", parent_uuid="uuid0"))
+        session.add(Page(uuid="page2", hash="hash", parent_uuid="uuid2"))
+
+    # When
+    with db.session_scope(engine) as session:
+        stale = db.collect_garbage(files[:2], session=session)
+
+    # Then
+    assert set(stale) == {Path("old/file1"), Path("file2")}
+    assert not db.gc_due(engine)
+    assert db.gc_due(create_engine("sqlite:///other-tablet.sqlite"))
+    with Session(bind=engine) as session:
+        assert {m.uuid for m in session.query(Metadata)} == {"uuid0", "uuid1"}
+        assert {p.uuid for p in session.query(Page)} == {"page0"}
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_sync_state():
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+
+    # When
+    with db.session_scope(engine) as session:
+        missing = db.get_sync_state("key", session=session)
+        db.set_sync_state("key", "value1", session=session)
+        db.set_sync_state("key", "value2", session=session)
+
+    # Then
+    with db.session_scope(engine) as session:
+        assert missing is None
+        assert db.get_sync_state("key", session=session) == "value2"
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_mark_pages_synced(files: Callable[[int], list[RemarkableFile]]):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    pages = _pages_for(files(1)[0], 2)
+
+    # When
+    with db.session_scope(engine) as session:
+        db.mark_pages_synced(pages[:1], session=session)
+
+    # Then
+    with db.session_scope(engine) as session:
+        db_hashes = db.page_hashes_for_files([pages[0].parent], session=session)
+        assert db.pages_needing_update(pages, {}, db_hashes) == pages[1:]
+        assert session.query(Metadata).count() == 0  # Document isn't synced yet
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_forced_pass(
+    files_and_configs: Callable[[int], dict[RemarkableFile, ProcessingConfig]],
+):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    files, configs, _ = files_and_configs(1)
+    configs[0].force_reprocess = True
+    file_configs = {files[0]: configs[0]}
+    pages = _pages_for(files[0], 3)
+
+    # When
+    with db.session_scope(engine) as session:
+        db.continue_forced_pass(files[0], pages[:1], session=session)
+        db.continue_forced_pass(files[0], pages[1:2], session=session)
+    with db.session_scope(engine) as session:
+        forced_pass = db.forced_pass_hashes(files, session=session)
+        db.end_forced_pass(files[0], session=session)
+    with db.session_scope(engine) as session:
+        next_pass = db.forced_pass_hashes(files, session=session)
+
+    # Then
+    db_hashes = {page.uuid: page.hash for page in pages}  # Unchanged
+    needing_update = partial(db.pages_needing_update, pages, file_configs, db_hashes)
+    assert needing_update(forced_pass) == pages[2:]
+    assert needing_update(next_pass) == pages
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_search_pages(files: Callable[[int], list[RemarkableFile]]):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    file0, file1 = files(2)
+    pages0, pages1 = _pages_for(file0, 2), _pages_for(file1, 1)
+
+    # When
+    with db.session_scope(engine) as session:
+        session.add_all([Metadata(uuid=file.uuid) for file in (file0, file1)])
+        db.index_page_text(
+            file0,
+            {pages0[0]: "Budget meeting", pages0[1]: "Shopping list"},
+            session=session,
+        )
+        db.index_page_text(file1, {pages1[0]: "Meeting, meeting"}, session=session)
+        db.index_page_text(  # Reconverted after moving the document
+            replace(file0, path=Path("moved/file0")),
+            {pages0[1]: "Groceries"},
+            session=session,
+        )
+
+    # Then
+    with db.session_scope(engine) as session:
+        hits = db.search_pages("meeting", session=session)
+        assert [(hit.path, hit.uuid) for hit in hits] == [
+            ("file1", "uuid1-page0"),
+            ("moved/file0", "uuid0-page0"),
+        ]
+        assert hits[1].snippet == "Budget **meeting**"
+        assert hits[1].page_idx == 0
+        assert db.search_pages("shopping", session=session) == []
+        assert [hit.uuid for hit in db.search_pages("grocer*", session=session)] == [
+            "uuid0-page1"
+        ]
+
+        db.collect_garbage([file1], session=session)
+        assert [hit.uuid for hit in db.search_pages("meeting", session=session)] == [
+            "uuid1-page0"
+        ]
+
+    Base.metadata.drop_all(engine)  # Cleanup
+
+
+def test_seed_page_text(files: Callable[[int], list[RemarkableFile]]):
+    # Given
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    file0, file1 = files(2)
+    pages0 = _pages_for(file0, 2)
+    md_pages = [
+        (Path("old/file0"), pages0[0].uuid, 0, "Budget meeting"),
+        (Path("old/file0"), pages0[1].uuid, 1, "Shopping list"),
+        (Path("other tablet"), "unknown-page0", 0, "Meeting"),
+    ]
+    with db.session_scope(engine) as session:
+        session.add_all(
+            [Metadata(uuid=file0.uuid, path="file0"), Metadata(uuid=file1.uuid)]
+        )
+        session.add_all(
+            [
+                Page(uuid=page.uuid, hash=page.hash, parent_uuid=file0.uuid)
+                for page in pages0
+            ]
+        )
+        db.index_page_text(file0, {pages0[1]: "Groceries"}, session=session)
+
+    # When
+    with db.session_scope(engine) as session:
+        seeded = db.seed_page_text(lambda: md_pages, session=session)
+    with db.session_scope(engine) as session:
+        reseeded = db.seed_page_text(lambda: md_pages, session=session)
+
+    # Then
+    assert (seeded, reseeded) == (1, 0)
+    with db.session_scope(engine) as session:
+        hits = db.search_pages("meeting", session=session)
+        assert [(hit.path, hit.uuid, hit.page_idx) for hit in hits] == [
+            ("file0", pages0[0].uuid, 0)
+        ]
+        assert db.search_pages("shopping", session=session) == []
+
+    Base.metadata.drop_all(engine)  # Cleanup
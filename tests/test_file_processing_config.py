@@ -0,0 +1,141 @@
+# tests/test_file_processing_config.py
+import time
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import patch
+
+import pandas as pd
+
+from rao import file_processing_config as fpc
+from rao.config import Config
+from rao.models import RemarkableFile
+
+
+def _file(path: str) -> RemarkableFile:
+    return RemarkableFile(
+        uuid=path,
+        name=Path(path).name,
+        last_modified=datetime.now(),
+        type="DocumentType",
+        parent_uuid="",
+        path=Path(path),
+        other_files=[],
+    )
+
+
+def test_path_trie_longest_prefix():
+    trie = fpc.PathTrie([("A", 1), ("A/B", 2), ("Work", 3), ("A/B", 4)])
+
+    assert trie.longest_prefix(Path("A/notes")) == 1
+    assert trie.longest_prefix(Path("A/B")) == 2
+    assert trie.longest_prefix(Path("A/B/C/notes")) == 2
+    assert trie.longest_prefix(Path("Work/notes")) == 3
+    assert trie.longest_prefix(Path("Workshop/notes")) is None
+    assert trie.longest_prefix(Path("B")) is None
+
+
+def test_get_configs_for_files(tmp_path: Path):
+    pd.DataFrame(
+        {
+            "path": ["A", "A/B"],
+            "prompt_path": [None, "ab.txt"],
+            "pdf_only": [True, False],
+            "force_reprocess": [None, None],
+        }
+    ).to_csv(tmp_path / "whitelist.csv", index=False)
+    pd.DataFrame({"path": ["A/B/skip"]}).to_csv(tmp_path / "blacklist.csv", index=False)
+    (tmp_path / "prompts").mkdir()
+    (tmp_path / "prompts" / "ab.txt").write_text("ab prompt")
+    files = [_file(p) for p in ["A/x", "A/B/y", "A/B/skip", "AB/z"]]
+
+    with (
+        patch.object(Config, "whitelist_path", new=str(tmp_path / "whitelist.csv")),
+        patch.object(Config, "blacklist_path", new=str(tmp_path / "blacklist.csv")),
+        patch.object(Config, "prompts_dir", new=str(tmp_path / "prompts")),
+    ):
+        configs = fpc.get_configs_for_files(files)
+
+    assert {str(f.path): c.pdf_only for f, c in configs.items()} == {
+        "A/x": True,
+        "A/B/y": False,
+    }
+    assert configs[files[1]].prompt == "ab prompt"
+
+
+def test_path_trie_10k_files_1k_rules():
+    rules = [(f"Folder{i}/Sub{i % 10}", i) for i in range(1000)]
+    paths = [Path(f"Folder{i % 2000}/Sub{i % 10}/note{i}") for i in range(10_000)]
+
+    start = time.perf_counter()
+    trie = fpc.PathTrie(rules)
+    matches = [trie.longest_prefix(path) for path in paths]
+    elapsed = time.perf_counter() - start
+
+    assert sum(match is not None for match in matches) == 5000
+    assert elapsed < 1, f"Matching 10k files against 1k rules took {elapsed:.2f}s"
+
+
+def test_get_configs_for_files_reloads_only_changed_inputs(tmp_path: Path):
+    whitelist_path = tmp_path / "whitelist.csv"
+    pd.DataFrame(
+        {
+            "path": ["A", "B"],
+            "prompt_path": [None, None],
+            "pdf_only": [False, False],
+            "force_reprocess": ["once", None],
+        }
+    ).to_csv(whitelist_path, index=False)
+    files = [_file("A/x"), _file("B/y")]
+
+    with (
+        patch.object(Config, "whitelist_path", new=str(whitelist_path)),
+        patch.object(Config, "blacklist_path", new=str(tmp_path / "missing.csv")),
+        patch.object(Config, "prompts_dir", new=str(tmp_path / "prompts")),
+        patch("rao.file_processing_config.pd.read_csv", wraps=pd.read_csv) as read,
+    ):
+        first = fpc.get_configs_for_files(files)
+        fpc.consume_reprocess_once(first, done=set())  # Deferred, so not consumed
+        second = fpc.get_configs_for_files(files)
+        fpc.consume_reprocess_once(second, done={files[0]})
+        written = whitelist_path.stat().st_mtime_ns
+        third = fpc.get_configs_for_files(files)
+        fpc.consume_reprocess_once(third, done=set(files))
+
+    assert first[files[0]].reprocess_once_rule == "A"
+    assert second[files[0]].force_reprocess
+    assert not third[files[0]].force_reprocess
+    assert whitelist_path.stat().st_mtime_ns == written  # Only written once
+    assert not (tmp_path / "whitelist.csv.tmp").exists()
+    assert read.call_count == 1  # Rewritten whitelist is not re-parsed
+
+
+def test_reprocess_once_only_clears_rules_of_processed_files(tmp_path: Path):
+    # Given
+    whitelist_path = tmp_path / "whitelist.csv"
+    pd.DataFrame(
+        {
+            "path": ["alice", "bob"],
+            "prompt_path": [None, None],
+            "pdf_only": [False, False],
+            "force_reprocess": ["once", "once"],
+        }
+    ).to_csv(whitelist_path, index=False)
+    alice_files, bob_files = [_file("alice/x")], [_file("bob/y")]
+
+    # When
+    with (
+        patch.object(Config, "whitelist_path", new=str(whitelist_path)),
+        patch.object(Config, "blacklist_path", new=None),
+        patch.object(Config, "prompts_dir", new=str(tmp_path / "prompts")),
+    ):
+        # Each tablet's thread only sees its own files
+        alice_configs = fpc.get_configs_for_files(alice_files)
+        bob_configs = fpc.get_configs_for_files(bob_files)
+        fpc.consume_reprocess_once(alice_configs, done=set(alice_files))
+        alice_after = fpc.get_configs_for_files(alice_files)
+        bob_after = fpc.get_configs_for_files(bob_files)
+
+    # Then
+    assert bob_configs[bob_files[0]].force_reprocess
+    assert not alice_after[alice_files[0]].force_reprocess
+    assert bob_after[bob_files[0]].force_reprocess
@@ -1,9 +1,21 @@
 # tests/test_file_sync.py
+import json
+import sqlite3
+import subprocess
+import threading
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import closing
+from io import BytesIO
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
+import pytest
+from pypdf import PdfReader, PdfWriter
+
 from rao import file_sync
-from rao.models import RemarkablePage
+from rao.config import Config
+from rao.models import RemarkableFile, RemarkablePage
 
 
 def test__combine_md_pages():
@@ -27,18 +39,415 @@ def test__combine_md_pages():
     assert "page2 content" in md
 
 
-@patch("os.path.exists", return_value=True)
 @patch("rao.file_sync.pathname2url", return_value="/test/path/file.md")
-def test__dir_to_md_tree(mock_url: MagicMock, mock_exists: MagicMock, tmp_path: Path):
-    root_path = tmp_path
-
-    # create dummy files and dir, so we can use it for the function calls below
-    (root_path / "file1.md").touch()
-    (root_path / "subdir").mkdir()
-    (root_path / "subdir" / "file2.md").touch()
+def test__md_tree(mock_url: MagicMock):
+    files = [Path("docs/file1.md"), Path("docs/subdir/file2.md")]
 
-    lines = file_sync._dir_to_md_tree(root_path, root_path)
+    lines = file_sync._md_tree(files, Path("docs"))
 
     assert "  * [file1.md](/test/path/file.md)" in lines
-    assert "  * [subdir/](subdir)" in lines
+    assert "  * [subdir/](docs/subdir)" in lines
     assert "    * [file2.md](/test/path/file.md)" in lines
+
+
+def test_db_backup_roundtrip(tmp_path: Path):
+    db_cache_path = tmp_path / "cache" / "db.sqlite"
+    db_cache_path.parent.mkdir()
+    with closing(sqlite3.connect(db_cache_path)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.execute("INSERT INTO t VALUES (1)")
+        conn.commit()
+
+    with (
+        patch("rao.file_sync.DB_CACHE_PATH", new=db_cache_path),
+        patch(
+            "rao.file_sync._db_backup_states",
+            new=defaultdict(file_sync._DBBackupState),
+        ),
+        patch.object(Config, "db_data_dir", new=str(tmp_path / "backup")),
+        patch.object(Config, "db_backup_interval", new=3600),
+    ):
+        file_sync.save_db_file_to_backup()  # Not dirty: no backup
+        assert not (tmp_path / "backup" / "db.sqlite").exists()
+
+        file_sync.mark_db_dirty()
+        file_sync.save_db_file_to_backup()
+        assert (tmp_path / "backup" / "db.sqlite").exists()
+        assert not (tmp_path / "backup" / "db.sqlite.tmp").exists()
+
+        with closing(sqlite3.connect(db_cache_path)) as conn:
+            conn.execute("INSERT INTO t VALUES (2)")
+            conn.commit()
+        file_sync.mark_db_dirty()
+        file_sync.save_db_file_to_backup()  # Within interval: deferred
+
+        db_cache_path.unlink()
+        file_sync.load_db_file_from_backup()
+
+    with closing(sqlite3.connect(db_cache_path)) as conn:
+        assert conn.execute("SELECT x FROM t").fetchall() == [(1,)]
+
+
+def test_flush_db_backup_and_local_integrity(tmp_path: Path):
+    db_path = tmp_path / "cache" / "db.sqlite"
+    db_path.parent.mkdir()
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.commit()
+
+        with (
+            patch(
+                "rao.file_sync._db_backup_states",
+                new=defaultdict(file_sync._DBBackupState),
+            ),
+            patch.object(Config, "db_data_dir", new=str(tmp_path / "backup")),
+            patch.object(Config, "db_backup_interval", new=3600),
+        ):
+            file_sync.flush_db_backup(db_path)  # Not dirty: no backup
+            assert not (tmp_path / "backup" / "db.sqlite").exists()
+            file_sync.mark_db_dirty(db_path)
+            file_sync.save_db_file_to_backup(db_path=db_path)
+            conn.execute("INSERT INTO t VALUES (1)")
+            conn.commit()
+            file_sync.mark_db_dirty(db_path)
+            file_sync.save_db_file_to_backup(db_path=db_path)  # Deferred
+            file_sync.flush_db_backup(db_path)
+
+        assert file_sync.db_is_intact(db_path)  # With the WAL still in use
+
+    with closing(sqlite3.connect(tmp_path / "backup" / "db.sqlite")) as conn:
+        assert conn.execute("SELECT x FROM t").fetchall() == [(1,)]
+    assert not file_sync.db_is_intact(tmp_path / "missing.sqlite")
+    db_path.write_bytes(b"not a database")
+    assert not file_sync.db_is_intact(db_path)
+
+
+def test_load_db_file_from_backup_corrupt(tmp_path: Path):
+    (tmp_path / "db.sqlite").write_bytes(b"not a database")
+
+    with (
+        patch("rao.file_sync.DB_CACHE_PATH", new=tmp_path / "cache" / "db.sqlite"),
+        patch.object(Config, "db_data_dir", new=str(tmp_path)),
+        pytest.raises(file_sync.DBBackupError),
+    ):
+        file_sync.load_db_file_from_backup()
+
+
+def test_save_mds_to_disk_splices_pages(
+    tmp_path: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (file,) = files(1)
+    pages = [
+        RemarkablePage(uuid=f"{i}a", hash="h", parent=file, page_idx=i, pdf_data=b"")
+        for i in range(3)
+    ]
+    md_path = tmp_path / "md" / "file0.md"
+    index_path = tmp_path / "md_index" / "file0.json"
+
+    with patch.object(Config, "render_path", new=str(tmp_path)):
+        # When
+        file_sync._save_mds_to_disk({page: f"text {page.uuid}" for page in pages})
+        first = md_path.read_text()
+        file_sync._save_mds_to_disk({pages[1]: "new text"})
+        second = md_path.read_text()
+        index_path.write_text("not json")  # Falls back to scanning the file
+        file_sync._save_mds_to_disk({pages[2]: "newer text"})
+        third = md_path.read_text()
+
+    # Then
+    assert second == file_sync._combine_md_pages("file0", {pages[1]: "new text"}, first)
+    assert "text 0a" in second and "new text" in second and "text 1a" not in second
+    assert third == file_sync._combine_md_pages(
+        "file0", {pages[2]: "newer text"}, second
+    )
+    index = json.loads(index_path.read_text())
+    start, end = index["pages"]["3"][1:]
+    assert third.encode()[start:end].decode().endswith("newer text\n\n")
+    assert sorted(path.name for path in index_path.parent.iterdir()) == ["file0.json"]
+
+
+def test_rendered_md_pages(
+    tmp_path: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (file,) = files(1)
+    pages = [
+        RemarkablePage(uuid=f"{i}a", hash="h", parent=file, page_idx=i, pdf_data=b"")
+        for i in range(2)
+    ]
+
+    with patch.object(Config, "render_path", new=str(tmp_path)):
+        file_sync._save_mds_to_disk({pages[0]: "# Title\ntext", pages[1]: "more text"})
+        (tmp_path / "md_index" / "file0.json").unlink()  # Falls back to scanning
+
+        # When
+        md_pages = list(file_sync.rendered_md_pages())
+
+    # Then
+    assert md_pages == [
+        (Path("file0"), "0a", 0, "# Title\ntext"),
+        (Path("file0"), "1a", 1, "more text"),
+    ]
+
+
+def _pdf_page(width: int) -> bytes:
+    writer = PdfWriter()
+    writer.add_blank_page(width, 100)
+    with BytesIO() as stream:
+        writer.write(stream)
+        return stream.getvalue()
+
+
+def test_save_pdfs_to_disk_updates_changed_pages_incrementally(
+    tmp_path: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (file,) = files(1)
+
+    def page(idx: int, width: int) -> RemarkablePage:
+        return RemarkablePage(
+            uuid=f"p{idx}",
+            hash=f"h{width}",
+            parent=file,
+            page_idx=idx,
+            pdf_data=_pdf_page(width),
+        )
+
+    pdf_path = tmp_path / "pdf" / "file0.pdf"
+    with (
+        patch.object(Config, "render_path", new=str(tmp_path)),
+        patch("rao.file_sync.Metrics") as metrics,
+    ):
+        # When
+        file_sync._save_pdfs_to_disk([page(i, 100) for i in range(3)])
+        original = pdf_path.read_bytes()
+        file_sync._save_pdfs_to_disk([page(0, 100), page(1, 150), page(2, 100)])
+        updated = pdf_path.read_bytes()
+        widths = []
+        for edited in [
+            [page(0, 100), page(1, 160), page(2, 100)],  # The same page again
+            [page(0, 100), page(1, 170), page(2, 100)],
+            [page(0, 110), page(1, 170), page(2, 130)],  # Other pages
+            [page(0, 120), page(1, 170), page(2, 130)],
+        ]:
+            file_sync._save_pdfs_to_disk(edited)
+            widths.append([page.mediabox.width for page in PdfReader(pdf_path).pages])
+        file_sync._save_pdfs_to_disk([page(1, 150), page(0, 100)])
+
+    # Then
+    assert updated.startswith(original)  # Appended as an incremental update
+    assert [call.args[0] for call in metrics.increment.call_args_list] == [
+        "pdf_full_rebuilds",
+        "pdf_incremental_updates",
+        "pdf_full_rebuilds",  # Updated already
+        "pdf_incremental_updates",
+        "pdf_full_rebuilds",
+        "pdf_incremental_updates",
+        "pdf_full_rebuilds",  # Page removed
+    ]
+    widths.insert(0, [p.mediabox.width for p in PdfReader(BytesIO(updated)).pages])
+    assert widths == [
+        [100, 150, 100],
+        [100, 160, 100],
+        [100, 170, 100],
+        [110, 170, 130],
+        [120, 170, 130],
+    ]
+    assert len(PdfReader(pdf_path).pages) == 2
+
+
+def _git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=repo, check=True, capture_output=True, text=True
+    ).stdout
+
+
+def test_sync_with_subrepo_commits_only_changed_files(tmp_path: Path):
+    # Given
+    remote, repo = tmp_path / "remote.git", tmp_path / "repo"
+    _git(tmp_path, "init", "-q", "--bare", str(remote))
+    _git(tmp_path, "clone", "-q", str(remote), str(repo))
+    _git(repo, "config", "user.name", "test")
+    _git(repo, "config", "user.email", "test@example.com")
+    md_dir = tmp_path / "render" / "md"
+    (md_dir / "Folder").mkdir(parents=True)
+    old, new = md_dir / "Folder" / "old.md", md_dir / "new.md"
+    old.write_text("old")
+    new.write_text("new")
+
+    publisher = file_sync.SubrepoPublisher()
+
+    with (
+        patch.object(Config, "render_path", new=str(tmp_path / "render")),
+        patch.object(Config, "md_repo_path", new=str(repo)),
+        patch.object(file_sync.SubrepoPublisher, "_run"),  # Publish in the foreground
+    ):
+        # When
+        publisher.submit([old, new])
+        assert publisher.flush()
+        old.write_text("edited")
+        publisher.submit([old])
+        assert publisher.flush()
+        publisher.submit([old])  # Nothing changed
+        assert publisher.flush()
+
+    # Then
+    assert _git(repo, "rev-list", "--count", "HEAD").strip() == "2"
+    assert _git(remote, "rev-parse", "HEAD") == _git(repo, "rev-parse", "HEAD")
+    assert _git(repo, "log", "-1", "--format=%B").strip() == (
+        "Update 1 documents\n\n- Folder/old"
+    )
+    changed = _git(repo, "show", "--name-only", "--format=", "HEAD").split()
+    assert changed == ["documents/Folder/old.md"]
+    assert (repo / "documents" / "Folder" / "old.md").read_text() == "edited"
+    assert "[new.md]" in (repo / "README.md").read_text()
+
+
+def test_subrepo_readme_is_committed_after_a_failed_commit(tmp_path: Path):
+    # Given
+    repo = tmp_path / "repo"
+    _git(tmp_path, "init", "-q", str(repo))
+    _git(repo, "config", "user.name", "test")
+    _git(repo, "config", "user.email", "test@example.com")
+    md_path = tmp_path / "render" / "md" / "doc.md"
+    md_path.parent.mkdir(parents=True)
+    md_path.write_text("doc")
+    publisher = file_sync.SubrepoPublisher()
+
+    with (
+        patch.object(Config, "render_path", new=str(tmp_path / "render")),
+        patch.object(Config, "md_repo_path", new=str(repo)),
+        patch.object(file_sync.SubrepoPublisher, "_run"),
+        patch("rao.file_sync._git", wraps=file_sync._git) as git,
+    ):
+        # When
+        git.side_effect = subprocess.CalledProcessError(1, "git add")
+        publisher.submit([md_path])
+        assert not publisher.flush()  # README written, but not committed
+        git.side_effect = None
+        publisher.flush()  # Pushing fails without a remote
+
+    # Then
+    committed = _git(repo, "show", "--name-only", "--format=", "HEAD").split()
+    assert sorted(committed) == ["README.md", "documents/doc.md"]
+
+
+def test_subrepo_publisher_coalesces_and_backs_off(tmp_path: Path):
+    # Given
+    now = 0.0
+    publisher = file_sync.SubrepoPublisher(clock=lambda: now)
+    pushes = []
+
+    def git(*args: str, input: str | None = None) -> str:
+        if args[0] == "push":
+            pushes.append(now)
+            if len(pushes) == 1:
+                raise subprocess.CalledProcessError(1, "git push")
+        return ""
+
+    with (
+        patch.object(Config, "md_repo_path", new=str(tmp_path)),
+        patch.object(Config, "md_repo_push_interval", new=600),
+        patch.object(Config, "md_repo_push_files", new=3),
+        patch.object(file_sync.SubrepoPublisher, "_run"),
+        patch("rao.file_sync._copy_to_subrepo", side_effect=lambda paths: paths),
+        patch(
+            "rao.file_sync._save_markdown_repo_readme_file",
+            side_effect=[OSError("No space left on device")] + ["README.md"] * 2,
+        ),
+        patch("rao.file_sync._commit_index", return_value=True) as commit_index,
+        patch("rao.file_sync._git", side_effect=git),
+    ):
+        # When / Then
+        assert publisher._delay() is None  # Nothing to do
+        publisher.submit([Path("documents/a.md")])
+        assert publisher._delay() == 0  # Nothing pushed recently
+        assert not publisher.flush()  # README can't be written
+        assert publisher._delay() == 60  # Backing off
+        now = 60.0
+        assert not publisher.flush()  # Committed, but not pushed
+        assert publisher._delay() == 120
+        now = 180.0
+        assert publisher.flush()
+        publisher.submit([Path("documents/b.md")])
+        assert publisher._delay() == 600  # Coalesced with later changes
+        publisher.submit([Path("documents/c.md"), Path("documents/d.md")])
+        assert publisher._delay() == 0  # Enough files pending
+
+    assert pushes == [60.0, 180.0]
+    assert commit_index.call_args.args[0].endswith("- a")  # Not lost on failure
+
+
+def test_pdf_copier_resumes_backlog_and_skips_unchanged(tmp_path: Path):
+    # Given
+    pdf_path = tmp_path / "render" / "pdf" / "Folder" / "doc.pdf"
+    pdf_path.parent.mkdir(parents=True)
+    pdf_path.write_bytes(b"%PDF")
+    target_dir = tmp_path / "drive"
+    target_path = target_dir / "Folder" / "doc.pdf"
+
+    with (
+        patch.object(Config, "render_path", new=str(tmp_path / "render")),
+        patch.object(Config, "pdf_copy_path", new=str(target_dir)),
+        patch("rao.file_sync.Metrics") as metrics,
+    ):
+        # When
+        copier = file_sync.PdfCopier()
+        copier.submit([pdf_path])
+        copier.wait()  # Drive not mounted
+        backlog = json.loads((tmp_path / "render" / "pdf_copy.json").read_text())
+        target_dir.mkdir()
+        copier = file_sync.PdfCopier()  # Restarted
+        copier.start()
+        copier.wait()
+        copier.submit([pdf_path])
+        copier.wait()
+
+    # Then
+    assert backlog["backlog"] == ["Folder/doc.pdf"]
+    assert target_path.read_bytes() == b"%PDF"
+    assert sorted(path.name for path in target_path.parent.iterdir()) == ["doc.pdf"]
+    assert [call.args[0] for call in metrics.increment.call_args_list] == [
+        "pdf_copy_failures",
+        "pdf_copies",
+        "pdf_copies_skipped",
+    ]
+    state = json.loads((tmp_path / "render" / "pdf_copy.json").read_text())
+    assert state["backlog"] == []
+
+
+def test_pdf_copier_cleans_up_after_failures(tmp_path: Path):
+    # Given
+    pdf_path = tmp_path / "render" / "pdf" / "doc.pdf"
+    pdf_path.parent.mkdir(parents=True)
+    pdf_path.write_bytes(b"%PDF")
+    target_dir = tmp_path / "drive"
+    target_dir.mkdir()
+
+    def stalled_cp(args: list[str], **kwargs):
+        Path(args[2]).write_bytes(b"%P")  # Partially copied
+        raise subprocess.TimeoutExpired(args, kwargs["timeout"])
+
+    def save_state():
+        if threading.current_thread().name.startswith("pdf-copy"):
+            raise OSError("No space left on device")
+
+    with (
+        patch.object(Config, "render_path", new=str(tmp_path / "render")),
+        patch.object(Config, "pdf_copy_path", new=str(target_dir)),
+        patch("rao.file_sync.subprocess.run", side_effect=stalled_cp),
+    ):
+        # When
+        copier = file_sync.PdfCopier()
+        with patch.object(copier, "_save_state", side_effect=save_state):
+            copier.submit([pdf_path])
+            waiting = threading.Thread(target=copier.wait, daemon=True)
+            waiting.start()
+            waiting.join(timeout=5)
+
+    # Then
+    assert not waiting.is_alive()  # The worker survived, and the copy was accounted for
+    assert list(target_dir.iterdir()) == []
@@ -0,0 +1,310 @@
+# tests/test_job_queue.py
+import multiprocessing
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from contextlib import closing
+from hashlib import sha256
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from rao import job_queue
+from rao.config import Config
+from rao.file_processing_config import ProcessingConfig
+from rao.models import Job, RemarkableFile, RemarkablePage
+
+CONFIG = ProcessingConfig(pdf_only=False, force_reprocess=False, prompt="p")
+
+
+@pytest.fixture
+def queue_dir(tmp_path: Path):
+    with patch.object(Config, "job_queue_dir", new=str(tmp_path)):
+        yield tmp_path
+
+
+def _pages(file: RemarkableFile, n: int) -> list[RemarkablePage]:
+    return [
+        RemarkablePage(
+            uuid=f"page{i}",
+            hash=f"hash{i}",
+            parent=file,
+            page_idx=i,
+            pdf_data=f"pdf {i}".encode(),
+        )
+        for i in range(n)
+    ]
+
+
+def _fake_pdf_to_md(pdf_data: bytes, prompt: str, model: str) -> str:
+    return f"{prompt}: {pdf_data.decode()}"
+
+
+def _run_worker(name: str, queue_dir: Path):
+    # A fresh interpreter, as with `rm-auto-ocr worker`
+    Config.job_queue_dir = str(queue_dir)
+    with patch("rao.job_queue.dp.pdf_to_md", _fake_pdf_to_md):
+        job_queue.work(job_queue.get_engine(), name, until_idle=True)
+
+
+def _wait_for_check_in(engine: Engine):
+    for _ in range(100):
+        with Session(engine) as session:
+            if job_queue._workers_alive(session=session):
+                return
+        time.sleep(0.01)
+    raise TimeoutError("No worker checked in")
+
+
+def test_workers_convert_each_job_once(
+    queue_dir: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    pages = _pages(files(1)[0], 30)
+    engine = job_queue.get_engine()
+    with Session(engine) as session, session.begin():
+        for page in pages:
+            job_queue.submit(page, CONFIG, session=session)
+    context = multiprocessing.get_context("spawn")
+
+    # When
+    workers = [
+        context.Process(target=_run_worker, args=(f"worker{i}", queue_dir))
+        for i in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+    results = [job_queue.convert(engine, page, CONFIG) for page in pages]
+
+    # Then
+    assert [worker.exitcode for worker in workers] == [0, 0, 0]
+    assert results == [f"p: pdf {i}" for i in range(30)]
+    with Session(engine) as session:
+        counts, stats = job_queue.stats(session=session)
+    assert counts == {job_queue.DONE: 30}
+    assert sum(stat.jobs_done for stat in stats) == 30
+    assert list((queue_dir / "blobs").iterdir()) == []  # No longer needed
+
+
+def test_expired_lease_and_idempotent_completion(
+    queue_dir: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (page,) = _pages(files(1)[0], 1)
+    engine = job_queue.get_engine()
+    with Session(engine) as session, session.begin():
+        job_id, status, _ = job_queue.submit(page, CONFIG, session=session)
+
+    # When
+    with (
+        patch.object(Config, "job_lease_seconds", new=0),
+        Session(engine) as session,
+        session.begin(),
+    ):
+        first = job_queue.claim("slow", session=session).id
+    with Session(engine) as session, session.begin():
+        second = job_queue.claim("fast", session=session).id
+    with Session(engine) as session, session.begin():
+        assert job_queue.claim("idle", session=session) is None
+        fast_done = job_queue.complete(job_id, "fast", "fast md", 1.0, session=session)
+        slow_done = job_queue.complete(job_id, "slow", "slow md", 9.0, session=session)
+
+    # Then
+    assert status == job_queue.PENDING
+    assert first == second == job_id
+    assert (fast_done, slow_done) == (True, False)
+    with Session(engine) as session:
+        job = session.get(Job, job_id)
+        assert (job.status, job.result, job.attempts) == ("done", "fast md", 2)
+        _, stats = job_queue.stats(session=session)
+    assert [(s.name, s.jobs_done, s.busy_seconds) for s in stats] == [
+        ("fast", 1, 1.0),
+        ("slow", 0, 9.0),
+    ]
+
+
+def test_failed_jobs_are_retried_then_given_up(
+    queue_dir: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (page,) = _pages(files(1)[0], 1)
+    engine = job_queue.get_engine()
+    stop = threading.Event()
+
+    # When
+    with (
+        patch("rao.job_queue.dp.pdf_to_md", return_value=None),
+        patch("rao.job_queue.POLL_SECONDS", new=0.01),
+    ):
+        worker = threading.Thread(
+            target=job_queue.work, args=(engine, "worker"), kwargs={"stop": stop}
+        )
+        worker.start()
+        _wait_for_check_in(engine)
+        failed = job_queue.convert(engine, page, CONFIG)
+        stop.set()
+        worker.join()
+    with Session(engine) as session, session.begin():
+        _, resubmitted, _ = job_queue.submit(page, CONFIG, session=session)
+
+    # Then
+    assert failed is None
+    assert resubmitted == job_queue.PENDING
+    with Session(engine) as session:
+        jobs = session.query(Job).order_by(Job.id).all()
+        assert [(job.model, job.error) for job in jobs] == [
+            (Config.model, "Conversion failed"),
+            (Config.backup_model, "Conversion failed"),
+        ]
+        _, (stat,) = job_queue.stats(session=session)
+    assert stat.jobs_failed == 2 * job_queue.MAX_ATTEMPTS
+
+
+def test_backup_model_result_is_stored_under_the_backup_model(
+    queue_dir: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (page,) = _pages(files(1)[0], 1)
+    engine = job_queue.get_engine()
+    stop = threading.Event()
+
+    def pdf_to_md(pdf_data: bytes, prompt: str, model: str) -> str | None:
+        return f"{model}: {pdf_data.decode()}" if model == Config.backup_model else None
+
+    # When
+    with (
+        patch("rao.job_queue.dp.pdf_to_md", pdf_to_md),
+        patch("rao.job_queue.POLL_SECONDS", new=0.01),
+    ):
+        worker = threading.Thread(
+            target=job_queue.work, args=(engine, "worker"), kwargs={"stop": stop}
+        )
+        worker.start()
+        _wait_for_check_in(engine)
+        md = job_queue.convert(engine, page, CONFIG)
+        stop.set()
+        worker.join()
+
+    # Then
+    assert md == f"{Config.backup_model}: pdf 0"
+    with Session(engine) as session:
+        jobs = session.query(Job).order_by(Job.id).all()
+    assert [(job.model, job.status, job.result) for job in jobs] == [
+        (Config.model, job_queue.FAILED, None),
+        (Config.backup_model, job_queue.DONE, md),
+    ]
+
+
+def test_convert_does_not_wait_without_workers(
+    queue_dir: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (page,) = _pages(files(1)[0], 1)
+    engine = job_queue.get_engine()
+    with (
+        patch("rao.job_queue.time.time", return_value=time.time() - 3600),
+        Session(engine) as session,
+        session.begin(),
+    ):
+        job_queue._record_work("gone", 1.0, done=1, failed=0, session=session)
+
+    # When
+    start = time.perf_counter()
+    md = job_queue.convert(engine, page, CONFIG)
+
+    # Then
+    assert md is None
+    assert time.perf_counter() - start < job_queue.POLL_SECONDS
+    with Session(engine) as session:
+        (job,) = session.query(Job)
+        assert job.status == job_queue.PENDING  # Left for the next cycle
+    assert job_queue.get_engine() is engine
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "delete"
+
+
+def test_forced_reprocess_requeues_done_jobs(
+    queue_dir: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    (page,) = _pages(files(1)[0], 1)
+    forced = ProcessingConfig(pdf_only=False, force_reprocess=True, prompt="p")
+    engine = job_queue.get_engine()
+    with Session(engine) as session, session.begin():
+        job_id, _, _ = job_queue.submit(page, CONFIG, session=session)
+        job_queue.claim("worker", session=session)
+        job_queue.complete(job_id, "worker", "old md", 1.0, session=session)
+
+    # When
+    with Session(engine) as session, session.begin():
+        reused = job_queue.submit(page, CONFIG, session=session)
+        requeued = job_queue.submit(page, forced, session=session)
+
+    # Then
+    assert reused == (job_id, job_queue.DONE, "old md")
+    assert requeued == (job_id, job_queue.PENDING, None)
+
+
+def test_get_engine_adds_missing_columns(queue_dir: Path):
+    # Given
+    with closing(sqlite3.connect(queue_dir / "jobs.sqlite")) as conn:
+        conn.execute(  # As created before `finished_at` was added
+            "CREATE TABLE job (id INTEGER PRIMARY KEY, pdf_hash VARCHAR NOT NULL, "
+            "prompt VARCHAR NOT NULL, prompt_hash VARCHAR NOT NULL, "
+            "model VARCHAR NOT NULL, status VARCHAR NOT NULL, worker VARCHAR, "
+            "lease_expires FLOAT, attempts INTEGER NOT NULL, result VARCHAR, "
+            "error VARCHAR, UNIQUE (pdf_hash, prompt_hash, model))"
+        )
+
+    # When
+    engine = job_queue.get_engine()
+
+    # Then
+    with Session(engine) as session:
+        assert session.query(Job.finished_at).all() == []
+
+
+def test_prune_finished_jobs(
+    queue_dir: Path, files: Callable[[int], list[RemarkableFile]]
+):
+    # Given
+    old_done, old_failed, new_done, pending = _pages(files(1)[0], 4)
+    engine = job_queue.get_engine()
+    with Session(engine) as session, session.begin():
+        ids = [
+            job_queue.submit(page, CONFIG, session=session)[0]
+            for page in (old_done, old_failed, new_done, pending)
+        ]
+        session.execute(
+            update(Job)
+            .where(Job.id.in_(ids[:3]))
+            .values(status=job_queue.DONE, finished_at=time.time())
+        )
+        session.execute(
+            update(Job)
+            .where(Job.id.in_(ids[:2]))
+            .values(finished_at=time.time() - job_queue.FINISHED_RETENTION_SECONDS - 1)
+        )
+        session.execute(
+            update(Job).where(Job.id == ids[1]).values(status=job_queue.FAILED)
+        )
+
+    # When
+    with Session(engine) as session, session.begin():
+        pruned = job_queue.prune(session=session)
+
+    # Then
+    assert pruned == 2
+    with Session(engine) as session:
+        assert [job.id for job in session.query(Job).order_by(Job.id)] == ids[2:]
+    blobs = {path.name for path in (queue_dir / "blobs").iterdir()}
+    assert blobs == {
+        f"{sha256(page.pdf_data).hexdigest()}.pdf" for page in (new_done, pending)
+    }
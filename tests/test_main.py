@@ -0,0 +1,204 @@
+# tests/test_main.py
+from contextlib import ExitStack, contextmanager, nullcontext
+from dataclasses import replace
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import call, patch
+
+import pytest
+from sqlalchemy.engine import Engine
+
+from rao import db, main, remarkable
+from rao.config import Config, Tablet
+from rao.file_processing_config import ProcessingConfig
+from rao.models import RemarkablePage
+from rao.scheduler import CycleOutcome
+
+CONFIG = ProcessingConfig(pdf_only=False, force_reprocess=False, prompt="p")
+
+
+def _write_snapshot(root: Path):
+    xochitl = root / "xochitl"
+    (xochitl / "uuid1").mkdir(parents=True)
+    (xochitl / "uuid1.metadata").write_text(
+        '{"visibleName": "notes", "parent": "", "type": "DocumentType"}'
+    )
+    (xochitl / "uuid1.content").write_text('{"cPages": {"pages": [{"id": "p1"}]}}')
+
+
+@pytest.fixture
+def engine(tmp_path: Path):
+    engine = db.get_engine(tmp_path / "db.sqlite")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(autouse=True)
+def sync_mocks(tmp_path: Path):
+    with (
+        patch.object(Config, "render_path", new=str(tmp_path / "renders")),
+        patch("rao.main.fpc.inputs_fingerprint", return_value="inputs"),
+        patch(
+            "rao.main.fpc.get_configs_for_files",
+            side_effect=lambda files: dict.fromkeys(files, CONFIG),
+        ),
+        patch("rao.main.fs.publish"),
+        patch("rao.main.Metrics") as metrics,
+        patch("rao.pipeline.remarkable.render_pages") as render_pages,
+        patch("rao.pipeline.dp.page_to_md") as page_to_md,
+        patch("rao.pipeline.fs.save_to_disk") as save_to_disk,
+    ):
+        render_pages.side_effect = lambda _, file, **__: [
+            RemarkablePage(
+                uuid=f"p{i}", hash="h", parent=file, page_idx=i, pdf_data=b""
+            )
+            for i in range(2)
+        ]
+        page_to_md.side_effect = lambda page, *_: f"md {page.uuid}"
+        save_to_disk.side_effect = lambda pages, _: ({}, [Path("notes.pdf")])
+        yield SimpleNamespace(
+            render_pages=render_pages, page_to_md=page_to_md, metrics=metrics
+        )
+
+
+def _sync_from(source: remarkable.Source, engine: Engine) -> CycleOutcome:
+    with db.session_scope(engine) as db_session:
+        return main._sync_from(
+            source, db_session, ExitStack(), Config.devices()[0], ocr_slots=None
+        )
+
+
+def test_sync_from_is_idle_when_nothing_was_saved(
+    tmp_path: Path, engine: Engine, sync_mocks: SimpleNamespace
+):
+    # Given
+    _write_snapshot(tmp_path / "snapshot")
+    snapshot = remarkable.LocalSnapshot(tmp_path / "snapshot")
+    sync_mocks.render_pages.side_effect = OSError("Unreadable document")
+    tablet = replace(Config.devices()[0], snapshot_path=str(tmp_path / "snapshot"))
+
+    # When
+    online = _sync_from(snapshot, engine)
+    with (
+        patch("rao.main.remarkable.connect", return_value=nullcontext(None)),
+        db.session_scope(engine) as db_session,
+    ):
+        offline = main._sync(db_session, 1, tablet, ocr_slots=None)
+
+    # Then
+    assert (online, offline) == (CycleOutcome.IDLE, CycleOutcome.OFFLINE)
+    assert sync_mocks.render_pages.call_count == 2
+
+
+def test_sync_from_skips_unchanged_library(
+    tmp_path: Path, engine: Engine, sync_mocks: SimpleNamespace
+):
+    # Given
+    _write_snapshot(tmp_path / "snapshot")
+    snapshot = remarkable.LocalSnapshot(tmp_path / "snapshot")
+
+    # When
+    first = _sync_from(snapshot, engine)
+    unchanged = _sync_from(snapshot, engine)
+    (tmp_path / "snapshot" / "xochitl" / "uuid1.content").write_text(
+        '{"cPages": {"pages": [{"id": "p1"}, {"id": "p2"}]}}'
+    )
+    changed = _sync_from(snapshot, engine)
+
+    # Then
+    assert (first, unchanged, changed) == (
+        CycleOutcome.CHANGED,
+        CycleOutcome.IDLE,
+        CycleOutcome.IDLE,  # Listed again, but the document's metadata is unchanged
+    )
+    assert sync_mocks.render_pages.call_count == 1
+    assert sync_mocks.page_to_md.call_count == 2
+    assert sync_mocks.metrics.increment.call_args_list == [
+        call("cycles_skipped_unchanged")
+    ]
+
+
+def test_checkpoint_resumes_after_a_partial_run(
+    tmp_path: Path, engine: Engine, sync_mocks: SimpleNamespace
+):
+    # Given
+    _write_snapshot(tmp_path / "snapshot")
+    snapshot = remarkable.LocalSnapshot(tmp_path / "snapshot")
+    sync_mocks.page_to_md.side_effect = lambda page, *_: (
+        None if page.uuid == "p1" else f"md {page.uuid}"
+    )
+
+    # When
+    partial = _sync_from(snapshot, engine)
+    sync_mocks.page_to_md.side_effect = lambda page, *_: f"md {page.uuid}"
+    resumed = _sync_from(snapshot, engine)
+    done = _sync_from(snapshot, engine)
+
+    # Then
+    assert (partial, resumed, done) == (
+        CycleOutcome.CHANGED,
+        CycleOutcome.CHANGED,
+        CycleOutcome.IDLE,
+    )
+    converted = [c.args[0].uuid for c in sync_mocks.page_to_md.call_args_list]
+    assert sorted(converted[:2]) == ["p0", "p1"]
+    assert converted[2:] == ["p1"]  # Only the page that failed
+    with db.session_scope(engine) as db_session:
+        hits = db.search_pages("md", session=db_session)
+        assert sorted(hit.uuid for hit in hits) == ["p0", "p1"]
+
+
+def test_sync_processes_from_snapshot_while_offline(
+    tmp_path: Path, engine: Engine, sync_mocks: SimpleNamespace
+):
+    # Given
+    _write_snapshot(tmp_path / "tablet")
+    (tmp_path / "tablet" / "templates").mkdir()
+    tablet_client = remarkable.LocalSnapshot(tmp_path / "tablet")
+    tablet = replace(Config.devices()[0], snapshot_path=str(tmp_path / "snapshot"))
+    events = []
+
+    @contextmanager
+    def connect(client):
+        yield client
+        events.append("disconnected")
+
+    def render(source, file, **_):
+        events.append(f"rendered {file.name} from {source.root.name}")
+        if sync_mocks.render_pages.call_count == 1:
+            return []  # Fails while online
+        return [
+            RemarkablePage(uuid="p0", hash="h", parent=file, page_idx=0, pdf_data=b"")
+        ]
+
+    sync_mocks.render_pages.side_effect = render
+
+    def sync(client, tablet: Tablet) -> CycleOutcome:
+        with (
+            patch("rao.main.remarkable.connect", return_value=connect(client)),
+            db.session_scope(engine) as db_session,
+        ):
+            return main._sync(db_session, 1, tablet, ocr_slots=None)
+
+    # When
+    not_mirrored_yet = sync(None, tablet)
+    online = sync(tablet_client, tablet)
+    offline = sync(None, tablet)
+    without_snapshot = sync(None, replace(tablet, snapshot_path=None))
+
+    # Then
+    assert [not_mirrored_yet, online, offline, without_snapshot] == [
+        CycleOutcome.OFFLINE,
+        CycleOutcome.IDLE,
+        CycleOutcome.CHANGED,  # Retried from the snapshot
+        CycleOutcome.OFFLINE,
+    ]
+    assert events == [
+        "disconnected",
+        "disconnected",  # Before rendering from the mirrored snapshot
+        "rendered notes from snapshot",
+        "disconnected",
+        "rendered notes from snapshot",
+        "disconnected",
+    ]
+    sync_mocks.metrics.increment.assert_called_once_with("cycles_from_snapshot")
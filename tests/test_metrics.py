@@ -0,0 +1,22 @@
+# tests/test_metrics.py
+import json
+from pathlib import Path
+from unittest.mock import patch
+
+from rao.config import Config
+from rao.metrics import _Metrics
+
+
+def test_metrics_report(tmp_path: Path):
+    metrics = _Metrics()
+    metrics.increment("cycles")
+    metrics.increment("cycles")
+    metrics.set("interval", 30)
+
+    with patch.object(Config, "metrics_path", new=str(tmp_path / "metrics.json")):
+        metrics.report()
+
+    assert json.loads((tmp_path / "metrics.json").read_text()) == {
+        "cycles": 2,
+        "interval": 30,
+    }
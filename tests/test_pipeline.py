@@ -0,0 +1,158 @@
+# tests/test_pipeline.py
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from rao.file_processing_config import ProcessingConfig
+from rao.models import RemarkableFile, RemarkablePage
+from rao.pipeline import Stage, SyncPipeline
+from rao.scheduler import CycleBudget
+
+
+def _pages(file: RemarkableFile, n: int) -> list[RemarkablePage]:
+    return [
+        RemarkablePage(
+            uuid=f"{file.uuid}-{i}",
+            hash=f"hash{i}",
+            parent=file,
+            page_idx=i,
+            pdf_data=b"",
+        )
+        for i in range(n)
+    ]
+
+
+def test_stage_processes_all_items_concurrently():
+    seen = []
+    running = threading.Semaphore(0)
+
+    def work(item: int):
+        running.release()
+        time.sleep(0.05)
+        seen.append(item)
+
+    stage = Stage("test", work, workers=4, queue_size=2)
+    stage.start()
+    start = time.perf_counter()
+    for i in range(8):
+        stage.put(i)
+    stage.close()
+
+    assert sorted(seen) == list(range(8))
+    assert time.perf_counter() - start < 0.3
+    assert 0 < stage.utilisation <= 1
+
+
+@patch("rao.pipeline.fs.save_to_disk")
+@patch("rao.pipeline.dp.page_to_md")
+@patch("rao.pipeline.remarkable.render_pages")
+def test_sync_pipeline(
+    mock_render: MagicMock,
+    mock_page_to_md: MagicMock,
+    mock_save: MagicMock,
+    files: Callable[[int], list[RemarkableFile]],
+):
+    # Given
+    file0, file1, file2, file3 = files(4)
+    pages = {file0: _pages(file0, 3), file1: _pages(file1, 2), file2: [], file3: []}
+    config = ProcessingConfig(pdf_only=False, force_reprocess=False, prompt="p")
+    configs = dict.fromkeys(pages, config)
+    db_hashes = {pages[file0][0].uuid: pages[file0][0].hash}  # Unchanged page
+
+    def render(_, file, **__):
+        if file == file3:
+            raise OSError("Connection lost")
+        return pages[file]
+
+    mock_render.side_effect = render
+    mock_page_to_md.side_effect = lambda page, *_: (
+        None if page == pages[file1][1] else f"md {page.uuid}"
+    )
+    mock_save.side_effect = lambda doc_pages, _: (
+        {},
+        [Path(f"{doc_pages[0].parent.name}.pdf")],
+    )
+
+    checkpointed = []
+
+    def on_saved(doc):
+        if doc.file == file1:
+            raise RuntimeError("DB is locked")
+        checkpointed.append(doc.file)
+
+    # When
+    pipeline = SyncPipeline(
+        MagicMock(),
+        configs,
+        db_hashes,
+        render_workers=2,
+        ocr_workers=2,
+        save_workers=1,
+        queue_size=1,
+        on_saved=on_saved,
+    )
+    pipeline.start()
+    for file in pages:
+        pipeline.submit(file)
+    pipeline.finish_rendering()
+    results = {doc.file: doc for doc in pipeline.finish()}
+
+    # Then
+    assert set(results) == {file0, file1}
+    assert sorted(pipeline.failed_files, key=lambda f: f.name) == [file2, file3]
+    assert results[file0].rendered == {
+        pages[file0][1]: f"md {pages[file0][1].uuid}",
+        pages[file0][2]: f"md {pages[file0][2].uuid}",
+    }
+    assert not results[file0].failed
+    assert results[file0].pdf_path == Path("file0.pdf")
+    assert results[file1].failed == {pages[file1][1]}
+    assert mock_page_to_md.call_count == 4
+    assert checkpointed == [file0]
+    assert results[file0].checkpointed
+    assert not results[file1].checkpointed
+
+
+@patch("rao.pipeline.fs.save_to_disk")
+@patch("rao.pipeline.dp.page_to_md")
+@patch("rao.pipeline.remarkable.render_pages")
+def test_sync_pipeline_defers_pages_beyond_budget(
+    mock_render: MagicMock,
+    mock_page_to_md: MagicMock,
+    mock_save: MagicMock,
+    files: Callable[[int], list[RemarkableFile]],
+):
+    # Given
+    file0, file1 = files(2)
+    pages = {file0: _pages(file0, 3), file1: _pages(file1, 2)}
+    config = ProcessingConfig(pdf_only=False, force_reprocess=False, prompt="p")
+    mock_render.side_effect = lambda _, file, **__: pages[file]
+    mock_page_to_md.side_effect = lambda page, *_: f"md {page.uuid}"
+    mock_save.side_effect = lambda doc_pages, _: ({}, [Path("doc.pdf")])
+    budget = CycleBudget(max_pages=4)
+
+    # When
+    pipeline = SyncPipeline(
+        MagicMock(),
+        {file0: config, file1: config},
+        {},
+        render_workers=1,
+        ocr_workers=2,
+        save_workers=1,
+        queue_size=1,
+        budget=budget,
+    )
+    pipeline.start()
+    for file in pages:
+        pipeline.submit(file)
+    pipeline.finish_rendering()
+    results = {doc.file: doc for doc in pipeline.finish()}
+
+    # Then
+    assert mock_page_to_md.call_count == 4
+    assert not results[file0].deferred
+    assert results[file1].deferred == {pages[file1][1]}
+    assert set(results[file1].rendered) == {pages[file1][0]}
+    assert budget.exhausted_reason == "pages"
@@ -1,5 +1,7 @@
 # Example test for test remarkable.py
-from unittest.mock import MagicMock
+import os
+from pathlib import Path
+from unittest.mock import MagicMock, patch
 
 import pandas as pd
 
@@ -27,3 +29,128 @@ def test__load_metadata_files():
     assert files[0].name == "test_file"
     assert files[0].parent_uuid == "uuid_parent"
     assert files[0].type == "document"
+
+
+def test_library_fingerprint():
+    df = pd.DataFrame(
+        {
+            "filename": ["uuid1.metadata", "uuid1.content"],
+            "st_size": [10, 20],
+            "st_mtime": [1678886400, 1678886400],
+        }
+    )
+    reordered = df.iloc[::-1]
+    touched = df.assign(st_mtime=[1678886400, 1678886401])
+
+    fingerprint = remarkable.library_fingerprint(df)
+
+    assert fingerprint == remarkable.library_fingerprint(reordered)
+    assert fingerprint != remarkable.library_fingerprint(touched)
+
+
+def _write_snapshot(root: Path):
+    xochitl = root / "xochitl"
+    (xochitl / "uuid1").mkdir(parents=True)
+    (xochitl / "uuid1.metadata").write_text(
+        '{"visibleName": "notes", "parent": "uuid2", "type": "DocumentType"}'
+    )
+    (xochitl / "uuid1.content").write_text(
+        '{"cPages": {"pages": [{"id": "p1"}, {"id": "p2"}]}}'
+    )
+    (xochitl / "uuid1" / "p1.rm").write_bytes(b"lines")
+    (xochitl / "uuid2.metadata").write_text(
+        '{"visibleName": "work", "parent": "", "type": "CollectionType"}'
+    )
+
+
+def test_local_snapshot(tmp_path: Path):
+    # Given
+    _write_snapshot(tmp_path)
+    snapshot = remarkable.LocalSnapshot(tmp_path)
+
+    # When
+    files_df = remarkable.list_files(snapshot)
+    files = remarkable.get_files(snapshot, files_df)
+
+    # Then
+    assert set(files_df.filename) == {
+        "uuid1",
+        "uuid1.metadata",
+        "uuid1.content",
+        "uuid2.metadata",
+    }
+    assert [file.path for file in files] == [Path("work/notes")]
+    assert remarkable.count_pages(snapshot, files) == {"uuid1": 2}
+
+    downloaded = remarkable._download_files(
+        files[0], snapshot.open_sftp(), tmp_path / "out"
+    )
+    assert downloaded["p1.rm"].read_bytes() == b"lines"
+
+
+def test_mirror(tmp_path: Path):
+    # Given
+    _write_snapshot(tmp_path / "tablet")
+    (tmp_path / "tablet" / "templates").mkdir()
+    (tmp_path / "tablet" / "templates" / "Lined.svg").write_text("<svg/>")
+    tablet = remarkable.LocalSnapshot(tmp_path / "tablet")
+    snapshot = remarkable.LocalSnapshot(tmp_path / "mirror")
+    metadata = tablet.files_root / "uuid1.metadata"
+
+    # When/Then
+    assert remarkable.mirror(tablet, snapshot) == 5
+    assert (snapshot.files_root / "uuid1" / "p1.rm").read_bytes() == b"lines"
+    assert (snapshot.templates_root / "Lined.svg").exists()
+    assert remarkable.get_files(
+        snapshot, remarkable.list_files(snapshot)
+    ) == remarkable.get_files(tablet, remarkable.list_files(tablet))
+
+    assert remarkable.mirror(tablet, snapshot) == 0
+
+    (tablet.files_root / "uuid1" / "p1.rm").write_bytes(b"more lines")
+    os.utime(metadata, (metadata.stat().st_mtime + 10,) * 2)
+    (tablet.files_root / "uuid2.metadata").unlink()
+    assert remarkable.mirror(tablet, snapshot) == 2
+    assert (snapshot.files_root / "uuid1" / "p1.rm").read_bytes() == b"more lines"
+    assert not (snapshot.files_root / "uuid2.metadata").exists()
+
+
+def test_template_cache(tmp_path: Path):
+    # Given
+    templates = tmp_path / "tablet" / "templates"
+    templates.mkdir(parents=True)
+    (templates / "Lined.svg").write_text("<svg/>")
+    sftp = MagicMock(wraps=remarkable.LocalSnapshot(tmp_path / "tablet").open_sftp())
+    cache = remarkable.TemplateCache(tmp_path / "cache")
+    templates_per_page = {"p1": "Lined", "p2": "Lined", "p3": "Missing"}
+
+    # When
+    with patch.object(remarkable, "template_cache", cache):
+        first = remarkable._download_templates(templates_per_page, sftp)
+        second = remarkable._download_templates(templates_per_page, sftp)
+        listed = sftp.listdir_attr.call_count
+        (templates / "Lined.svg").write_text("<svg>updated</svg>")
+        cache.forget_listings()  # Next cycle
+        updated = remarkable._download_templates(templates_per_page, sftp)
+    restarted = remarkable.TemplateCache(tmp_path / "cache").get("Lined", sftp)
+    (tmp_path / "bob" / "templates").mkdir(parents=True)
+    (tmp_path / "bob" / "templates" / "Lined.svg").write_text(
+        "<svg>other firmware</svg>"
+    )
+    bob_sftp = remarkable.LocalSnapshot(tmp_path / "bob").open_sftp()
+    other_tablet = cache.get("Lined", bob_sftp, tablet="bob")
+    after_other_tablet = cache.get("Lined", sftp)
+    cache.get("Lined", bob_sftp, tablet="bob")
+
+    # Then
+    assert first == second == {"Lined": first["Lined"]}
+    assert listed == 1
+    sftp.stat.assert_not_called()
+    assert first["Lined"].read_text() == "<svg/>"
+    assert updated["Lined"].read_text() == "<svg>updated</svg>"
+    assert updated["Lined"].name == "Lined.svg"
+    assert updated["Lined"].parent != first["Lined"].parent
+    assert restarted == updated["Lined"]
+    assert other_tablet.read_text() == "<svg>other firmware</svg>"
+    assert after_other_tablet == updated["Lined"]  # Not evicted by the other tablet
+    assert (cache.hits, cache.misses) == (3, 3)
@@ -0,0 +1,142 @@
+# tests/test_scheduler.py
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import replace
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+
+from rao.config import Config
+from rao.file_processing_config import ProcessingConfig
+from rao.models import RemarkableFile
+from rao.scheduler import (
+    AdaptiveScheduler,
+    CycleBudget,
+    CycleOutcome,
+    FairShare,
+    prioritise,
+)
+
+
+@pytest.fixture
+def intervals():
+    with (
+        patch.object(Config, "min_check_interval", new=10),
+        patch.object(Config, "check_interval", new=60),
+        patch.object(Config, "max_check_interval", new=300),
+        patch.object(Config, "max_staleness", new=1000),
+    ):
+        yield
+
+
+def test_scheduler_backs_off_while_idle_and_speeds_up_on_edits(intervals):
+    now = 0.0
+    scheduler = AdaptiveScheduler(clock=lambda: now)
+
+    assert scheduler.next_interval(CycleOutcome.IDLE) == 60
+    assert scheduler.next_interval(CycleOutcome.IDLE) == 120
+    assert scheduler.next_interval(CycleOutcome.IDLE) == 240
+    assert scheduler.next_interval(CycleOutcome.IDLE) == 300
+    assert scheduler.next_interval(CycleOutcome.CHANGED) == 10
+    assert scheduler.reason == "recent edits"
+    assert scheduler.next_interval(CycleOutcome.IDLE) == 60
+
+
+def test_scheduler_offline(intervals):
+    now = 0.0
+    scheduler = AdaptiveScheduler(clock=lambda: now)
+    assert scheduler.connect_retries == 5
+
+    waits = []
+    for now in range(0, 1500, 300):
+        waits.append(scheduler.next_interval(CycleOutcome.OFFLINE))
+
+    assert waits == [60, 120, 240, 300, 300]  # Not shortened by max staleness
+    assert scheduler.reason == "offline, backing off"
+    assert scheduler.connect_retries == 1
+
+
+def test_scheduler_max_staleness(intervals):
+    now = 0.0
+    scheduler = AdaptiveScheduler(clock=lambda: now)
+
+    with patch.object(Config, "max_staleness", new=100):
+        assert scheduler.next_interval(CycleOutcome.IDLE) == 60
+        assert scheduler.next_interval(CycleOutcome.IDLE) == 100
+        assert scheduler.reason == "max staleness"
+        assert scheduler.next_interval(CycleOutcome.FAILED) == 240
+
+
+def test_cycle_budget():
+    now = 0.0
+    budget = CycleBudget(
+        max_pages=5, max_api_calls=2, max_seconds=60, clock=lambda: now
+    )
+
+    assert budget.reserve_pages(3) == 3
+    assert budget.reserve_pages(3) == 2
+    assert budget.reserve_pages(1) == 0
+    assert budget.exhausted_reason == "pages"
+
+    assert budget.spend_api_call()
+    assert budget.can_convert()
+    assert budget.spend_api_call()
+    assert not budget.can_convert()
+    assert not budget.spend_api_call()
+
+    now = 60.0
+    assert budget.out_of_time()
+    assert budget.exhausted_reason == "pages"  # The first reason is kept
+
+
+def test_cycle_budget_unlimited():
+    budget = CycleBudget()
+    assert budget.reserve_pages(10_000) == 10_000
+    assert all(budget.spend_api_call() for _ in range(1000))
+    assert budget.exhausted_reason is None
+
+
+def test_prioritise(files: Callable[[int], list[RemarkableFile]]):
+    # Given
+    old, recent, important = files(3)
+    recent = replace(recent, last_modified=old.last_modified + timedelta(days=1))
+    configs = {
+        old: ProcessingConfig(pdf_only=False, force_reprocess=False, prompt=None),
+        recent: ProcessingConfig(pdf_only=False, force_reprocess=False, prompt=None),
+        important: ProcessingConfig(
+            pdf_only=False, force_reprocess=False, prompt=None, priority=1
+        ),
+    }
+
+    # When/Then
+    assert prioritise([old, recent, important], configs) == [important, recent, old]
+
+
+def test_fair_share_takes_turns_between_tablets():
+    # Given
+    share = FairShare(slots=1)
+    order = []
+    blocker = share.slot("a")
+    blocker.__enter__()
+
+    def convert(tablet: str):
+        with share.slot(tablet):
+            order.append(tablet)
+
+    threads = []
+    for tablet in ["a", "a", "a", "b"]:
+        thread = threading.Thread(target=convert, args=(tablet,))
+        thread.start()
+        threads.append(thread)
+        while sum(share._waiting.values()) < len(threads):
+            time.sleep(0.001)
+
+    # When
+    blocker.__exit__(None, None, None)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # Then
+    assert order == ["a", "b", "a", "a"]
@@ -0,0 +1,87 @@
+# tests/test_watcher.py
+import os
+import signal
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from rao import watcher
+from rao.config import Config
+
+
+@pytest.fixture(autouse=True)
+def no_debounce():
+    with patch("rao.watcher.DEBOUNCE_SECONDS", new=0):
+        yield
+
+
+def test_sync_trigger():
+    trigger = watcher.SyncTrigger()
+
+    assert trigger.wait(0) == []
+    trigger.fire("a")
+    trigger.fire("b")
+    trigger.fire("a")
+    assert trigger.wait(10) == ["a", "b"]
+    assert trigger.wait(0) == []
+
+
+def test_signal_relay_while_trigger_is_locked():
+    # Given
+    trigger = watcher.SyncTrigger()
+    relay = watcher.SignalRelay(trigger)
+    previous = signal.signal(signal.SIGHUP, relay.on_signal)
+    relay.start()
+
+    # When
+    try:
+        with trigger._lock:  # As in `SyncTrigger.wait`
+            os.kill(os.getpid(), signal.SIGHUP)
+            time.sleep(0.05)  # Let the handler run
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+
+    # Then
+    assert trigger.wait(2) == ["SIGHUP"]
+
+
+def test_control_server(tmp_path: Path):
+    trigger = watcher.SyncTrigger()
+    socket_path = tmp_path / "rao.sock"
+    watcher.ControlServer(trigger, socket_path).start()
+    for _ in range(50):
+        try:
+            response = watcher.send_command("sync", socket_path)
+            break
+        except OSError:  # Not listening yet
+            time.sleep(0.01)
+
+    assert response == "ok"
+    assert watcher.send_command("foo", socket_path) == "unknown command: foo"
+    assert trigger.wait(10) == ["sync requested"]
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_input_watcher(tmp_path: Path, use_inotify: bool):
+    whitelist_path = tmp_path / "whitelist.csv"
+    whitelist_path.write_text("path\n")
+    (tmp_path / "prompts").mkdir()
+    trigger = watcher.SyncTrigger()
+
+    with (
+        patch.object(Config, "whitelist_path", new=str(whitelist_path)),
+        patch.object(Config, "prompts_dir", new=str(tmp_path / "prompts")),
+        patch.object(Config, "watch_poll_interval", new=0.05),
+    ):
+        input_watcher = watcher.InputWatcher(trigger)
+        if not use_inotify:
+            input_watcher._inotify_init = lambda: (_ for _ in ()).throw(OSError())
+        input_watcher.start()
+        time.sleep(0.2)
+        (tmp_path / "unrelated.txt").write_text("ignored")
+        assert trigger.wait(0.2) == []
+
+        (tmp_path / "prompts" / "prompt.txt").write_text("new prompt")
+        assert trigger.wait(2) == [f"{tmp_path / 'prompts' / 'prompt.txt'} changed"]